@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+from loguru import logger
+
+IVF_MIN_SIZE = 4096  # below this the exact scan is fast enough
+IVF_NPROBE = 8  # lists searched per face, more lists give a better recall
+IVF_ITERATIONS = 10  # k-means iterations when training
+IVF_SAMPLE = 256  # training rows per list
+IVF_RETRAIN_GROWTH = 4  # retrain once the gallery grew by this factor
+
+
+################################################################################
+# index of the nearest centroid for every row
+################################################################################
+def nearest_centroids(vectors: np.ndarray, centroids: np.ndarray, count: int = 1) -> np.ndarray:
+    """
+    Indices of the ``count`` nearest centroids of every vector, shape (N, count).
+    """
+    squared = (np.einsum("ij,ij->i", vectors, vectors)[:, None] +
+               np.einsum("ij,ij->i", centroids, centroids)[None, :] -
+               2.0 * (vectors @ centroids.T))
+    if count >= len(centroids):
+        return np.argsort(squared, axis=1)
+    return np.argpartition(squared, count - 1, axis=1)[:, :count]
+
+
+class IvfIndex:
+    """
+    Inverted file index over the gallery matrix, in pure NumPy.
+
+    The encodings are clustered with k-means into about sqrt(N) lists. A
+    face is only compared against the students in the ``nprobe`` lists
+    whose centroids are closest to it. The index stores the list of every
+    gallery row, the distances themselves are computed exactly on the
+    gallery matrix, so the tolerance means the same as for the exact scan.
+    """
+
+    def __init__(self, nprobe: int = IVF_NPROBE, min_size: int = IVF_MIN_SIZE):
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.centroids = None
+        self.assignments = np.empty((0,), dtype=np.int32)
+        self.trained_size = 0
+
+    @property
+    def ready(self) -> bool:
+        return self.centroids is not None
+
+    ############################################################
+    # cluster the encodings and assign every row
+    ############################################################
+    def train(self, encodings: np.ndarray, seed: int = 0):
+        """
+        Train the centroids on the encodings and assign all the rows. For a
+        small gallery the index stays empty and the exact scan is used.
+        """
+        size = len(encodings)
+        self.trained_size = size
+        if size < self.min_size:
+            self.centroids = None
+            self.assignments = np.empty((0,), dtype=np.int32)
+            return
+
+        rng = np.random.default_rng(seed)
+        lists = int(math.sqrt(size))
+        sample = encodings[rng.choice(size, min(size, lists * IVF_SAMPLE), replace=False)]
+        centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+        for _ in range(IVF_ITERATIONS):
+            labels = nearest_centroids(sample, centroids)[:, 0]
+            counts = np.bincount(labels, minlength=lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = counts == 0
+            centroids[~empty] = sums[~empty] / counts[~empty, None]
+            # restart the empty lists from random rows
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+
+        self.centroids = centroids.astype(np.float32)
+        self.assignments = np.empty((max(size, 1),), dtype=np.int32)
+        self.assignments[:size] = nearest_centroids(np.asarray(encodings, dtype=np.float32), self.centroids)[:, 0]
+        logger.info(f"IVF index trained with {lists} lists over {size} encodings")
+
+    ############################################################
+    # the gallery has to be trained again
+    ############################################################
+    def needs_training(self, size: int) -> bool:
+        if self.ready:
+            return size > self.trained_size * IVF_RETRAIN_GROWTH
+        return size >= self.min_size
+
+    ############################################################
+    # assign a new row
+    ############################################################
+    def add(self, row: int, encoding: np.ndarray):
+        if not self.ready:
+            return
+        if row >= len(self.assignments):
+            assignments = np.empty((max(2 * len(self.assignments), row + 1),), dtype=np.int32)
+            assignments[:len(self.assignments)] = self.assignments
+            self.assignments = assignments
+        self.assignments[row] = nearest_centroids(encoding.reshape(1, -1), self.centroids)[0, 0]
+
+    ############################################################
+    # a row was moved by the gallery
+    ############################################################
+    def move(self, source: int, target: int):
+        if self.ready:
+            self.assignments[target] = self.assignments[source]
+
+    ############################################################
+    # candidate rows for each face
+    ############################################################
+    def candidates(self, faces: np.ndarray, size: int) -> list:
+        """
+        Gallery rows in the nprobe nearest lists of every face.
+
+        Parameters
+        ----------
+        faces : np.ndarray
+            Face encodings of shape (F, 128)
+        size : int
+            Number of rows in the gallery
+
+        Returns
+        -------
+        rows : list
+            One array of gallery rows per face
+        """
+        probes = nearest_centroids(faces, self.centroids, min(self.nprobe, len(self.centroids)))
+        assignments = self.assignments[:size]
+        rows = []
+        for probe in probes:
+            selected = np.zeros((len(self.centroids),), dtype=bool)
+            selected[probe] = True
+            rows.append(np.flatnonzero(selected[assignments]))
+        return rows
@@ -1,5 +1,11 @@
+# first import, starts the startup clock before the heavy imports below
+from started import STARTED  # isort: skip
+import asyncio
+import itertools
+import sqlite3
+import time
 from contextlib import asynccontextmanager
-import os
+from datetime import datetime
 import pathlib
 import uuid
 # from datetime import datetime
@@ -7,21 +13,44 @@ from pathlib import Path
 # from typing import Annotated, Optional, Union
 # from uuid import UUID
 # import numpy as np
-import json
-import face_recognition
 
-from fastapi import FastAPI, File, Request, UploadFile, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, File, HTTPException, Request, UploadFile, Form, WebSocket, WebSocketDisconnect
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from database import FacesDatabase
+from database import ATTENDANCE_PAGE_SIZE, FacesDatabase, parse_date
+from enrollment import (MAX_PHOTO_BYTES, MAX_ROSTER_BYTES, PHOTO_EXTENSIONS, check_roster_size, discard_photos,
+                        encode_photos, load_models, photo_chunks, prepare_photo, stage_archive, store_students)
+from export import EXPORT_FORMATS, export_attendance, parquet_available
+from executor import PoolBusy, database_executor, encoding_executor
+from metrics import CONTENT_TYPE, REGISTRY, counter, gauge, histogram
+from photos import remove_photo
+from preview import PREVIEW_FPS, PREVIEW_STALE, PreviewReader, preview_cameras
 # from database import Student
 import starlette.status as status
 from loguru import logger
 
 faces_db = FacesDatabase()
+# blocking calls run here, the handlers only await them
+database_pool = database_executor()
+# the encoding processes load the dlib models, the app never does
+encoding_pool = encoding_executor(initializer=load_models)
+
+REQUEST_SECONDS = histogram("attendance_http_request_seconds", "Time to answer a request",
+                            ("method", "route", "status"))
+REQUESTS_IN_FLIGHT = gauge("attendance_http_requests_in_flight", "Requests being answered")
+POOL_REJECTIONS = counter("attendance_pool_rejections_total", "Calls refused by a full pool", ("pool",))
+POOL_PENDING = gauge("attendance_pool_pending", "Calls running or waiting in a pool", ("pool",))
+POOL_PENDING.set_function(lambda: database_pool.pending, pool="database")
+POOL_PENDING.set_function(lambda: encoding_pool.pending, pool="encoding")
+STARTUP_SECONDS = gauge("attendance_startup_seconds", "Time from the start of the app to a startup phase",
+                        ("phase",))
+in_flight = 0
+first_response = True
+IMPORTED = time.perf_counter() - STARTED
+STARTUP_SECONDS.set(IMPORTED, phase="import")
 
 
 ###############################################################################
@@ -29,8 +58,15 @@ faces_db = FacesDatabase()
 ###############################################################################
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # the models load in the encoding processes while the app serves
+    encoding_pool.warm()
+    ready = time.perf_counter() - STARTED
+    STARTUP_SECONDS.set(ready, phase="ready")
+    logger.info(f"Application ready in {ready * 1000:.0f} ms (imports {IMPORTED * 1000:.0f} ms).")
     yield
     logger.debug("Application shutdown with database close.")
+    encoding_pool.shutdown()
+    database_pool.shutdown()
     faces_db.close_db()
 
 
@@ -41,6 +77,59 @@ app.mount("/assets", StaticFiles(directory="assets"), name="assets")
 templates = Jinja2Templates(directory="templates")
 
 PICTURS_FOLDER = "./assets/faces"
+MAX_PAGE_SIZE = 500
+UPLOAD_CHUNK = 1024 * 1024  # uploads are copied to disk 1 MB at a time
+MAX_ARCHIVE_BYTES = 2 * 1024 * 1024 * 1024  # largest bulk enrollment archive
+RETRY_AFTER = 2  # seconds a client should wait when a pool is full
+
+
+###############################################################################
+# a full pool is a temporary overload
+###############################################################################
+@app.exception_handler(PoolBusy)
+async def pool_busy(request: Request, e: PoolBusy):
+    POOL_REJECTIONS.inc(pool=e.name)
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        content={"detail": f"Server is busy ({e.name}), please try again shortly."},
+                        headers={"Retry-After": str(RETRY_AFTER)})
+
+
+###############################################################################
+# time every request
+###############################################################################
+@app.middleware("http")
+async def measure_request(request: Request, call_next):
+    """
+    Observe the time to the response of every request, labelled with the
+    route template (not the path) so ids in paths do not add series. A
+    streamed response is measured until it starts.
+    """
+    global in_flight, first_response
+    in_flight += 1
+    REQUESTS_IN_FLIGHT.set(in_flight)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        in_flight -= 1
+        REQUESTS_IN_FLIGHT.set(in_flight)
+        if first_response:
+            first_response = False
+            STARTUP_SECONDS.set(time.perf_counter() - STARTED, phase="first_response")
+        route = request.scope.get("route")
+        REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method,
+                                route=route.path if route is not None else "unmatched", status=status_code)
+
+
+###############################################################################
+# metrics of the web app
+###############################################################################
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
 
 
 ###############################################################################
@@ -64,7 +153,7 @@ async def students_list(request: Request, msg: bool = False):
         msg_string = "New user created sucessfully! \U0001F44F"
 
     # get all the faces from database
-    students = faces_db.get_all_faces()
+    students = await database_pool.run(faces_db.get_all_faces)
     return templates.TemplateResponse(
         request=request,
         name="student_list.html",
@@ -78,19 +167,134 @@ async def students_list(request: Request, msg: bool = False):
 # attendance listing
 ###############################################################################
 @app.get("/attendance/list", response_class=HTMLResponse)
-async def attendance_list(request: Request):
-
-    # get all the faces from database
-    attendance_list = faces_db.get_attendance(student_face_id="")
+async def attendance_list(request: Request,
+                          date_from: str = "",
+                          date_to: str = "",
+                          course: str = "",
+                          face_id: str = ""):
+
+    # get the first page, the page loads the next ones from the json endpoint
+    attendance_list, next_cursor = await database_pool.run(get_attendance_page, "", ATTENDANCE_PAGE_SIZE,
+                                                           date_from, date_to, course, face_id)
+    courses = await database_pool.run(faces_db.get_courses)
     return templates.TemplateResponse(
         request=request,
         name="attendance_list.html",
         context={
-            "attendance_list": attendance_list
+            "attendance_list": attendance_list,
+            "next_cursor": next_cursor,
+            "courses": courses,
+            "filters": {"date_from": date_from, "date_to": date_to, "course": course, "face_id": face_id},
         }
     )
 
 
+###############################################################################
+# attendance listing as json, one page at a time
+###############################################################################
+@app.get("/attendance/list/json", response_class=JSONResponse)
+async def attendance_list_json(cursor: str = "",
+                               limit: int = ATTENDANCE_PAGE_SIZE,
+                               date_from: str = "",
+                               date_to: str = "",
+                               course: str = "",
+                               face_id: str = ""):
+    attendance_list, next_cursor = await database_pool.run(get_attendance_page, cursor, limit,
+                                                           date_from, date_to, course, face_id)
+    return {
+        "items": [{"id": attendance.id,
+                   "face_id": attendance.face_id,
+                   "filename": attendance.filename,
+                   "name": attendance.name,
+                   "course": attendance.course,
+                   "attendance_time": attendance.attendance_time,
+                   "timestamp": attendance.timestamp} for attendance in attendance_list],
+        "next_cursor": next_cursor,
+    }
+
+
+###############################################################################
+# export of the attendance as a file
+###############################################################################
+@app.get("/attendance/export")
+async def attendance_export(format: str = "csv",
+                            date_from: str = "",
+                            date_to: str = "",
+                            course: str = "",
+                            face_id: str = ""):
+    """
+    Stream the attendance as CSV or parquet. The rows are read a chunk at a
+    time and the generator runs in the thread pool of the response, so a
+    year of attendance takes neither memory nor the event loop.
+    """
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=400, detail="parquet export needs pyarrow on the server")
+    try:
+        time_from = parse_date(date_from)
+        time_to = parse_date(date_to, end_of_day=True)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid filter: {e}")
+
+    (media_type, extension) = EXPORT_FORMATS[format]
+    pieces = export_attendance(faces_db, format, time_from, time_to, course, face_id)
+    # the first piece is read before the headers are sent, so a database
+    # error answers 503; a later one aborts the transfer
+    try:
+        first = await database_pool.run(next, pieces, b"")
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"export failed: {e}")
+    return StreamingResponse(itertools.chain([first], pieces),
+                             media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="attendance.{extension}"'})
+
+
+###############################################################################
+# validate the listing parameters and read the page
+###############################################################################
+def get_attendance_page(cursor: str, limit: int, date_from: str, date_to: str, course: str, face_id: str):
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    try:
+        return faces_db.get_attendance_page(cursor, limit,
+                                            parse_date(date_from),
+                                            parse_date(date_to, end_of_day=True),
+                                            course, face_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"invalid filter or cursor: {e}")
+
+
+###############################################################################
+# attendance per day and course
+###############################################################################
+@app.get("/reports/daily", response_class=JSONResponse)
+async def daily_report(date_from: str = "", date_to: str = "", course: str = ""):
+    check_days(date_from, date_to)
+    return await database_pool.run(faces_db.get_daily_report, date_from, date_to, course)
+
+
+###############################################################################
+# attendance of the students of a course
+###############################################################################
+@app.get("/reports/course", response_class=JSONResponse)
+async def course_report(course: str, date_from: str = "", date_to: str = ""):
+    check_days(date_from, date_to)
+    return await database_pool.run(faces_db.get_course_report, course, date_from, date_to)
+
+
+###############################################################################
+# report days must be YYYY-MM-DD
+###############################################################################
+def check_days(*days: str):
+    for day in days:
+        try:
+            if day:
+                datetime.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"invalid date: {day}, expected YYYY-MM-DD")
+
+
 ###############################################################################
 # New student registration
 ###############################################################################
@@ -152,23 +356,51 @@ async def register_student(request: Request,
     # logger.debug(len(profile_picture.filename), profile_picture.filename)
     logger.debug(f"profile picture filename: {profile_picture.filename}")
     # Save the uploaded profile picture
-    face_id = save_profile_pic(profile_picture)
-    image = face_id + pathlib.Path(str(profile_picture.filename)).suffix
-    face_image = face_recognition.load_image_file(f"assets/faces/{image}")
+    try:
+        face_id = await database_pool.run(save_profile_pic, profile_picture)
+    except ValueError as e:
+        logger.error(f"error: profile picture not saved, {e}")
+        return templates.TemplateResponse(
+            request=request,
+            name="student_new.html",
+            context={
+                "name_value": name,
+                "course_value": course,
+                "error_message": f"The profile picture can not be used ({e}).",
+            },
+            status_code=400,
+        )
+    image = face_id + pathlib.Path(str(profile_picture.filename)).suffix.lower()
     logger.debug("Image filename: ", image)
-    face_encodings = face_recognition.face_encodings(face_image)[0]
+    # dlib runs in the encoding processes, which also write the
+    # downscaled photo, its display and thumbnail variants and face crop
+    face_encodings, error = await encoding_pool.run(prepare_photo, f"{PICTURS_FOLDER}/{image}")
+    if face_encodings is None:
+        logger.error(f"error: profile picture not usable, {error}")
+        await database_pool.run(remove_photo, face_id, image, PICTURS_FOLDER)
+        return templates.TemplateResponse(
+            request=request,
+            name="student_new.html",
+            context={
+                "name_value": name,
+                "course_value": course,
+                "error_message": f"The profile picture can not be used ({error}).",
+            },
+            status_code=400,
+        )
     # print("face encodings:\n", face_encodings)
-    new_face_id = faces_db.insert_face_details(name,
-                                               course,
-                                               face_id,
-                                               image,
-                                               json.dumps(face_encodings.tolist()))
+    new_face_id = await database_pool.run(faces_db.insert_face_details,
+                                          name,
+                                          course,
+                                          face_id,
+                                          image,
+                                          face_encodings)
     # print(new_face_id)
 
     # message to user on successfully created user
     msg_string = f"New user ({name}) created sucessfully! \U0001F44F"
     # return the listing screen
-    students = faces_db.get_all_faces()
+    students = await database_pool.run(faces_db.get_all_faces)
     return templates.TemplateResponse(
         request=request,
         name="student_list.html",
@@ -177,20 +409,102 @@ async def register_student(request: Request,
     )
 
 
+###############################################################################
+# Bulk registration from a ZIP archive of photos and a CSV roster
+###############################################################################
+@app.post("/students/bulk", response_class=JSONResponse)
+async def bulk_register_students(archive: UploadFile = File(...),
+                                 roster: UploadFile = File(None)):
+    logger.debug(f"bulk registration invoked ({archive.filename}, {roster.filename if roster else ''})")
+    if archive.size is not None and archive.size > MAX_ARCHIVE_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail=f"archive is larger than {MAX_ARCHIVE_BYTES // (1024 * 1024)} MB")
+    start = time.perf_counter()
+    try:
+        roster_text = ""
+        if roster is not None and roster.filename:
+            content = await roster.read(MAX_ROSTER_BYTES + 1)
+            check_roster_size(len(content))
+            roster_text = content.decode("utf-8-sig")
+        results, photos = await database_pool.run(stage_archive, archive.file, roster_text, PICTURS_FOLDER)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # the photos are encoded a chunk per task of the encoding pool, so a
+    # full pool refuses the import (503) like any other registration
+    stored = False
+    try:
+        encodings = await encode_chunks(photo_chunks(photos, PICTURS_FOLDER))
+        report = await database_pool.run(store_students, faces_db, results, photos, encodings,
+                                         PICTURS_FOLDER, start)
+        stored = True
+    finally:
+        if not stored:
+            discard_photos(photos, PICTURS_FOLDER)
+    return report
+
+
+###############################################################################
+# encode the chunks of photos of a bulk registration
+###############################################################################
+async def encode_chunks(chunks: list) -> list:
+    """
+    Run encode_photos on the encoding pool, as many chunks at a time as
+    there are encoding processes, so an import never fills the queue of
+    the pool by itself.
+
+    Raises
+    ------
+    PoolBusy
+        If the pool is full, once the chunks already running are done
+    """
+    encodings = []
+    for first in range(0, len(chunks), encoding_pool.workers):
+        # wait for the whole wave, no worker writes photo variants after a failure
+        encoded = await asyncio.gather(*(encoding_pool.run(encode_photos, chunk)
+                                         for chunk in chunks[first:first + encoding_pool.workers]),
+                                       return_exceptions=True)
+        for chunk in encoded:
+            if isinstance(chunk, BaseException):
+                raise chunk
+            encodings.extend(chunk)
+    return encodings
+
+
 ###############################################################################
 # Save profile picture to faces folder
 ###############################################################################
 def save_profile_pic(upload_file: UploadFile) -> str:
+    """
+    Copy the upload to the faces folder in chunks, so a large upload is
+    never held in memory.
+
+    Raises
+    ------
+    ValueError
+        If the upload is not a PHOTO_EXTENSIONS image or larger than
+        MAX_PHOTO_BYTES, nothing is kept then
+    """
     # file_extension = pathlib.Path(upload_file.filename).suffix
     if not upload_file:
         return ""
-    file_ext = pathlib.Path(str(upload_file.filename)).suffix
+    file_ext = pathlib.Path(str(upload_file.filename)).suffix.lower()
+    if file_ext not in PHOTO_EXTENSIONS:
+        raise ValueError(f"must be one of {', '.join(PHOTO_EXTENSIONS)}")
     face_id_uuid = str(uuid.uuid4()) + file_ext
     logger.debug(f"UUID {face_id_uuid}")
 
     file_path = Path(PICTURS_FOLDER) / face_id_uuid
+    size = 0
     with file_path.open("wb") as buffer:
-        buffer.write(upload_file.file.read())
+        while chunk := upload_file.file.read(UPLOAD_CHUNK):
+            size += len(chunk)
+            if size > MAX_PHOTO_BYTES:
+                break
+            buffer.write(chunk)
+    if size > MAX_PHOTO_BYTES:
+        file_path.unlink()
+        raise ValueError(f"larger than {MAX_PHOTO_BYTES // (1024 * 1024)} MB")
 
     # finally return the uuid
     return face_id_uuid.split(".")[0]
@@ -201,14 +515,14 @@ def save_profile_pic(upload_file: UploadFile) -> str:
 ###############################################################################
 @app.get("/students/delete/{face_id}", response_class=RedirectResponse)
 async def delete_student(request: Request, face_id: str):
-    student = faces_db.get_student_details(face_id)
+    student = await database_pool.run(faces_db.get_student_details, face_id)
 
     if student != None:
-        deleted = faces_db.delete_face_details(student.face_id)
+        deleted = await database_pool.run(faces_db.delete_face_details, student.face_id)
         if not deleted:
             logger.error("unable to delete the student details")
         else:
-            os.remove(f"{PICTURS_FOLDER}/{student.filename}")
+            await database_pool.run(remove_photo, student.face_id, student.filename, PICTURS_FOLDER)
     redirect_url = request.url_for('students_list')
     return RedirectResponse(redirect_url, status_code=status.HTTP_302_FOUND)
 
@@ -218,13 +532,139 @@ async def delete_student(request: Request, face_id: str):
 ###############################################################################
 @app.get("/attendance/delete/{id}", response_class=RedirectResponse)
 async def delete_student(request: Request, id: int):
-    deleted = faces_db.delete_attendance_details(id)
+    deleted = await database_pool.run(faces_db.delete_attendance_details, id)
     if not deleted:
         logger.error("unable to delete the student details")
     redirect_url = request.url_for('attendance_list')
     return RedirectResponse(redirect_url, status_code=status.HTTP_302_FOUND)
 
 
+###############################################################################
+# live preview of the cameras
+###############################################################################
+@app.get("/preview", response_class=HTMLResponse)
+async def preview_page(request: Request):
+    return templates.TemplateResponse(
+        request=request,
+        name="preview.html",
+        context={"cameras": preview_cameras()}
+    )
+
+
+###############################################################################
+# cameras publishing a preview and their mode
+###############################################################################
+@app.get("/preview/cameras", response_class=JSONResponse)
+async def preview_camera_list():
+    cameras = []
+    for camera in preview_cameras():
+        try:
+            reader = PreviewReader(camera)
+        except (OSError, ValueError):
+            # the camera stopped while listing
+            continue
+        cameras.append(reader.status())
+        reader.close()
+    return cameras
+
+
+###############################################################################
+# open the preview of a camera
+###############################################################################
+def open_preview(camera: str) -> PreviewReader:
+    try:
+        return PreviewReader(camera)
+    except (OSError, ValueError):
+        raise HTTPException(status_code=404, detail=f"camera {camera} has no preview")
+
+
+###############################################################################
+# wait for a newer frame of the camera
+###############################################################################
+async def next_preview_frame(reader: PreviewReader, sequence: int):
+    """
+    Poll the ring of the camera until there is a frame newer than
+    ``sequence``. A client that falls behind gets the newest frame and
+    skips the ones in between, so a slow client never slows the camera or
+    the other clients. The camera process starts a new ring when it
+    restarts, so the reader is opened again after PREVIEW_STALE seconds
+    without a frame.
+
+    Returns
+    -------
+    (reader, frame) : tuple
+        The reader to use from now on and the frame of PreviewReader.latest
+    """
+    waited = 0.0
+    interval = 0.5 / PREVIEW_FPS
+    while True:
+        frame = reader.latest(after=sequence)
+        if frame is not None:
+            return reader, frame
+        await asyncio.sleep(interval)
+        waited += interval
+        if waited >= PREVIEW_STALE:
+            waited = 0.0
+            try:
+                fresh = PreviewReader(reader.camera)
+            except (OSError, ValueError):
+                continue
+            reader.close()
+            reader = fresh
+            # numbering starts again in a new ring
+            sequence = 0
+
+
+###############################################################################
+# MJPEG stream of a camera, shown by an <img> tag
+###############################################################################
+@app.get("/preview/{camera}/mjpeg")
+async def preview_mjpeg(request: Request, camera: str):
+    reader = open_preview(camera)
+
+    async def frames():
+        nonlocal reader
+        sequence = 0
+        try:
+            while not await request.is_disconnected():
+                reader, (sequence, jpeg, _, _) = await next_preview_frame(reader, sequence)
+                yield (b"--frame\r\nContent-Type: image/jpeg\r\n"
+                       + f"Content-Length: {len(jpeg)}\r\n\r\n".encode() + jpeg + b"\r\n")
+        finally:
+            reader.close()
+
+    return StreamingResponse(frames(), media_type="multipart/x-mixed-replace; boundary=frame",
+                             headers={"Cache-Control": "no-store"})
+
+
+###############################################################################
+# frames and mode of a camera over a websocket
+###############################################################################
+@app.websocket("/preview/{camera}/ws")
+async def preview_websocket(websocket: WebSocket, camera: str):
+    """
+    Send a JSON message with the sequence, mode and time of every frame,
+    followed by the JPEG as a binary message.
+    """
+    try:
+        reader = PreviewReader(camera)
+    except (OSError, ValueError):
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    sequence = 0
+    try:
+        while True:
+            reader, (sequence, jpeg, mode, timestamp) = await next_preview_frame(reader, sequence)
+            await websocket.send_json({"camera": camera, "sequence": sequence, "mode": mode,
+                                       "timestamp": timestamp})
+            await websocket.send_bytes(jpeg)
+    except WebSocketDisconnect:
+        logger.debug(f"preview client of {camera} disconnected")
+    finally:
+        reader.close()
+
+
 ################################################################################
 # Demo routes
 ################################################################################
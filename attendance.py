@@ -0,0 +1,310 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import List
+
+from loguru import logger
+
+from database import FacesDatabase
+
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+JOURNAL_FILE = "db/attendance.journal"
+MAX_JOURNALS = 16  # processes writing attendance at the same time at most
+BATCH_SIZE = 32  # attendance rows committed together at most
+BATCH_WINDOW = 0.05  # seconds to wait for more rows after the first one
+WRITE_RETRIES = 3  # attempts to commit a batch before it is reported failed
+RETRY_DELAY = 0.5  # seconds before the first retry, doubled every time
+REQUEUE_DELAY = 5.0  # seconds before a failed row is queued again, doubled every time
+MAX_REQUEUE_DELAY = 300.0  # longest wait before queueing a failed row again
+
+
+################################################################################
+# journal file of the given slot
+################################################################################
+def journal_path(journal_file: str, slot: int) -> str:
+    """
+    db/attendance.journal for the first slot, db/attendance.<slot>.journal
+    for the others.
+    """
+    if slot == 0:
+        return journal_file
+    root, extension = os.path.splitext(journal_file)
+    return f"{root}.{slot}{extension}"
+
+
+################################################################################
+# exclusive lock of an open file, without waiting
+################################################################################
+def lock_file(file) -> bool:
+    """
+    Lock the file for this process. The lock goes away with the process,
+    so the journal of a process that died can be taken over.
+    """
+    try:
+        if sys.platform == "win32":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+################################################################################
+# rows of a journal
+################################################################################
+def read_rows(journal) -> List[dict]:
+    rows = []
+    journal.seek(0)
+    for line in journal:
+        try:
+            rows.append(json.loads(line))
+        except json.JSONDecodeError:
+            # the last line is cut if the process died writing it
+            logger.warning(f"skipping damaged attendance journal line: {line!r}")
+    return rows
+
+
+class AttendanceWriter:
+    """
+    Write the attendance from a background thread, so a slow disk or a
+    locked database never stalls the camera loop.
+
+    A submitted row is appended to a local journal first and then queued.
+    The writer thread commits the queued rows in small batches and resolves
+    the future of every row with True (written) or False (failed). A failed
+    row stays in the journal and is queued again later, with a growing
+    delay, until it is written. The journal is emptied once everything in
+    it is committed; rows left in it after a crash are written again on the
+    next start. The insert skips a row that is already in the database, so
+    replaying is safe.
+
+    Every process takes the first journal nobody holds a lock on, and
+    writes the rows of the journals of processes that died.
+
+    Raises
+    ------
+    RuntimeError
+        If all MAX_JOURNALS journals are in use
+    """
+
+    def __init__(self, db: FacesDatabase, journal_file: str = JOURNAL_FILE):
+        self.db = db
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # rows appended to the journal and rows committed since it was emptied
+        self.journaled = 0
+        self.committed = 0
+        # timers queueing failed rows again
+        self.retries = set()
+        self.closed = False
+
+        self.journal_file, self.journal = self.open_journal(journal_file)
+        replay = read_rows(self.journal) + self.adopt_journals(journal_file)
+        # written again without a damaged last line, new rows go after it
+        self.rewrite_journal(replay)
+        self.journaled = len(replay)
+        for row in replay:
+            self.queue.put((row, Future(), 0))
+        if replay:
+            logger.warning(f"writing {len(replay)} attendance rows left in the journals")
+
+        self.thread = threading.Thread(target=self.run, name="attendance-writer", daemon=True)
+        self.thread.start()
+
+    ############################################################
+    # take a journal no other process is using
+    ############################################################
+    def open_journal(self, journal_file: str):
+        for slot in range(MAX_JOURNALS):
+            path = journal_path(journal_file, slot)
+            # opened without truncating, another process may be writing it
+            journal = open(path, "a+", encoding="utf-8")
+            if lock_file(journal):
+                logger.debug(f"attendance journal {path}")
+                return path, journal
+            journal.close()
+        raise RuntimeError(f"all {MAX_JOURNALS} attendance journals are in use")
+
+    ############################################################
+    # rows of the journals of processes that died
+    ############################################################
+    def adopt_journals(self, journal_file: str) -> List[dict]:
+        """
+        Move the rows of the unlocked journals into this one. A journal is
+        only emptied once its rows are in the journal of this process.
+        """
+        rows = []
+        for slot in range(MAX_JOURNALS):
+            path = journal_path(journal_file, slot)
+            if path == self.journal_file or not os.path.exists(path):
+                continue
+            with open(path, "r+", encoding="utf-8") as journal:
+                if not lock_file(journal):
+                    continue
+                adopted = read_rows(journal)
+                if adopted:
+                    logger.warning(f"adopting {len(adopted)} attendance rows of {path}")
+                    self.journal.writelines(json.dumps(row) + "\n" for row in adopted)
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                    journal.seek(0)
+                    journal.truncate()
+                    rows.extend(adopted)
+        return rows
+
+    ############################################################
+    # replace the content of the journal
+    ############################################################
+    def rewrite_journal(self, rows: List[dict]):
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.journal.writelines(json.dumps(row) + "\n" for row in rows)
+        self.journal.flush()
+
+    ############################################################
+    # queue the attendance of a student
+    ############################################################
+    def submit(self, face_id: str, filename: str, name: str, course: str) -> Future:
+        """
+        Journal and queue the attendance of the student, marked now.
+
+        Returns
+        -------
+        future : Future
+            Resolves to True once the row is committed, False if it failed
+        """
+        row = {"face_id": face_id, "filename": filename, "name": name, "course": course,
+               "datetime": round(datetime.now().timestamp())}
+        future = Future()
+        with self.lock:
+            # a flushed write survives a crash of the process
+            self.journal.write(json.dumps(row) + "\n")
+            self.journal.flush()
+            self.journaled += 1
+        # later recognitions see the student as marked right away
+        self.db.last_marked[face_id] = row["datetime"]
+        self.queue.put((row, future, 0))
+        return future
+
+    ############################################################
+    # next batch of rows
+    ############################################################
+    def next_batch(self) -> list:
+        """
+        Wait for a row, then collect the rows coming in shortly after it.
+        An empty list means the writer is closed.
+        """
+        item = self.queue.get()
+        if item is None:
+            return []
+        batch = [item]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while len(batch) < BATCH_SIZE:
+            try:
+                item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # finish this batch, close on the next call
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    ############################################################
+    # commit a batch, retrying a locked database
+    ############################################################
+    def write(self, batch: list) -> bool:
+        rows = [(row["face_id"], row["filename"], row["name"], row["course"], row["datetime"])
+                for (row, _, _) in batch]
+        delay = RETRY_DELAY
+        for attempt in range(1, WRITE_RETRIES + 1):
+            if self.db.insert_attendance_batch(rows):
+                return True
+            if attempt < WRITE_RETRIES:
+                logger.warning(f"attendance batch of {len(rows)} not written, retrying in {delay} s")
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    ############################################################
+    # writer thread
+    ############################################################
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                return
+            written = self.write(batch)
+            with self.lock:
+                if written:
+                    self.committed += len(batch)
+                # everything journaled is committed, start an empty journal
+                if self.committed == self.journaled:
+                    self.journal.seek(0)
+                    self.journal.truncate()
+                    self.journaled = self.committed = 0
+            for row, future, attempts in batch:
+                if future is not None and not future.done():
+                    future.set_result(written)
+                if not written:
+                    self.retry(row, attempts + 1)
+            if written:
+                logger.debug(f"attendance batch of {len(batch)} written")
+            else:
+                logger.error(f"attendance batch of {len(batch)} failed, kept in the journal and retried")
+
+    ############################################################
+    # queue a failed row again after a while
+    ############################################################
+    def retry(self, row: dict, attempts: int):
+        """
+        Queue the row again once the delay of its attempt is over. The row
+        is still in the journal, so it is also written on the next start
+        if the process stops first.
+        """
+        delay = min(REQUEUE_DELAY * 2 ** (attempts - 1), MAX_REQUEUE_DELAY)
+
+        def requeue():
+            with self.lock:
+                self.retries.discard(timer)
+                if self.closed:
+                    return
+                self.queue.put((row, None, attempts))
+
+        timer = threading.Timer(delay, requeue)
+        timer.daemon = True
+        with self.lock:
+            if self.closed:
+                return
+            self.retries.add(timer)
+        timer.start()
+
+    ############################################################
+    # write the queued rows and stop
+    ############################################################
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for timer in self.retries:
+                timer.cancel()
+            self.retries.clear()
+        self.queue.put(None)
+        self.thread.join()
+        with self.lock:
+            unwritten = self.journaled - self.committed
+            # closing the file releases the lock of the journal
+            self.journal.close()
+        if unwritten:
+            logger.warning(f"{unwritten} attendance rows not written, they are written on the next start")
@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+import types
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+
+import cv2
+import face_recognition
+import numpy as np
+from loguru import logger
+
+from gallery import ENCODING_SIZE, FaceGallery
+from main import (FaceRecognition, FrameResult, add_detector_arguments, add_gallery_arguments,
+                  detector_from_arguments, gallery_from_arguments, prepare_frame)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+GALLERY_SIZES = "100,1000,10000,100000"
+STARTUP_TIMEOUT = 120  # seconds to wait for the web app to answer
+
+
+class StageTimer:
+    """
+    Collects the latency of the named stages over many frames.
+    """
+
+    def __init__(self):
+        self.samples = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(name, []).append(time.perf_counter() - start)
+
+    ############################################################
+    # latency statistics in milliseconds
+    ############################################################
+    def summary(self) -> dict:
+        summary = {}
+        for name, samples in self.samples.items():
+            values = np.array(samples) * 1000
+            summary[name] = {
+                "count": len(values),
+                "mean_ms": round(float(values.mean()), 3),
+                "p50_ms": round(float(np.percentile(values, 50)), 3),
+                "p95_ms": round(float(np.percentile(values, 95)), 3),
+                "max_ms": round(float(values.max()), 3),
+            }
+        return summary
+
+
+################################################################################
+# peak resident memory of this process
+################################################################################
+def peak_memory_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+################################################################################
+# random encodings with a spread similar to real face encodings
+################################################################################
+def synthetic_encodings(size: int, seed: int = 0) -> np.ndarray:
+    return np.random.default_rng(seed).normal(0.0, 0.1, size=(size, ENCODING_SIZE)).astype(np.float32)
+
+
+################################################################################
+# synthetic gallery
+################################################################################
+def synthetic_gallery(size: int, matcher: str = "exact", nprobe: int = None, seed: int = 0) -> FaceGallery:
+    """
+    Build a gallery of synthetic_encodings and students with fake face ids.
+    """
+    encodings = synthetic_encodings(size, seed)
+    students = [types.SimpleNamespace(id=row, name=f"student-{row}", course="benchmark",
+                                      face_id=f"synthetic-{row}", filename="")
+                for row in range(size)]
+    gallery = FaceGallery(index=matcher) if nprobe is None else FaceGallery(index=matcher, nprobe=nprobe)
+    gallery.load(students, encodings)
+    return gallery
+
+
+################################################################################
+# matching benchmark over synthetic galleries
+################################################################################
+def benchmark_matching(sizes, matchers, faces: int, repeat: int, nprobe: int) -> list:
+    """
+    Time the gallery build and the matching of ``faces`` faces for every
+    gallery size and matcher. All the matchers of a size get the same
+    queries, the recall compares their top-1 with the exact one.
+    """
+    results = []
+    rng = np.random.default_rng(1)
+    for size in sizes:
+        # queries close to enrolled students, like real faces
+        rows = rng.integers(0, size, faces)
+        queries = synthetic_encodings(size)[rows] + rng.normal(0.0, 0.02, (faces, ENCODING_SIZE)).astype(np.float32)
+
+        exact = None
+        for matcher in matchers:
+            start = time.perf_counter()
+            gallery = synthetic_gallery(size, matcher, nprobe)
+            build_time = time.perf_counter() - start
+
+            timer = StageTimer()
+            for _ in range(repeat):
+                with timer.stage("match"):
+                    indices, _ = gallery.match(queries)
+
+            result = {
+                "gallery_size": size,
+                "matcher": matcher,
+                "faces": faces,
+                "build_ms": round(build_time * 1000, 3),
+                "gallery_mb": round(gallery.encodings.nbytes / (1024 * 1024), 2),
+                "stages": timer.summary(),
+                "peak_memory_mb": peak_memory_mb(),
+            }
+            if matcher == "exact":
+                exact = indices[:, 0]
+            elif exact is not None:
+                result["recall"] = float((indices[:, 0] == exact).mean())
+            logger.info(f"{matcher} gallery of {size}: {result['stages']['match']['mean_ms']} ms per match")
+            results.append(result)
+    return results
+
+
+################################################################################
+# frames of a video file or an image folder
+################################################################################
+def read_frames(path: str, limit: int = 0):
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for count, name in enumerate(names):
+            if limit and count >= limit:
+                return
+            frame = cv2.imread(os.path.join(path, name))
+            if frame is not None:
+                yield frame
+        return
+
+    video_capture = cv2.VideoCapture(path)
+    if not video_capture.isOpened():
+        sys.exit(f"Video source not opened... ({path})")
+    count = 0
+    while not limit or count < limit:
+        ret, frame = video_capture.read()
+        if not ret:
+            break
+        count += 1
+        yield frame
+    video_capture.release()
+
+
+################################################################################
+# end to end benchmark over recorded frames
+################################################################################
+def benchmark_video(path: str, recognition: FaceRecognition, limit: int = 0) -> dict:
+    """
+    Run every stage of the recognition on each frame, without displaying
+    anything and without marking the attendance. The motion gate and the
+    tracker are bypassed so every stage is measured on every frame.
+    """
+    detector = recognition.detector
+    state = recognition.state
+    timer = StageTimer()
+    frames = 0
+    faces = 0
+    start = time.perf_counter()
+    for frame in read_frames(path, limit):
+        with timer.stage("frame"):
+            with timer.stage("resize"):
+                rgb_small_frame = prepare_frame(frame, detector.scale)
+            with timer.stage("detect"):
+                face_locations = detector.detect(rgb_small_frame)
+            with timer.stage("encode"):
+                face_encodings = face_recognition.face_encodings(rgb_small_frame, face_locations)
+            with timer.stage("match"):
+                identities = recognition.gallery.identify(face_encodings)
+            students = [student for student, _ in identities]
+            result = FrameResult(face_locations,
+                                 [student.name if student else "Unknown" for student in students],
+                                 students, detector.scale)
+            if result.found_student is not None:
+                with timer.stage("db_check"):
+                    recognition.db.get_time_diff(result.found_student.face_id)
+            with timer.stage("composite"):
+                recognition.render(frame, result, state)
+        frames += 1
+        faces += len(face_locations)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "input": path,
+        "frames": frames,
+        "faces": faces,
+        "fps": round(frames / elapsed, 2) if elapsed > 0 else 0,
+        "detector": detector.name,
+        "scale": detector.scale,
+        "gallery_size": len(recognition.gallery),
+        "matcher": "exact" if recognition.gallery.index is None else "ivf",
+        "stages": timer.summary(),
+        "peak_memory_mb": peak_memory_mb(),
+    }
+
+
+################################################################################
+# import time of every module of a fresh interpreter
+################################################################################
+def import_times(module: str, top: int = 20) -> dict:
+    """
+    Import the module in a new interpreter with ``-X importtime``.
+
+    Returns
+    -------
+    times : dict
+        Total import time and the modules taking the longest (with what
+        they import), in milliseconds
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                             capture_output=True, text=True)
+    modules = []
+    for line in process.stderr.splitlines():
+        # import time: <self us> | <cumulative us> | <nested package>
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].rstrip()
+        modules.append({"module": name.strip(),
+                        "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+                        "self_ms": round(int(parts[0].split(":")[1]) / 1000, 3),
+                        "cumulative_ms": round(int(parts[1]) / 1000, 3)})
+    total = next((entry["cumulative_ms"] for entry in modules if entry["module"] == module and entry["depth"] == 0), 0)
+    return {
+        "module": module,
+        "total_ms": total,
+        "slowest": sorted(modules, key=lambda entry: entry["cumulative_ms"], reverse=True)[:top],
+    }
+
+
+################################################################################
+# time until the web app answers
+################################################################################
+def benchmark_startup(app: str = "api:app", paths=("/", "/attendance/list", "/students/list")) -> dict:
+    """
+    Start the web app with uvicorn on a free port and time the first
+    answer to the home page, then the first and a second answer of every
+    page.
+    """
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    url = f"http://127.0.0.1:{port}"
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", app, "--port", str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        first_response = None
+        while first_response is None:
+            if process.poll() is not None:
+                raise RuntimeError(f"{app} exited with code {process.returncode}")
+            if time.perf_counter() - start > STARTUP_TIMEOUT:
+                raise RuntimeError(f"{app} did not answer in {STARTUP_TIMEOUT} s")
+            try:
+                urllib.request.urlopen(url + paths[0], timeout=1).read()
+                first_response = time.perf_counter() - start
+            except OSError:
+                time.sleep(0.01)
+
+        pages = {}
+        for path in paths:
+            latencies = []
+            for _ in range(2):
+                request_start = time.perf_counter()
+                urllib.request.urlopen(url + path, timeout=STARTUP_TIMEOUT).read()
+                latencies.append(round((time.perf_counter() - request_start) * 1000, 3))
+            pages[path] = {"first_ms": latencies[0], "second_ms": latencies[1]}
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "app": app,
+        "first_response_ms": round(first_response * 1000, 3),
+        "pages": pages,
+        "imports": import_times(app.split(":")[0]),
+    }
+
+
+################################################################################
+# main
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the face recognition")
+    parser.add_argument("--output", help="write the JSON results to this file (default: stdout)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    matching = commands.add_parser("matching", help="matching speed over synthetic galleries")
+    matching.add_argument("--sizes", default=GALLERY_SIZES, help=f"gallery sizes (default: {GALLERY_SIZES})")
+    matching.add_argument("--matchers", default="exact,ivf", help="matchers to compare (default: exact,ivf)")
+    matching.add_argument("--faces", type=int, default=1, help="faces matched at once (default: 1)")
+    matching.add_argument("--repeat", type=int, default=100, help="matches per measurement (default: 100)")
+    matching.add_argument("--nprobe", type=int, default=None, help="IVF lists searched per face")
+
+    video = commands.add_parser("video", help="all stages over a video file or an image folder")
+    video.add_argument("--input", required=True, help="video file or folder of images")
+    video.add_argument("--frames", type=int, default=0, help="stop after this many frames (default: all)")
+    video.add_argument("--gallery-size", type=int, default=0,
+                       help="use a synthetic gallery of this size instead of the enrolled students")
+    add_detector_arguments(video)
+    add_gallery_arguments(video)
+
+    startup = commands.add_parser("startup", help="web app import time per module and time to first response")
+    startup.add_argument("--app", default="api:app", help="uvicorn application (default: api:app)")
+    args = parser.parse_args()
+
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+    }
+    if args.command == "matching":
+        report["matching"] = benchmark_matching([int(size) for size in args.sizes.split(",")],
+                                                args.matchers.split(","), args.faces, args.repeat, args.nprobe)
+    elif args.command == "startup":
+        report["startup"] = benchmark_startup(args.app)
+    else:
+        recognition = FaceRecognition(detector_from_arguments(args), 0, gallery_from_arguments(args),
+                                      write_attendance=False)
+        if args.gallery_size:
+            recognition.gallery = synthetic_gallery(args.gallery_size, args.matcher, args.nprobe)
+        report["video"] = benchmark_video(args.input, recognition, args.frames)
+        recognition.close()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
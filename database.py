@@ -1,11 +1,203 @@
+import functools
+import json
 import sqlite3
 import sys
-from typing import List
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Tuple
+from datetime import datetime, timedelta
 from loguru import logger
+import numpy as np
 import pytz
 
-SELECT_QUERY = "SELECT * FROM faces WHERE face_id = ?;"
+from metrics import histogram
+from tracing import TRACER
+
+# encodings are stored as little-endian float32 blobs, the version tag
+# tells how the blob was written (0 = legacy JSON text column)
+ENCODING_VERSION = 1
+ENCODING_DTYPE = np.dtype("<f4")
+
+TIMEZONE = pytz.timezone('Asia/Kuala_Lumpur')
+ATTENDANCE_PAGE_SIZE = 50
+EXPORT_CHUNK = 5000  # attendance rows fetched at once by an export
+
+DATABASE_FILE = "db/faces.db"
+BUSY_TIMEOUT = 5.0  # seconds to wait for a lock held by another process
+MIGRATION_WAIT = 0.5  # seconds between attempts when another process is migrating
+CACHE_SIZE_KB = 16384  # page cache of every connection
+
+DB_QUERY_SECONDS = histogram("attendance_db_query_seconds", "Time of the FacesDatabase calls", ("method",))
+
+FACE_COLUMNS = "id, name, course, face_id, filename, encoding_blob, encoding_version, datetime"
+SELECT_QUERY = f"SELECT {FACE_COLUMNS} FROM faces WHERE face_id = ?;"
+INSERT_FACE_QUERY = """
+INSERT INTO faces (name, course, face_id, filename, encodings, encoding_blob, encoding_version, datetime)
+values (?, ?, ?, ?, ?, ?, ?, ?);
+"""
+
+
+################################################################################
+# convert face encodings into binary blob
+################################################################################
+def encodings_to_blob(encodings) -> bytes:
+    """
+    Convert face encodings (numpy array or list) into a float32 blob.
+    """
+    return np.asarray(encodings, dtype=ENCODING_DTYPE).tobytes()
+
+
+################################################################################
+# convert binary blob into face encodings
+################################################################################
+def blob_to_encodings(blob, version: int = ENCODING_VERSION) -> np.ndarray:
+    """
+    Convert the stored encodings back into a numpy array.
+
+    Parameters
+    ----------
+    blob : bytes
+        Binary encodings from the encoding_blob column
+    version : int, optional
+        Value of the encoding_version column
+
+    Returns
+    -------
+    encodings : np.ndarray
+        Read-only float32 view over the blob (no copy is made)
+    """
+    if version != ENCODING_VERSION:
+        raise ValueError(f"unknown encoding version: {version}")
+    return np.frombuffer(blob, dtype=ENCODING_DTYPE)
+
+
+################################################################################
+# error of a lock held by another connection
+################################################################################
+def is_busy(error: sqlite3.Error) -> bool:
+    """
+    True for SQLITE_BUSY and its extended codes (SQLITE_BUSY_SNAPSHOT...),
+    which go away once the other connection is done.
+    """
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff == sqlite3.SQLITE_BUSY
+    return "database is locked" in str(error)
+
+
+class ConnectionPool:
+    """
+    SQLite connections shared by the threads of one process.
+
+    The database is opened in WAL mode, so readers never block the writer
+    and the writer never blocks readers. Every thread reading gets its own
+    read-only connection, opened the first time it reads. All writes go
+    through a single connection guarded by a lock, which keeps the
+    transactions of different threads apart. Writers of other processes
+    (the kiosk and the web app) are waited for up to the busy timeout.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE, timeout: float = BUSY_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.write_lock = threading.RLock()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.local = threading.local()
+        self.writer_conn = self.connect()
+        self.writer_conn.execute("PRAGMA journal_mode = WAL")
+
+    ############################################################
+    # open a tuned connection
+    ############################################################
+    def connect(self, read_only: bool = False) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        # WAL is safe against corruption with NORMAL, only the last
+        # commits may be lost on a power failure
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KB}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    ############################################################
+    # read-only connection of the calling thread
+    ############################################################
+    def reader(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.connect(read_only=True)
+            self.local.conn = conn
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn
+
+    ############################################################
+    # exclusive use of the writer connection
+    ############################################################
+    @contextmanager
+    def writer(self):
+        """
+        Hold the writer connection. A transaction left open by a failed
+        write is rolled back when released.
+        """
+        with self.write_lock:
+            try:
+                yield self.writer_conn
+            finally:
+                if self.writer_conn.in_transaction:
+                    self.writer_conn.rollback()
+
+    ############################################################
+    # close all the connections
+    ############################################################
+    def close(self):
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
+        # the connections of other threads are closed now
+        self.local = threading.local()
+        with self.write_lock:
+            self.writer_conn.close()
+
+
+################################################################################
+# time the method into the query metric
+################################################################################
+def measured(method):
+    """
+    Decorator for the FacesDatabase methods, their time is observed in
+    DB_QUERY_SECONDS labelled with the method name, and traced as a span
+    when called in a traced frame.
+    """
+    @functools.wraps(method)
+    def timed_method(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            with TRACER.span(method.__name__, "db"):
+                return method(self, *args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, method=method.__name__)
+    return timed_method
+
+
+################################################################################
+# run the method on the writer connection
+################################################################################
+def writes(method):
+    """
+    Decorator for the FacesDatabase methods writing through ``self.conn``,
+    they hold the writer connection for the whole method. The time includes
+    waiting for the writer.
+    """
+    @functools.wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.pool.writer():
+            return method(self, *args, **kwargs)
+    return measured(locked)
 
 
 class Student:
@@ -20,21 +212,116 @@ class Student:
 
 
 class Attendance:
-    def __init__(self, id: int, face_id: str, filename: str, name: str, course: str, attendance_time: str):
+    def __init__(self, id: int, face_id: str, filename: str, name: str, course: str, attendance_time: str,
+                 timestamp: int = 0):
         self.id = id
         self.name = name
         self.course = course
         self.face_id = face_id
         self.filename = filename
         self.attendance_time = attendance_time
+        self.timestamp = timestamp
+
+
+################################################################################
+# attendance object from a database row
+################################################################################
+def attendance_from_row(row) -> Attendance:
+    (id, fid, filename, name, course, time) = row
+    return Attendance(id, fid, filename, name, course,
+                      datetime.fromtimestamp(time, TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'), time)
+
+
+################################################################################
+# where clause for the attendance filters
+################################################################################
+def attendance_filters(date_from: int = None, date_to: int = None, course: str = "",
+                       face_id: str = "", after: str = "") -> Tuple[str, list]:
+    """
+    Build the parameterized where clause of the attendance list.
+
+    Returns
+    -------
+    (where, params) : tuple
+        The where clause (empty without filters) and its parameters
+    """
+    conditions = []
+    params = []
+    if date_from is not None:
+        conditions.append("datetime >= ?")
+        params.append(date_from)
+    if date_to is not None:
+        conditions.append("datetime <= ?")
+        params.append(date_to)
+    if course:
+        conditions.append("course = ?")
+        params.append(course)
+    if face_id:
+        conditions.append("face_id = ?")
+        params.append(face_id)
+    if after:
+        # keyset cursor "<datetime>-<id>" of the last row of the previous page
+        (time, id) = (int(value) for value in after.split("-"))
+        conditions.append("(datetime, id) < (?, ?)")
+        params.extend([time, id])
+
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    return where, params
+
+
+################################################################################
+# YYYY-MM-DD into unix time
+################################################################################
+def parse_date(value: str, end_of_day: bool = False):
+    """
+    Convert a local date into unix time, the end of the day is the last
+    second of that day. Empty values are None.
+    """
+    if not value:
+        return None
+    day = datetime.strptime(value, "%Y-%m-%d")
+    if end_of_day:
+        day += timedelta(days=1)
+    timestamp = int(TIMEZONE.localize(day).timestamp())
+    return timestamp - 1 if end_of_day else timestamp
+
+
+################################################################################
+# where clause for the rollup filters
+################################################################################
+def rollup_filters(date_from: str = "", date_to: str = "", course: str = "") -> Tuple[str, list]:
+    """
+    Build the parameterized where clause of the rollup tables, the days
+    are YYYY-MM-DD strings which compare in date order.
+    """
+    conditions = []
+    params = []
+    if date_from:
+        conditions.append("day >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("day <= ?")
+        params.append(date_to)
+    if course:
+        conditions.append("course = ?")
+        params.append(course)
+
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    return where, params
 
 
 class FacesDatabase:
     """
     A class to represent a faces database.
     """
+    pool: ConnectionPool
+    # the writer connection of the pool
     conn: sqlite3.Connection
     db_open: bool = False
+    # face id -> unix time of the last attendance known to this process
+    last_marked: dict
+    # attendance deletions counted when last_marked was valid
+    last_marked_deletions: int
 
     ############################################################################
     # constructor
@@ -44,8 +331,11 @@ class FacesDatabase:
         """
         Constructs the faces database object.
         """
+        self.last_marked = {}
+        self.last_marked_deletions = None
         self.open_db()
         self.create_tables()
+        self.migrate_schema()
 
     ############################################################################
     # print error message
@@ -88,7 +378,8 @@ class FacesDatabase:
         Open database with given database file.
         """
         try:
-            self.conn = sqlite3.connect("db/faces.db")
+            self.pool = ConnectionPool()
+            self.conn = self.pool.writer_conn
             self.db_open = True
             logger.success("Opened database successfully.")
         except sqlite3.OperationalError as e:
@@ -104,9 +395,15 @@ class FacesDatabase:
         Close the database.
         """
         logger.info("closing database connnection...")
-        self.conn.close()
+        self.pool.close()
         self.db_open = False
 
+    ############################################################################
+    # read-only connection of the calling thread
+    ############################################################################
+    def reader(self) -> sqlite3.Connection:
+        return self.pool.reader()
+
     ############################################################################
     # check the table exists or not
     ############################################################################
@@ -135,6 +432,273 @@ class FacesDatabase:
         self.create_table_if_not_exists(faces_table_ddl)
         self.create_table_if_not_exists(attendance_table_ddl)
 
+    ############################################################################
+    # bring the schema up to date
+    ############################################################################
+    def migrate_schema(self):
+        """
+        Run the pending schema migrations. The number of applied migrations
+        is kept in the SQLite user_version pragma, so each one runs once.
+        Every migration runs in an immediate transaction which reads the
+        version again, so processes starting together on the same database
+        wait for each other instead of applying a migration twice.
+        """
+        migrations = [
+            self.migrate_binary_encodings,
+            self.migrate_faces_revision,
+            self.migrate_faces_changes,
+            self.migrate_attendance_datetime_index,
+            self.migrate_attendance_face_index,
+            self.migrate_attendance_rollups,
+            self.migrate_attendance_deletions,
+        ]
+        while self.conn.execute("PRAGMA user_version").fetchone()[0] < len(migrations):
+            try:
+                # take the write lock before reading the version, several
+                # processes starting together apply every migration once
+                self.conn.execute("BEGIN IMMEDIATE")
+                version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                if version < len(migrations):
+                    logger.info(f"migrating database schema to version {version + 1}...")
+                    migrations[version]()
+                    self.conn.execute(f"PRAGMA user_version = {version + 1}")
+                self.conn.commit()
+            except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+                if self.conn.in_transaction:
+                    self.conn.rollback()
+                if is_busy(e):
+                    # another process holds the lock longer than the busy timeout
+                    logger.warning(f"database locked while migrating, trying again in {MIGRATION_WAIT} s")
+                    time.sleep(MIGRATION_WAIT)
+                    continue
+                self.print_error(e)
+                self.close_db()
+                logger.error("exiting...")
+                sys.exit()
+
+    ############################################################################
+    # migration 1: JSON text encodings into float32 blobs
+    ############################################################################
+    def migrate_binary_encodings(self):
+        """
+        Add the binary encoding columns and convert the existing JSON rows.
+        The JSON text is cleared afterwards to give the space back.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("ALTER TABLE faces ADD COLUMN encoding_blob BLOB")
+        cursor.execute("ALTER TABLE faces ADD COLUMN encoding_version INTEGER not null DEFAULT 0")
+
+        cursor.execute("SELECT id, encodings FROM faces WHERE encoding_version = 0")
+        rows = [(encodings_to_blob(json.loads(encodings)), ENCODING_VERSION, id)
+                for (id, encodings) in cursor.fetchall()]
+        cursor.executemany(
+            "UPDATE faces SET encoding_blob = ?, encoding_version = ?, encodings = '' WHERE id = ?",
+            rows)
+        cursor.close()
+        logger.success(f"converted {len(rows)} face encodings into binary format.")
+
+    ############################################################################
+    # migration 2: revision counter for the faces table
+    ############################################################################
+    def migrate_faces_revision(self):
+        """
+        Keep a revision number that is bumped by triggers on every change of
+        the faces table, so readers can tell if their copy is stale.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS faces_meta (
+            name TEXT PRIMARY KEY,
+            value INTEGER not null
+        );
+        """)
+        cursor.execute("INSERT OR IGNORE INTO faces_meta (name, value) values ('revision', 0)")
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS faces_revision_{event.lower()} AFTER {event} ON faces
+            BEGIN
+                UPDATE faces_meta SET value = value + 1 WHERE name = 'revision';
+            END;
+            """)
+        cursor.close()
+
+    ############################################################################
+    # migration 3: change feed of the faces table
+    ############################################################################
+    def migrate_faces_changes(self):
+        """
+        Log every change of the faces table with its revision, so a running
+        recognizer can fetch only the changes since the revision it has.
+        An update is logged as a delete of the old row and an insert of the
+        new one.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS faces_changes (
+            revision INTEGER PRIMARY KEY,
+            operation TEXT not null,
+            face_id TEXT not null
+        );
+        """)
+        bump_revision = "UPDATE faces_meta SET value = value + 1 WHERE name = 'revision';"
+        log_change = ("INSERT INTO faces_changes (revision, operation, face_id) "
+                      "SELECT value, '{operation}', {row}.face_id FROM faces_meta WHERE name = 'revision';")
+        triggers = {
+            "INSERT": [("insert", "NEW")],
+            "UPDATE": [("delete", "OLD"), ("insert", "NEW")],
+            "DELETE": [("delete", "OLD")],
+        }
+        for event, changes in triggers.items():
+            body = "".join(bump_revision + log_change.format(operation=operation, row=row)
+                           for (operation, row) in changes)
+            cursor.execute(f"DROP TRIGGER IF EXISTS faces_revision_{event.lower()}")
+            cursor.execute(f"""
+            CREATE TRIGGER faces_revision_{event.lower()} AFTER {event} ON faces
+            BEGIN
+                {body}
+            END;
+            """)
+        cursor.close()
+
+    ############################################################################
+    # migration 4: index for the attendance listing order
+    ############################################################################
+    def migrate_attendance_datetime_index(self):
+        """
+        Index the attendance list in listing order, so a page is read
+        straight from the index instead of sorting the whole table.
+        """
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_list_datetime_id ON attendance_list (datetime, id)")
+
+    ############################################################################
+    # migration 5: index for the last attendance of a student
+    ############################################################################
+    def migrate_attendance_face_index(self):
+        """
+        Index the attendance by student and time, the last attendance of a
+        student is then a single index lookup.
+        """
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS attendance_list_face_id_datetime ON attendance_list (face_id, datetime)")
+
+    ############################################################################
+    # migration 6: daily attendance rollups
+    ############################################################################
+    def migrate_attendance_rollups(self):
+        """
+        Keep the attendance counted per day, course and student, and per day
+        and course, so the reports read a few rows per day instead of the
+        whole attendance list. Triggers on the attendance list update the
+        rollups in the transaction of every insert and delete. The day is
+        the local date of TIMEZONE, which has no daylight saving time.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_daily (
+            day TEXT not null,
+            course TEXT not null,
+            face_id TEXT not null,
+            name TEXT not null,
+            marks INTEGER not null,
+            first_time INTEGER not null,
+            last_time INTEGER not null,
+            PRIMARY KEY (day, course, face_id)
+        ) WITHOUT ROWID;
+        """)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS attendance_course_daily (
+            day TEXT not null,
+            course TEXT not null,
+            students INTEGER not null,
+            marks INTEGER not null,
+            PRIMARY KEY (day, course)
+        ) WITHOUT ROWID;
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS attendance_daily_course_day ON attendance_daily (course, day)")
+
+        offset = int(TIMEZONE.utcoffset(datetime.now()).total_seconds())
+        day = "date({row}.datetime + %d, 'unixepoch')" % offset
+        # unix time range of the local day of the row
+        day_start = "(CAST(strftime('%%s', {day}) AS INTEGER) - %d)" % offset
+        new_day = day.format(row="NEW")
+        old_day = day.format(row="OLD")
+        old_start = day_start.format(day=old_day)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS attendance_rollup_insert AFTER INSERT ON attendance_list
+        BEGIN
+            INSERT INTO attendance_course_daily (day, course, students, marks)
+            SELECT {new_day}, NEW.course,
+                   NOT EXISTS (SELECT 1 FROM attendance_daily
+                               WHERE day = {new_day} AND course = NEW.course AND face_id = NEW.face_id), 1
+            ON CONFLICT (day, course) DO UPDATE SET students = students + excluded.students, marks = marks + 1;
+            INSERT INTO attendance_daily (day, course, face_id, name, marks, first_time, last_time)
+            values ({new_day}, NEW.course, NEW.face_id, NEW.name, 1, NEW.datetime, NEW.datetime)
+            ON CONFLICT (day, course, face_id) DO UPDATE SET
+                name = excluded.name,
+                marks = marks + 1,
+                first_time = MIN(first_time, excluded.first_time),
+                last_time = MAX(last_time, excluded.last_time);
+        END;
+        """)
+        cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS attendance_rollup_delete AFTER DELETE ON attendance_list
+        BEGIN
+            UPDATE attendance_daily SET
+                marks = marks - 1,
+                first_time = COALESCE((SELECT MIN(datetime) FROM attendance_list
+                                       WHERE face_id = OLD.face_id AND course = OLD.course
+                                       AND datetime BETWEEN {old_start} AND {old_start} + 86399), 0),
+                last_time = COALESCE((SELECT MAX(datetime) FROM attendance_list
+                                      WHERE face_id = OLD.face_id AND course = OLD.course
+                                      AND datetime BETWEEN {old_start} AND {old_start} + 86399), 0)
+            WHERE day = {old_day} AND course = OLD.course AND face_id = OLD.face_id;
+            UPDATE attendance_course_daily SET
+                marks = marks - 1,
+                students = students - EXISTS (SELECT 1 FROM attendance_daily
+                                              WHERE day = {old_day} AND course = OLD.course
+                                              AND face_id = OLD.face_id AND marks = 0)
+            WHERE day = {old_day} AND course = OLD.course;
+            DELETE FROM attendance_daily
+            WHERE day = {old_day} AND course = OLD.course AND face_id = OLD.face_id AND marks <= 0;
+            DELETE FROM attendance_course_daily WHERE day = {old_day} AND course = OLD.course AND marks <= 0;
+        END;
+        """)
+
+        # the attendance marked so far
+        row_day = day.format(row="a")
+        cursor.execute(f"""
+        INSERT INTO attendance_daily (day, course, face_id, name, marks, first_time, last_time)
+        SELECT {row_day}, a.course, a.face_id, MAX(a.name), COUNT(*), MIN(a.datetime), MAX(a.datetime)
+        FROM attendance_list a
+        GROUP BY 1, a.course, a.face_id
+        """)
+        cursor.execute("""
+        INSERT INTO attendance_course_daily (day, course, students, marks)
+        SELECT day, course, COUNT(*), SUM(marks) FROM attendance_daily GROUP BY day, course
+        """)
+        logger.success(f"counted the attendance of {cursor.rowcount} course days.")
+        cursor.close()
+
+    ############################################################################
+    # migration 7: revision counter of the attendance deletions
+    ############################################################################
+    def migrate_attendance_deletions(self):
+        """
+        Count the deleted attendance rows, so a process caching the last
+        attendance of the students can tell that another process (the web
+        app) has deleted some.
+        """
+        cursor = self.conn.cursor()
+        cursor.execute("INSERT OR IGNORE INTO faces_meta (name, value) values ('attendance_deletions', 0)")
+        cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS attendance_deletions AFTER DELETE ON attendance_list
+        BEGIN
+            UPDATE faces_meta SET value = value + 1 WHERE name = 'attendance_deletions';
+        END;
+        """)
+        cursor.close()
+
     ############################################################################
     # create table for given DDL
     ############################################################################
@@ -157,9 +721,10 @@ class FacesDatabase:
     ############################################################################
     # get all faces
     ############################################################################
+    @measured
     def get_all_faces(self) -> List[Student]:
-        cursor = self.conn.cursor()
-        cursor.execute(f"SELECT * FROM faces")
+        cursor = self.reader().cursor()
+        cursor.execute(f"SELECT {FACE_COLUMNS} FROM faces")
 
         students = []
         # Fetch all rows
@@ -169,8 +734,8 @@ class FacesDatabase:
                               row[2],  # course
                               row[3],  # face id
                               row[4],  # image file name
-                              row[5],  # encodings
-                              datetime.fromtimestamp(row[6])  # join date
+                              blob_to_encodings(row[5], row[6]),  # encodings
+                              datetime.fromtimestamp(row[7])  # join date
                               )
             students.append(student)
 
@@ -178,6 +743,63 @@ class FacesDatabase:
         cursor.close()
         return students
 
+    ############################################################################
+    # current revision of the faces table
+    ############################################################################
+    @measured
+    def get_faces_revision(self) -> int:
+        """
+        Revision of the faces table, it changes whenever a face is inserted,
+        updated or deleted.
+        """
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute("SELECT value FROM faces_meta WHERE name = 'revision'")
+            result = cursor.fetchone()
+            cursor.close()
+            return result[0] if result else 0
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return -1
+
+    ############################################################################
+    # changes of the faces table since given revision
+    ############################################################################
+    @measured
+    def get_face_changes(self, revision: int) -> List[tuple]:
+        """
+        Changes of the faces table after the given revision, oldest first.
+
+        Returns
+        -------
+        changes : list
+            (revision, operation, face_id, student) tuples, where operation
+            is "insert" or "delete". The student is None for deletes and for
+            inserted rows which are already deleted again.
+        """
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute("""
+            SELECT c.revision, c.operation, c.face_id,
+                   f.id, f.name, f.course, f.face_id, f.filename, f.encoding_blob, f.encoding_version, f.datetime
+            FROM faces_changes c LEFT JOIN faces f ON f.face_id = c.face_id
+            WHERE c.revision > ?
+            ORDER BY c.revision
+            """, (revision,))
+            changes = []
+            for (rev, operation, face_id, id, name, course, fid, filename, blob, version, time) in cursor.fetchall():
+                student = None
+                if operation == "insert" and id is not None:
+                    student = Student(id, name, course, fid, filename,
+                                      blob_to_encodings(blob, version),
+                                      datetime.fromtimestamp(time))
+                changes.append((rev, operation, face_id, student))
+            cursor.close()
+            return changes
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return []
+
     ############################################################################
     # insert face/student details
     ############################################################################
@@ -194,9 +816,11 @@ class FacesDatabase:
     ############################################################################
     # insert face/student details
     ############################################################################
-    def insert_face_details(self, name: str, course: str, face_id: str, filename: str, encodings: str) -> str:
+    @writes
+    def insert_face_details(self, name: str, course: str, face_id: str, filename: str, encodings) -> str:
         """
-        Insert face details into face table.
+        Insert face details into face table. The encodings (numpy array or
+        list of 128 floats) are stored as a float32 blob.
 
         Return:
         -------
@@ -207,14 +831,11 @@ class FacesDatabase:
         cursor = self.conn.cursor()
         timestamp = datetime.now().timestamp()
 
-        data = (name, course, face_id, filename, encodings, round(timestamp))
-        logger.debug(f"Insert Data: {data}")
-        insert_query = """
-        INSERT INTO faces (name, course, face_id, filename, encodings, datetime) 
-        values (?, ?, ?, ?, ?, ?);
-        """
+        data = (name, course, face_id, filename, "", encodings_to_blob(encodings), ENCODING_VERSION,
+                round(timestamp))
+        logger.debug(f"Insert Data: {data[:4]}")
         try:
-            cursor.execute(insert_query, data)
+            cursor.execute(INSERT_FACE_QUERY, data)
             cursor.close()
             self.conn.commit()
             return str(face_id)
@@ -222,9 +843,45 @@ class FacesDatabase:
             self.print_error(e)
             return ""
 
+    ############################################################################
+    # insert many faces/students at once
+    ############################################################################
+    @writes
+    def insert_many_faces(self, faces: list) -> int:
+        """
+        Insert many students in a single transaction, either all of them are
+        inserted or none.
+
+        Parameters
+        ----------
+        faces : list
+            (name, course, face_id, filename, encodings) tuples
+
+        Returns
+        -------
+        count : int
+            Number of inserted students, 0 on error
+        """
+        if not faces:
+            return 0
+        logger.debug(f"inserting {len(faces)} rows into face table...")
+        timestamp = round(datetime.now().timestamp())
+        data = [(name, course, face_id, filename, "", encodings_to_blob(encodings), ENCODING_VERSION, timestamp)
+                for (name, course, face_id, filename, encodings) in faces]
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany(INSERT_FACE_QUERY, data)
+            cursor.close()
+            self.conn.commit()
+            return len(data)
+        except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+            self.print_error(e)
+            return 0
+
     ############################################################################
     # insert attenance details
     ############################################################################
+    @writes
     def insert_attenance_details(self, face_id: str, filename: str, name: str, course: str) -> str:
         logger.debug("inserting data into face table...")
         cursor = self.conn.cursor()
@@ -238,17 +895,57 @@ class FacesDatabase:
             cursor.execute(insert_query, data)
             cursor.close()
             self.conn.commit()
+            self.last_marked[face_id] = data[-1]
             return str(face_id)
         except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
             self.print_error(e)
             return ""
 
+    ############################################################################
+    # insert many attendance rows at once
+    ############################################################################
+    @writes
+    def insert_attendance_batch(self, rows: list) -> bool:
+        """
+        Insert attendance rows in a single transaction. A row already in the
+        table (same student and time) is skipped, so a batch can be written
+        again after a crash.
+
+        Parameters
+        ----------
+        rows : list
+            (face_id, filename, name, course, datetime) tuples
+
+        Returns
+        -------
+        written : bool
+            True if the transaction was committed
+        """
+        insert_query = """
+        INSERT INTO attendance_list (face_id, filename, name, course, datetime)
+        SELECT ?1, ?2, ?3, ?4, ?5
+        WHERE NOT EXISTS (SELECT 1 FROM attendance_list WHERE face_id = ?1 AND datetime = ?5)
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.executemany(insert_query, rows)
+            cursor.close()
+            self.conn.commit()
+            for (face_id, _, _, _, timestamp) in rows:
+                if timestamp > self.last_marked.get(face_id, 0):
+                    self.last_marked[face_id] = timestamp
+            return True
+        except (sqlite3.OperationalError, sqlite3.IntegrityError) as e:
+            self.print_error(e)
+            return False
+
     ############################################################################
     # search student by ID
     ############################################################################
+    @measured
     def search_by_id(self, face_id: str) -> bool:
         # Create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
 
         # Execute the SQL query with the parameter
         try:
@@ -258,7 +955,7 @@ class FacesDatabase:
             result = cursor.fetchone()
             cursor.close()
             if result:
-                (id, name, course, fid, filename, encodings, time) = result
+                (id, name, course, fid, filename, blob, version, time) = result
                 # logger.debug("Result:", result)
                 if fid == face_id:
                     return True
@@ -274,28 +971,96 @@ class FacesDatabase:
     ############################################################################
     # get the time difference in seconds from last login
     ############################################################################
-    def get_time_diff(self, face_id: str) -> int:
-        # Create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+    def get_time_diff(self, face_id: str, max_age: int = None) -> int:
+        """
+        Seconds since the last attendance of the student, 0 if there is none.
 
-        # Execute the SQL query with the parameter
+        Parameters
+        ----------
+        face_id : str
+            Face id of the student
+        max_age : int, optional
+            If the cached last attendance is at most this old, it is returned
+            without the MAX query. The cache misses attendance written by other
+            processes, which can only make the real difference smaller, and is
+            dropped when any process has deleted attendance since it was filled.
+        """
+        now = round(datetime.now().timestamp())
+        last = self.last_marked.get(face_id)
+        if last is not None and max_age is not None and now - last <= max_age and self.last_marked_valid():
+            return now - last
+
+        last = self.get_last_attendance_time(face_id)
+        if last is None:
+            return 0
+        return now - last
+
+    ############################################################################
+    # time of the last attendance of a student
+    ############################################################################
+    @measured
+    def get_last_attendance_time(self, face_id: str) -> int:
+        """
+        Unix time of the last attendance of the student, None if there is
+        none. MAX over the (face_id, datetime) index is a single lookup.
+        """
+        cursor = self.reader().cursor()
         try:
-            cursor.execute(
-                """
-                SELECT 
-                    (unixepoch()-datetime) as timediff
-                FROM attendance_list 
-                    WHERE face_id = ? 
-                ORDER BY 1 ASC LIMIT 1;""",
-                (face_id,))
-            # Fetch the result (one row in this case)
+            cursor.execute("SELECT MAX(datetime) FROM attendance_list WHERE face_id = ?", (face_id,))
+            (last,) = cursor.fetchone()
+            cursor.close()
+            if last is not None:
+                self.last_marked[face_id] = last
+            return last
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return None
+
+    ############################################################################
+    # check the last attendance cache against the deletions
+    ############################################################################
+    def last_marked_valid(self) -> bool:
+        """
+        False, and the cache is emptied, if attendance has been deleted since
+        the cache was filled. A single row lookup.
+        """
+        deletions = self.get_attendance_deletions()
+        if deletions is not None and deletions == self.last_marked_deletions:
+            return True
+        self.last_marked.clear()
+        self.last_marked_deletions = deletions
+        return False
+
+    ############################################################################
+    # number of attendance rows ever deleted
+    ############################################################################
+    def get_attendance_deletions(self) -> int:
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute("SELECT value FROM faces_meta WHERE name = 'attendance_deletions'")
             result = cursor.fetchone()
             cursor.close()
-            if result:
-                (timediff,) = result
-                return timediff
-            else:
-                return 0
+            return result[0] if result else 0
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return None
+
+    ############################################################################
+    # fill the last attendance cache
+    ############################################################################
+    @measured
+    def warm_last_marked(self):
+        """
+        Load the last attendance time of every student into the cache.
+        """
+        # counted first, a deletion during the load empties the cache again
+        self.last_marked_deletions = self.get_attendance_deletions()
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute("SELECT face_id, MAX(datetime) FROM attendance_list GROUP BY face_id")
+            self.last_marked = dict(cursor.fetchall())
+            cursor.close()
+            logger.debug(f"Last attendance cached for {len(self.last_marked)} students")
         except sqlite3.OperationalError as e:
             self.print_error(e)
 
@@ -303,9 +1068,10 @@ class FacesDatabase:
     # find name using face id
     ############################################################################
 
+    @measured
     def find_name_by_face_id(self, face_id: str) -> str:
         # create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         # execute the SQL query with the parameter
         try:
             cursor.execute(SELECT_QUERY, (face_id,))
@@ -313,7 +1079,7 @@ class FacesDatabase:
             # fetch the result (one row in this case)
             result = cursor.fetchone()
             if result:
-                (id, name, course, fid, filename, encodings, time) = result
+                (id, name, course, fid, filename, blob, version, time) = result
                 # logger.debug("Result:", result)
                 return name
             else:
@@ -326,41 +1092,196 @@ class FacesDatabase:
     ############################################################################
     # get all attendance from database and with where clause of face id
     ############################################################################
+    @measured
     def get_attendance(self, student_face_id: str) -> List[Attendance]:
-        tz = pytz.timezone('Asia/Kuala_Lumpur')
         # create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         # define the SQL query to retrieve rows based on a parameter
-        select_query = '''SELECT id, face_id, filename, name, course, datetime 
-                          FROM attendance_list order by datetime desc'''
-        if len(student_face_id) > 0:
-            logger.debug("adding where clause...")
-            select_query = select_query + ' where face_id = \'' + student_face_id + '\''
-            logger.debug("SQL Query: " + select_query)
+        where, params = attendance_filters(face_id=student_face_id)
+        select_query = f'''SELECT id, face_id, filename, name, course, datetime 
+                          FROM attendance_list {where} order by datetime desc, id desc'''
         attendance_list = []
         # execute the SQL query with the parameter
         try:
-            cursor.execute(select_query,)
+            cursor.execute(select_query, params)
             for row in cursor.fetchall():
-                (id, fid, filename, name, course, time) = row
-                attd = Attendance(id, fid, filename, name, course,
-                                  datetime.fromtimestamp(time, tz).strftime('%Y-%m-%d %H:%M:%S'))
-                attendance_list.append(attd)
+                attendance_list.append(attendance_from_row(row))
                 # logger.debug("Result:", result)
         except sqlite3.OperationalError as e:
             self.print_error(e)
         return attendance_list
 
+    ############################################################################
+    # one page of the attendance list, newest first
+    ############################################################################
+    @measured
+    def get_attendance_page(self, after: str = "", limit: int = ATTENDANCE_PAGE_SIZE,
+                            date_from: int = None, date_to: int = None,
+                            course: str = "", face_id: str = "") -> Tuple[List[Attendance], str]:
+        """
+        Get one page of the attendance list with keyset pagination.
+
+        Parameters
+        ----------
+        after : str, optional
+            Cursor returned with the previous page, empty for the first page
+        limit : int, optional
+            Number of rows in the page
+        date_from, date_to : int, optional
+            Unix time range of the attendance (both inclusive)
+        course, face_id : str, optional
+            Only the attendance of this course / student
+
+        Returns
+        -------
+        (attendance_list, cursor) : tuple
+            The rows and the cursor of the next page, empty on the last page
+        """
+        where, params = attendance_filters(date_from, date_to, course, face_id, after)
+        select_query = f'''SELECT id, face_id, filename, name, course, datetime
+                          FROM attendance_list {where}
+                          ORDER BY datetime DESC, id DESC LIMIT ?'''
+        cursor = self.reader().cursor()
+        attendance_list = []
+        try:
+            # one row more tells if there is a next page
+            cursor.execute(select_query, params + [limit + 1])
+            attendance_list = [attendance_from_row(row) for row in cursor.fetchall()]
+            cursor.close()
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+
+        next_cursor = ""
+        if len(attendance_list) > limit:
+            attendance_list = attendance_list[:limit]
+            last = attendance_list[-1]
+            next_cursor = f"{last.timestamp}-{last.id}"
+        return attendance_list, next_cursor
+
+    ############################################################################
+    # all the matching attendance, a chunk at a time
+    ############################################################################
+    def iter_attendance(self, date_from: int = None, date_to: int = None, course: str = "",
+                        face_id: str = "", chunk_size: int = EXPORT_CHUNK) -> Iterator[list]:
+        """
+        Read the attendance list oldest first in chunks of raw rows, so an
+        export of any size holds one chunk in memory.
+
+        The rows are read on a connection of their own, which sees the
+        table as it was when the export started and may be used from
+        whichever thread pulls the next chunk.
+
+        Yields
+        ------
+        rows : list
+            Up to chunk_size (id, face_id, filename, name, course, datetime)
+            tuples
+
+        Raises
+        ------
+        sqlite3.OperationalError
+            If the rows can not be read, so a streamed export is cut short
+            instead of ending as if it were complete
+        """
+        where, params = attendance_filters(date_from, date_to, course, face_id)
+        conn = self.pool.connect(read_only=True)
+        try:
+            cursor = conn.cursor()
+            # a single read transaction for a consistent export
+            conn.execute("BEGIN")
+            cursor.execute(f'''SELECT id, face_id, filename, name, course, datetime
+                               FROM attendance_list {where}
+                               ORDER BY datetime, id''', params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield rows
+            cursor.close()
+        except sqlite3.OperationalError as e:
+            # the export is being sent, it has to fail rather than look complete
+            self.print_error(e)
+            raise
+        finally:
+            conn.close()
+
+    ############################################################################
+    # courses of the registered students
+    ############################################################################
+    @measured
+    def get_courses(self) -> List[str]:
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute("SELECT DISTINCT course FROM faces ORDER BY course")
+            courses = [course for (course,) in cursor.fetchall()]
+            cursor.close()
+            return courses
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return []
+
+    ############################################################################
+    # attendance counted per day and course
+    ############################################################################
+    @measured
+    def get_daily_report(self, date_from: str = "", date_to: str = "", course: str = "") -> List[dict]:
+        """
+        Number of students and marks per day and course, newest day first,
+        read from the attendance_course_daily rollup.
+
+        Parameters
+        ----------
+        date_from, date_to : str, optional
+            Local days as YYYY-MM-DD (both inclusive)
+        course : str, optional
+            Only this course
+        """
+        where, params = rollup_filters(date_from, date_to, course)
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute(f"""SELECT day, course, students, marks FROM attendance_course_daily {where}
+                              ORDER BY day DESC, course""", params)
+            report = [{"day": day, "course": course, "students": students, "marks": marks}
+                      for (day, course, students, marks) in cursor.fetchall()]
+            cursor.close()
+            return report
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return []
+
+    ############################################################################
+    # attendance of every student of a course over some days
+    ############################################################################
+    @measured
+    def get_course_report(self, course: str, date_from: str = "", date_to: str = "") -> List[dict]:
+        """
+        Who attended the course between the days, with the number of days
+        attended, marks and first and last attendance (unix time) of every
+        student, read from the attendance_daily rollup.
+        """
+        where, params = rollup_filters(date_from, date_to, course)
+        cursor = self.reader().cursor()
+        try:
+            cursor.execute(f"""SELECT face_id, MAX(name), COUNT(*), SUM(marks), MIN(first_time), MAX(last_time)
+                              FROM attendance_daily {where}
+                              GROUP BY face_id ORDER BY 2""", params)
+            report = [{"face_id": face_id, "name": name, "days": days, "marks": marks,
+                       "first_time": first_time, "last_time": last_time}
+                      for (face_id, name, days, marks, first_time, last_time) in cursor.fetchall()]
+            cursor.close()
+            return report
+        except sqlite3.OperationalError as e:
+            self.print_error(e)
+            return []
+
     ############################################################################
     # get all names from database
     ############################################################################
+    @measured
     def get_actual_names(self, face_ids: list) -> list:
         # create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
 
         # define the SQL query to retrieve rows based on a parameter
         select_query = '''
-        SELECT * FROM faces
+        SELECT face_id, name FROM faces
         '''
 
         name_dict = {}
@@ -368,7 +1289,7 @@ class FacesDatabase:
         try:
             cursor.execute(select_query,)
             for row in cursor.fetchall():
-                (id, name, course, fid, filename, encodings, time) = row
+                (fid, name) = row
                 name_dict[fid] = name
                 # logger.debug("Result:", result)
         except sqlite3.OperationalError as e:
@@ -384,9 +1305,10 @@ class FacesDatabase:
     ############################################################################
     # get encoding for given face/student id
     ############################################################################
-    def get_encodings(self, face_id: str) -> str:
+    @measured
+    def get_encodings(self, face_id: str) -> np.ndarray:
         # create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         # execute the SQL query with the parameter
         try:
             cursor.execute(SELECT_QUERY, (face_id,))
@@ -394,21 +1316,22 @@ class FacesDatabase:
             # fetch the result (one row in this case)
             result = cursor.fetchone()
             if result:
-                (id, name, course, fid, filename, encodings, time) = result
+                (id, name, course, fid, filename, blob, version, time) = result
                 # logger.debug("Result:", result)
-                return encodings
+                return blob_to_encodings(blob, version)
             else:
                 logger.error("Error: No encoding found.")
-                return ""
+                return None
         except sqlite3.OperationalError as e:
             self.print_error(e)
 
     ############################################################################
     # get student details based on id
     ############################################################################
+    @measured
     def get_student_details(self, face_id: str) -> Student:
         # create a cursor object to interact with the database
-        cursor = self.conn.cursor()
+        cursor = self.reader().cursor()
         # execute the SQL query with the parameter
         try:
             cursor.execute(SELECT_QUERY, (face_id,))
@@ -417,13 +1340,13 @@ class FacesDatabase:
             result = cursor.fetchone()
             cursor.close()
             if result:
-                (id, name, course, fid, filename, encodings, time) = result
+                (id, name, course, fid, filename, blob, version, time) = result
                 student = Student(id,
                                   name,
                                   course,
                                   fid,
                                   filename,
-                                  encodings,
+                                  blob_to_encodings(blob, version),
                                   time)
                 # logger.debug("Result:", result)
                 return student
@@ -436,6 +1359,7 @@ class FacesDatabase:
     ############################################################################
     # delete row by face id
     ############################################################################
+    @writes
     def delete_face_details(self, face_id: str) -> bool:
         # Create a cursor object to interact with the database
         cursor = self.conn.cursor()
@@ -472,6 +1396,7 @@ class FacesDatabase:
     # delete row by id in attendance list
     ############################################################################
 
+    @writes
     def delete_attendance_details(self, id: int) -> bool:
         # Create a cursor object to interact with the database
         cursor = self.conn.cursor()
@@ -482,6 +1407,8 @@ class FacesDatabase:
             cursor.execute(delete_query, (id,))
             # Commit the changes
             self.conn.commit()
+            # the cached last attendance may be the deleted one
+            self.last_marked.clear()
             # Display the number of rows affected
             logger.debug(f"Rows affected: {cursor.rowcount}")
             if cursor.rowcount == 1:
@@ -0,0 +1,191 @@
+import os
+from typing import Optional, Tuple
+
+import cv2
+import face_recognition
+import numpy as np
+from loguru import logger
+
+DETECTION_SCALE = 0.25  # frames are shrunk to a quarter before detection
+MOTION_THRESHOLD = 2.0  # mean pixel change (0-255) that counts as motion
+MODELS_FOLDER = "assets/models"
+
+# (backend, model files) -> model loaded in this process
+_models = {}
+
+
+################################################################################
+# model of a backend, loaded once per process
+################################################################################
+def cached_model(key: tuple, load):
+    """
+    The detector is pickled without its model into the recognition pool
+    with every frame, the worker processes keep the loaded models here.
+    """
+    model = _models.get(key)
+    if model is None:
+        model = _models[key] = load()
+        logger.debug(f"{key[0]} face detector model loaded in process {os.getpid()}")
+    return model
+
+
+class FaceDetector:
+    """
+    Base class of the face detector backends.
+
+    A detector works on the RGB frame shrunk by ``scale`` and returns the
+    face locations as (top, right, bottom, left) in that frame. An optional
+    region of interest (x, y, w, h in full frame pixels) limits the search
+    to part of the frame.
+    """
+    name = "base"
+
+    def __init__(self, scale: float = DETECTION_SCALE, upsample: int = 1,
+                 roi: Optional[Tuple[int, int, int, int]] = None):
+        self.scale = scale
+        self.upsample = upsample
+        self.roi = roi
+        self._model = None
+
+    ############################################################
+    # models are loaded in the process using them (cached_model)
+    ############################################################
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_model"] = None
+        return state
+
+    ############################################################
+    # find the faces in the frame
+    ############################################################
+    def detect(self, rgb_small_frame: np.ndarray) -> list:
+        """
+        Find the faces in the frame, inside the region of interest if set.
+        """
+        if self.roi is None:
+            return self.detect_faces(rgb_small_frame)
+
+        (x, y, w, h) = [round(value * self.scale) for value in self.roi]
+        crop = np.ascontiguousarray(rgb_small_frame[y: y + h, x: x + w])
+        return [(top + y, right + x, bottom + y, left + x)
+                for (top, right, bottom, left) in self.detect_faces(crop)]
+
+    def detect_faces(self, rgb_image: np.ndarray) -> list:
+        raise NotImplementedError
+
+
+class HogDetector(FaceDetector):
+    """
+    dlib HOG detector, the face_recognition default.
+    """
+    name = "hog"
+
+    def detect_faces(self, rgb_image: np.ndarray) -> list:
+        return face_recognition.face_locations(rgb_image, self.upsample, model="hog")
+
+
+class CnnDetector(FaceDetector):
+    """
+    dlib CNN detector. Most accurate and finds small faces, but slow
+    without a GPU.
+    """
+    name = "cnn"
+
+    def detect_faces(self, rgb_image: np.ndarray) -> list:
+        return face_recognition.face_locations(rgb_image, self.upsample, model="cnn")
+
+
+class HaarDetector(FaceDetector):
+    """
+    OpenCV Haar cascade, the fastest backend for low-power kiosks.
+    """
+    name = "haar"
+
+    def detect_faces(self, rgb_image: np.ndarray) -> list:
+        if self._model is None:
+            cascade = os.path.join(cv2.data.haarcascades, "haarcascade_frontalface_default.xml")
+            self._model = cached_model((self.name, cascade), lambda: cv2.CascadeClassifier(cascade))
+        gray = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2GRAY)
+        if self.upsample > 1:
+            gray = cv2.resize(gray, (0, 0), fx=self.upsample, fy=self.upsample)
+        faces = self._model.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(20, 20))
+        return [(y // self.upsample, (x + w) // self.upsample, (y + h) // self.upsample, x // self.upsample)
+                for (x, y, w, h) in faces]
+
+
+class DnnDetector(FaceDetector):
+    """
+    OpenCV DNN detector with the res10 SSD face model. The model files
+    are expected in the assets/models folder.
+    """
+    name = "dnn"
+    prototxt = os.path.join(MODELS_FOLDER, "deploy.prototxt")
+    caffemodel = os.path.join(MODELS_FOLDER, "res10_300x300_ssd_iter_140000.caffemodel")
+    min_confidence = 0.5
+
+    def detect_faces(self, rgb_image: np.ndarray) -> list:
+        if self._model is None:
+            self._model = cached_model((self.name, self.prototxt, self.caffemodel),
+                                       lambda: cv2.dnn.readNetFromCaffe(self.prototxt, self.caffemodel))
+        height, width = rgb_image.shape[:2]
+        size = 300 * self.upsample
+        bgr_image = cv2.cvtColor(rgb_image, cv2.COLOR_RGB2BGR)
+        blob = cv2.dnn.blobFromImage(bgr_image, 1.0, (size, size), (104.0, 177.0, 123.0))
+        self._model.setInput(blob)
+        detections = self._model.forward()
+
+        face_locations = []
+        for detection in detections[0, 0]:
+            if detection[2] < self.min_confidence:
+                continue
+            left, top, right, bottom = (detection[3:7] * [width, height, width, height]).astype(int)
+            face_locations.append((max(top, 0), min(right, width), min(bottom, height), max(left, 0)))
+        return face_locations
+
+
+DETECTORS = {detector.name: detector for detector in (HogDetector, CnnDetector, HaarDetector, DnnDetector)}
+
+
+################################################################################
+# create detector by name
+################################################################################
+def create_detector(name: str = "hog", **options) -> FaceDetector:
+    """
+    Create the detector backend with the given name (hog, cnn, haar, dnn).
+    """
+    if name not in DETECTORS:
+        raise ValueError(f"unknown detector: {name}, choose one of {', '.join(DETECTORS)}")
+    logger.info(f"Using {name} face detector with {options}")
+    return DETECTORS[name](**options)
+
+
+class MotionGate:
+    """
+    Tells if the frame has changed enough since the last detection to be
+    worth detecting again. It compares tiny grayscale thumbnails, which is
+    much cheaper than any detector.
+    """
+
+    def __init__(self, threshold: float = MOTION_THRESHOLD):
+        self.threshold = threshold
+        self._previous = None
+
+    def changed(self, frame: np.ndarray) -> bool:
+        """
+        True if the frame differs from the one of the last detection. A
+        threshold of 0 disables the gate.
+        """
+        if self.threshold <= 0:
+            return True
+        thumbnail = cv2.cvtColor(cv2.resize(frame, (64, 48), interpolation=cv2.INTER_AREA),
+                                 cv2.COLOR_BGR2GRAY).astype(np.int16)
+        if self._previous is not None and np.abs(thumbnail - self._previous).mean() < self.threshold:
+            return False
+        self._previous = thumbnail
+        return True
+
+    def reset(self):
+        """
+        Forget the last frame, the next one is detected whatever it shows.
+        """
+        self._previous = None
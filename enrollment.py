@@ -0,0 +1,438 @@
+import argparse
+import csv
+import io
+import json
+import os
+import pathlib
+import time
+import uuid
+import zipfile
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+from database import FacesDatabase
+from photos import FACES_FOLDER, remove_photo, save_variants, shrink
+
+PHOTO_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+MAX_PHOTO_BYTES = 10 * 1024 * 1024  # larger photos in an import are rejected
+MAX_ROSTER_BYTES = 1024 * 1024  # larger rosters are rejected
+ROSTER_COLUMNS = ("name", "course", "photo")
+ENCODE_CHUNK = 4  # photos encoded by one task of the process pool
+
+
+################################################################################
+# load the dlib models in an encoding process
+################################################################################
+def load_models():
+    """
+    Import face_recognition, which loads dlib and its model files. Only the
+    encoding processes need it, they call this when they start so neither
+    the web app startup nor the first registration waits for the models.
+    """
+    import face_recognition  # noqa: F401
+
+
+################################################################################
+# normalize an enrollment photo and encode its face
+################################################################################
+def prepare_photo(path: str) -> Tuple[Optional[np.ndarray], str]:
+    """
+    Encode the face of an enrollment photo, which must show exactly one
+    face. The photo is shrunk in place to MAX_PHOTO_SIDE and its display,
+    thumbnail and face crop variants are written next to it, so the kiosk
+    and the web pages never load the full size upload. Runs in the encoding
+    process pool, so it has to stay a module level function.
+
+    Parameters
+    ----------
+    path : str
+        Photo saved as <face id>.<extension> in the faces folder
+
+    Returns
+    -------
+    (encoding, error) : tuple
+        The encoding and an empty string, or None and the reason the photo
+        can not be used
+    """
+    # already loaded by load_models in the encoding processes
+    import face_recognition
+
+    # imread also applies the EXIF orientation of phone pictures
+    image = cv2.imread(path)
+    if image is None:
+        return None, "unreadable image"
+    shrunk = shrink(image)
+    rgb_image = cv2.cvtColor(shrunk, cv2.COLOR_BGR2RGB)
+    face_locations = face_recognition.face_locations(rgb_image)
+    if not face_locations:
+        return None, "no face found"
+    if len(face_locations) > 1:
+        return None, f"{len(face_locations)} faces found"
+    encoding = face_recognition.face_encodings(rgb_image, face_locations)[0]
+
+    try:
+        # imwrite picks the encoder from the extension, which the build may lack
+        if shrunk is not image and not cv2.imwrite(path, shrunk):
+            return None, "photo can not be written"
+        save_variants(pathlib.Path(path).stem, shrunk, face_locations[0], os.path.dirname(path))
+    except cv2.error:
+        return None, "photo can not be written"
+    return np.asarray(encoding), ""
+
+
+################################################################################
+# students of a CSV roster
+################################################################################
+def read_roster(text: str) -> List[dict]:
+    """
+    Read the name, course and photo columns of a CSV roster with header.
+
+    Raises
+    ------
+    ValueError
+        If a column is missing
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    header = [column.strip().lower() for column in reader.fieldnames or []]
+    missing = [column for column in ROSTER_COLUMNS if column not in header]
+    if missing:
+        raise ValueError(f"roster misses the column(s): {', '.join(missing)}")
+    reader.fieldnames = header
+    return [{column: (row.get(column) or "").strip() for column in ROSTER_COLUMNS} for row in reader]
+
+
+################################################################################
+# write the photos of a roster to the faces folder
+################################################################################
+def stage_photos(roster: List[dict], read_photo: Callable[[str], Optional[bytes]],
+                 faces_folder: str = FACES_FOLDER) -> Tuple[List[dict], list]:
+    """
+    Check the rows of a roster and save the photo of every valid row under
+    a new face id. Nothing is left in the faces folder if it fails.
+
+    Parameters
+    ----------
+    roster : list
+        Rows of read_roster
+    read_photo : callable
+        Returns the content of the named photo, None if there is none. It
+        raises ValueError with the reason if the photo can not be used.
+
+    Returns
+    -------
+    (results, photos) : tuple
+        The result of every row, and (result, file name) of the saved photos
+    """
+    results = []
+    photos = []
+    try:
+        for number, row in enumerate(roster, start=1):
+            result = {"row": number, "name": row["name"], "course": row["course"], "photo": row["photo"],
+                      "status": "rejected", "face_id": "", "reason": ""}
+            results.append(result)
+            extension = pathlib.Path(row["photo"]).suffix.lower()
+            if not row["name"] or not row["course"]:
+                result["reason"] = "name and course are required"
+                continue
+            if extension not in PHOTO_EXTENSIONS:
+                result["reason"] = f"photo must be one of {', '.join(PHOTO_EXTENSIONS)}"
+                continue
+            try:
+                content = read_photo(row["photo"])
+            except ValueError as e:
+                result["reason"] = str(e)
+                continue
+            if content is None:
+                result["reason"] = "photo not found"
+                continue
+
+            face_id = str(uuid.uuid4())
+            filename = face_id + extension
+            photos.append((result, filename))
+            with open(os.path.join(faces_folder, filename), "wb") as photo_file:
+                photo_file.write(content)
+            result["face_id"] = face_id
+    except BaseException:
+        discard_photos(photos, faces_folder)
+        raise
+    return results, photos
+
+
+################################################################################
+# delete the saved photos of an import which did not finish
+################################################################################
+def discard_photos(photos: list, faces_folder: str = FACES_FOLDER):
+    for result, filename in photos:
+        remove_photo(pathlib.Path(filename).stem, filename, faces_folder)
+        result["face_id"] = ""
+
+
+################################################################################
+# the saved photos in chunks of ENCODE_CHUNK paths
+################################################################################
+def photo_chunks(photos: list, faces_folder: str = FACES_FOLDER) -> List[List[str]]:
+    paths = [os.path.join(faces_folder, filename) for (_, filename) in photos]
+    return [paths[first:first + ENCODE_CHUNK] for first in range(0, len(paths), ENCODE_CHUNK)]
+
+
+################################################################################
+# encode a chunk of photos
+################################################################################
+def encode_photos(paths: List[str]) -> List[Tuple[Optional[np.ndarray], str]]:
+    """
+    prepare_photo of every path, one task of the encoding pool per chunk.
+    """
+    return [prepare_photo(path) for path in paths]
+
+
+################################################################################
+# insert the students whose photo was encoded
+################################################################################
+def store_students(db: FacesDatabase, results: List[dict], photos: list, encodings: list,
+                   faces_folder: str = FACES_FOLDER, start: float = None) -> dict:
+    """
+    Reject the photos which do not show exactly one face and insert the
+    other students in a single transaction.
+
+    Parameters
+    ----------
+    results, photos : list
+        Returned by stage_photos
+    encodings : list
+        (encoding, error) of every photo, in the order of photos
+    start : float, optional
+        perf_counter at the start of the import, for the report
+
+    Returns
+    -------
+    report : dict
+        Counts, elapsed time, throughput and the result of every row
+    """
+    start = time.perf_counter() if start is None else start
+    encoded = len(encodings)
+    faces = []
+    for (result, filename), (encoding, error) in zip(photos, encodings):
+        if encoding is None:
+            result["reason"] = error
+            remove_photo(result["face_id"], filename, faces_folder)
+            result["face_id"] = ""
+            continue
+        faces.append((result, (result["name"], result["course"], result["face_id"], filename, encoding)))
+
+    inserted = db.insert_many_faces([face for (_, face) in faces])
+    for result, (_, _, _, filename, _) in faces:
+        if inserted:
+            result["status"] = "enrolled"
+        else:
+            result["reason"] = "database error"
+            remove_photo(result["face_id"], filename, faces_folder)
+            result["face_id"] = ""
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"enrolled {inserted} of {len(results)} students in {elapsed:.1f} s")
+    return {
+        "rows": len(results),
+        "encoded": encoded,
+        "enrolled": inserted,
+        "rejected": len(results) - inserted,
+        "seconds": round(elapsed, 3),
+        # photos encoded per second, the rows rejected before cost nothing
+        "photos_per_second": round(encoded / elapsed, 2) if elapsed > 0 else 0,
+        "results": results,
+    }
+
+
+################################################################################
+# enroll the saved photos
+################################################################################
+def enroll_staged(db: FacesDatabase, staged: Tuple[List[dict], list], executor: Executor,
+                  faces_folder: str = FACES_FOLDER, start: float = None) -> dict:
+    """
+    Encode the photos of stage_photos in parallel on the executor (a
+    process pool), a chunk per task, and store the students. The photos
+    are deleted if the import fails on the way.
+    """
+    results, photos = staged
+    stored = False
+    try:
+        encodings = []
+        for encoded in executor.map(encode_photos, photo_chunks(photos, faces_folder)):
+            encodings.extend(encoded)
+        report = store_students(db, results, photos, encodings, faces_folder, start)
+        stored = True
+    finally:
+        if not stored:
+            discard_photos(photos, faces_folder)
+    return report
+
+
+################################################################################
+# enroll the students of a roster
+################################################################################
+def enroll_students(db: FacesDatabase, roster: List[dict], read_photo: Callable[[str], Optional[bytes]],
+                    executor: Executor, faces_folder: str = FACES_FOLDER) -> dict:
+    """
+    Enroll many students at once.
+
+    Rows without a usable photo, or whose photo does not show exactly one
+    face, are rejected. The accepted students are inserted in a single
+    transaction.
+
+    Parameters
+    ----------
+    db : FacesDatabase
+        Database to insert into
+    roster : list
+        Rows of read_roster
+    read_photo : callable
+        Returns the content of the named photo, None if there is none. It
+        raises ValueError with the reason if the photo can not be used.
+    executor : Executor
+        Pool computing the encodings
+
+    Returns
+    -------
+    report : dict
+        Counts, elapsed time, throughput and the result of every row
+    """
+    start = time.perf_counter()
+    return enroll_staged(db, stage_photos(roster, read_photo, faces_folder), executor, faces_folder, start)
+
+
+################################################################################
+# refuse photos above the size limit
+################################################################################
+def check_photo_size(size: int):
+    if size > MAX_PHOTO_BYTES:
+        raise ValueError(f"photo is larger than {MAX_PHOTO_BYTES // (1024 * 1024)} MB")
+
+
+################################################################################
+# refuse rosters above the size limit
+################################################################################
+def check_roster_size(size: int):
+    if size > MAX_ROSTER_BYTES:
+        raise ValueError(f"roster is larger than {MAX_ROSTER_BYTES // 1024} KB")
+
+
+################################################################################
+# save the photos of a ZIP archive
+################################################################################
+def stage_archive(archive, roster_text: str, faces_folder: str = FACES_FOLDER) -> Tuple[List[dict], list]:
+    """
+    stage_photos of the students of a ZIP archive. The photo column is the
+    path of the photo in the archive, or only its file name when no other
+    photo in the archive has the same one. Without ``roster_text`` the
+    first CSV file of the archive is the roster.
+
+    Raises
+    ------
+    ValueError
+        If the archive is not a ZIP file or there is no valid roster
+    """
+    try:
+        zip_file = zipfile.ZipFile(archive)
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"not a ZIP archive ({e})")
+
+    with zip_file:
+        members = {str(pathlib.PurePosixPath(info.filename)): info
+                   for info in zip_file.infolist() if not info.is_dir()}
+        by_name = {}
+        for path, info in members.items():
+            by_name.setdefault(pathlib.PurePosixPath(path).name, []).append(info)
+        if not roster_text:
+            rosters = [path for path in members if path.lower().endswith(".csv")]
+            if not rosters:
+                raise ValueError("no roster CSV given or found in the archive")
+            check_roster_size(members[rosters[0]].file_size)
+            roster_text = zip_file.read(members[rosters[0]]).decode("utf-8-sig")
+
+        def read_photo(name: str) -> Optional[bytes]:
+            path = pathlib.PurePosixPath(name.replace("\\", "/"))
+            info = members.get(str(path))
+            if info is None:
+                same_name = by_name.get(path.name, [])
+                if len(same_name) > 1:
+                    # a student must never get the photo of another one
+                    raise ValueError(f"{len(same_name)} photos named {path.name} in the archive, "
+                                     "give the path of the photo")
+                if not same_name:
+                    return None
+                info = same_name[0]
+            # checked before reading, so a zip bomb is never inflated
+            check_photo_size(info.file_size)
+            return zip_file.read(info)
+
+        return stage_photos(read_roster(roster_text), read_photo, faces_folder)
+
+
+################################################################################
+# enroll from a ZIP archive of photos
+################################################################################
+def enroll_archive(db: FacesDatabase, archive, roster_text: str, executor: Executor,
+                   faces_folder: str = FACES_FOLDER) -> dict:
+    start = time.perf_counter()
+    return enroll_staged(db, stage_archive(archive, roster_text, faces_folder), executor, faces_folder, start)
+
+
+################################################################################
+# enroll from a folder of photos
+################################################################################
+def enroll_folder(db: FacesDatabase, folder: str, roster_text: str, executor: Executor,
+                  faces_folder: str = FACES_FOLDER) -> dict:
+    def read_photo(name: str) -> Optional[bytes]:
+        path = os.path.join(folder, os.path.basename(name))
+        if not os.path.isfile(path):
+            return None
+        check_photo_size(os.path.getsize(path))
+        with open(path, "rb") as photo_file:
+            return photo_file.read()
+
+    return enroll_students(db, read_roster(roster_text), read_photo, executor, faces_folder)
+
+
+################################################################################
+# main
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enroll many students at once")
+    parser.add_argument("--roster", help="CSV file with the name, course and photo columns "
+                                         "(default: the CSV file in the archive)")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--photos", help="folder with the photos")
+    source.add_argument("--archive", help="ZIP archive with the photos")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of encoding processes (default: number of cores)")
+    parser.add_argument("--output", help="write the JSON report to this file (default: stdout)")
+    args = parser.parse_args()
+    if args.photos and not args.roster:
+        parser.error("--roster is required with --photos")
+
+    roster_text = ""
+    if args.roster:
+        try:
+            check_roster_size(os.path.getsize(args.roster))
+        except ValueError as e:
+            parser.error(str(e))
+        with open(args.roster, encoding="utf-8-sig") as roster_file:
+            roster_text = roster_file.read()
+
+    db = FacesDatabase()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=load_models) as executor:
+        if args.photos:
+            report = enroll_folder(db, args.photos, roster_text, executor)
+        else:
+            report = enroll_archive(db, args.archive, roster_text, executor)
+    db.close_db()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
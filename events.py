@@ -0,0 +1,82 @@
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Optional
+
+from database import TIMEZONE
+from tracing import TRACER
+
+
+################################################################################
+# time a stage into a dict of milliseconds
+################################################################################
+@contextmanager
+def timed(timings: Optional[dict], stage: str):
+    """
+    Add the duration of the block in milliseconds to ``timings[stage]``.
+    Nothing is measured when timings is None. The block is also a span of
+    the frame trace.
+    """
+    with TRACER.span(stage):
+        if timings is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[stage] = round(timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000, 3)
+
+
+class EventWriter:
+    """
+    Structured events of the recognizer, for cameras without a screen.
+
+    Every event is a dict with its type, the local time and the unix
+    timestamp. The events are written as JSON lines to the output, and/or
+    handed to the callback. Events come from the camera loops and from the
+    attendance writer thread, so emitting is locked.
+    """
+
+    def __init__(self, output=None, callback: Callable[[dict], None] = None):
+        self.output = output
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    ############################################################
+    # write an event
+    ############################################################
+    def emit(self, event_type: str, **fields) -> dict:
+        now = time.time()
+        event = {"type": event_type,
+                 "time": datetime.fromtimestamp(now, TIMEZONE).isoformat(timespec="milliseconds"),
+                 "timestamp": round(now, 3)}
+        event.update(fields)
+        with self.lock:
+            if self.output is not None:
+                self.output.write(json.dumps(event) + "\n")
+                self.output.flush()
+            if self.callback is not None:
+                self.callback(event)
+        return event
+
+    ############################################################
+    # close the output file
+    ############################################################
+    def close(self):
+        with self.lock:
+            if self.output is not None and self.output is not sys.stdout:
+                self.output.close()
+            self.output = None
+
+
+################################################################################
+# event writer for a file name, - is stdout
+################################################################################
+def open_event_writer(path: str) -> EventWriter:
+    if path == "-":
+        return EventWriter(sys.stdout)
+    return EventWriter(open(path, "a", encoding="utf-8"))
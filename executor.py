@@ -0,0 +1,97 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+from loguru import logger
+
+DATABASE_WORKERS = 8  # threads for the SQLite and file calls of the web app
+ENCODING_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # processes for dlib
+QUEUE_FACTOR = 4  # tasks allowed to wait per worker before refusing more
+
+
+class PoolBusy(Exception):
+    """
+    Raised when a pool already has as many tasks as it may queue.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(f"{name} pool is busy")
+        self.name = name
+
+
+class BoundedExecutor:
+    """
+    Run blocking calls from async code on an executor, with a limit on the
+    running and waiting tasks.
+
+    Once the limit is reached new calls fail with PoolBusy straight away
+    instead of queueing without end, so a burst of slow work (enrollments)
+    gets refused early while the event loop stays free for cheap requests.
+    """
+
+    def __init__(self, executor: Executor, workers: int, name: str, queue_factor: int = QUEUE_FACTOR):
+        self.executor = executor
+        self.name = name
+        self.workers = workers
+        self.limit = workers * (1 + queue_factor)
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    ############################################################
+    # await the call on the executor
+    ############################################################
+    async def run(self, function, *args, **kwargs):
+        """
+        Run ``function(*args, **kwargs)`` on the executor and wait for the
+        result without blocking the event loop.
+
+        Raises
+        ------
+        PoolBusy
+            If the pool has no room for the call
+        """
+        with self.lock:
+            if self.pending >= self.limit:
+                logger.warning(f"{self.name} pool is full with {self.pending} tasks, refusing the call")
+                raise PoolBusy(self.name)
+            self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    ############################################################
+    # start the workers in the background
+    ############################################################
+    def warm(self):
+        """
+        Start the workers now with a no-op call each, without waiting for
+        them, so their initializer runs before the first real call.
+        """
+        for _ in range(self.workers):
+            self.executor.submit(int)
+
+    ############################################################
+    # stop the workers
+    ############################################################
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+################################################################################
+# thread pool for the database
+################################################################################
+def database_executor(workers: int = DATABASE_WORKERS) -> BoundedExecutor:
+    return BoundedExecutor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix="database"),
+                           workers, "database")
+
+
+################################################################################
+# process pool for the face encodings
+################################################################################
+def encoding_executor(workers: int = ENCODING_WORKERS, initializer=None) -> BoundedExecutor:
+    return BoundedExecutor(ProcessPoolExecutor(max_workers=workers, initializer=initializer), workers, "encoding")
@@ -0,0 +1,159 @@
+import argparse
+import csv
+import importlib.util
+import io
+import sys
+from datetime import datetime
+from typing import Iterable, Iterator
+
+from loguru import logger
+
+from database import TIMEZONE, FacesDatabase, parse_date
+
+EXPORT_COLUMNS = ("id", "face_id", "name", "course", "attendance_time", "timestamp")
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+################################################################################
+# the parquet export needs pyarrow
+################################################################################
+def parquet_available() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+################################################################################
+# attendance rows as CSV
+################################################################################
+def export_csv(chunks: Iterable[list]) -> Iterator[bytes]:
+    """
+    Write the chunks of raw attendance rows (FacesDatabase.iter_attendance)
+    as CSV with a header, one piece of bytes per chunk.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in chunks:
+        writer.writerows((id, face_id, name, course,
+                          datetime.fromtimestamp(time, TIMEZONE).isoformat(), time)
+                         for (id, face_id, _, name, course, time) in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    # the header of an empty export
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Output file of the parquet writer, which keeps the bytes written since
+    they were last taken.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+################################################################################
+# attendance rows as parquet
+################################################################################
+def export_parquet(chunks: Iterable[list]) -> Iterator[bytes]:
+    """
+    Write the chunks of raw attendance rows as a columnar parquet file,
+    one row group per chunk, yielding the bytes of every row group as soon
+    as it is written.
+
+    Raises
+    ------
+    ImportError
+        If pyarrow is not installed
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("face_id", pa.string()),
+        ("name", pa.string()),
+        ("course", pa.string()),
+        ("attendance_time", pa.timestamp("s", tz=TIMEZONE.zone)),
+        ("timestamp", pa.int64()),
+    ])
+    sink = ChunkSink()
+    with pq.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in chunks:
+            (ids, face_ids, _, names, courses, times) = zip(*rows)
+            writer.write_table(pa.table([ids, face_ids, names, courses, times, times], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+################################################################################
+# export the attendance in the format
+################################################################################
+def export_attendance(db: FacesDatabase, export_format: str, date_from: int = None, date_to: int = None,
+                      course: str = "", face_id: str = "") -> Iterator[bytes]:
+    """
+    Stream the matching attendance, oldest first, in constant memory.
+
+    Parameters
+    ----------
+    export_format : str
+        A key of EXPORT_FORMATS
+    date_from, date_to : int, optional
+        Unix time range of the attendance (both inclusive)
+    course, face_id : str, optional
+        Only the attendance of this course / student
+    """
+    chunks = db.iter_attendance(date_from, date_to, course, face_id)
+    if export_format == "parquet":
+        return export_parquet(chunks)
+    return export_csv(chunks)
+
+
+################################################################################
+# main
+################################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the attendance")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+    parser.add_argument("--date-from", default="", help="first day, YYYY-MM-DD")
+    parser.add_argument("--date-to", default="", help="last day, YYYY-MM-DD")
+    parser.add_argument("--course", default="", help="only this course")
+    parser.add_argument("--output", help="output file (default: stdout)")
+    args = parser.parse_args()
+    if args.format == "parquet" and not parquet_available():
+        parser.error("the parquet format needs pyarrow (pip install pyarrow)")
+
+    db = FacesDatabase()
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    size = 0
+    for data in export_attendance(db, args.format, parse_date(args.date_from),
+                                  parse_date(args.date_to, end_of_day=True), args.course):
+        output.write(data)
+        size += len(data)
+    if args.output:
+        output.close()
+    db.close_db()
+    logger.success(f"exported {size} bytes of attendance")
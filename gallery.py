@@ -0,0 +1,272 @@
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+from ann import IVF_NPROBE, IvfIndex
+
+ENCODING_SIZE = 128
+FACE_MATCH_TOLERANCE = 0.6
+MIN_CAPACITY = 64
+
+
+class FaceGallery:
+    """
+    In-memory gallery of the enrolled face encodings.
+
+    All encodings are kept in one contiguous float32 (N, 128) matrix with the
+    squared norms precomputed, so every face found in a frame is matched
+    against every student with a single matrix product.
+
+    Students can be added and removed one at a time. The matrix keeps spare
+    rows for appends and a removed row is filled with the last one, so
+    neither operation copies the whole gallery. All the methods can be
+    called from several threads.
+
+    For very large galleries an approximate IVF index can be enabled, then
+    only the students in the lists nearest to a face are compared.
+    """
+    students: list
+
+    ############################################################
+    # constructor
+    ############################################################
+    def __init__(self, tolerance: float = FACE_MATCH_TOLERANCE, index: str = "exact",
+                 nprobe: int = IVF_NPROBE):
+        """
+        Constructs an empty gallery.
+
+        Parameters
+        ----------
+        tolerance : float, optional
+            Maximum distance for two faces to be treated as a match
+        index : str, optional
+            "exact" to scan every student, "ivf" for the approximate index
+        nprobe : int, optional
+            Number of IVF lists searched per face, higher is more accurate
+        """
+        if index not in ("exact", "ivf"):
+            raise ValueError(f"unknown gallery index: {index}")
+        self.tolerance = tolerance
+        self.index = IvfIndex(nprobe) if index == "ivf" else None
+        self._matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._norms = np.empty((0,), dtype=np.float32)
+        self._positions = {}
+        self._lock = threading.RLock()
+        self.students = []
+
+    def __len__(self) -> int:
+        return len(self.students)
+
+    @property
+    def encodings(self) -> np.ndarray:
+        return self._matrix[:len(self.students)]
+
+    @property
+    def norms(self) -> np.ndarray:
+        return self._norms[:len(self.students)]
+
+    ############################################################
+    # load the students and their encodings
+    ############################################################
+    def load(self, students: list, encodings):
+        """
+        Replace the gallery content.
+
+        Parameters
+        ----------
+        students : list
+            Student objects, in the same order as the encodings
+        encodings : array like
+            Face encodings of shape (N, 128)
+        """
+        with self._lock:
+            matrix = np.asarray(encodings, dtype=np.float32)
+            if matrix.size == 0:
+                matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+            if matrix.ndim != 2 or matrix.shape[1] != ENCODING_SIZE:
+                raise ValueError(f"expected (N, {ENCODING_SIZE}) encodings, got {matrix.shape}")
+            if matrix.shape[0] != len(students):
+                raise ValueError("number of students and encodings are not matching")
+
+            # a read-only matrix (e.g. memory mapped) is only copied on first
+            # change, any other is copied now, add and remove change the rows
+            if matrix.flags.writeable or not matrix.flags.c_contiguous:
+                matrix = np.array(matrix, dtype=np.float32, order="C", copy=True)
+            self._matrix = matrix
+            self._norms = np.einsum("ij,ij->i", self._matrix, self._matrix)
+            self.students = list(students)
+            self._positions = {student.face_id: row for row, student in enumerate(self.students)}
+            if self.index is not None:
+                self.index.train(self._matrix)
+            logger.debug(f"Gallery loaded with {len(self.students)} encodings")
+
+    ############################################################
+    # make room for the given number of students
+    ############################################################
+    def _reserve(self, size: int):
+        if size <= len(self._matrix) and self._matrix.flags.writeable:
+            return
+        capacity = max(MIN_CAPACITY, size, 2 * len(self.students))
+        matrix = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        norms = np.empty((capacity,), dtype=np.float32)
+        matrix[:len(self.students)] = self.encodings
+        norms[:len(self.students)] = self.norms
+        self._matrix = matrix
+        self._norms = norms
+
+    ############################################################
+    # add a single student
+    ############################################################
+    def add(self, student, encoding):
+        """
+        Add (or replace) a student with the given encoding.
+        """
+        with self._lock:
+            if student.face_id in self._positions:
+                self.remove(student.face_id)
+
+            row = len(self.students)
+            self._reserve(row + 1)
+            self._matrix[row] = np.asarray(encoding, dtype=np.float32)
+            self._norms[row] = np.dot(self._matrix[row], self._matrix[row])
+            self.students.append(student)
+            self._positions[student.face_id] = row
+
+            if self.index is not None:
+                if self.index.needs_training(len(self.students)):
+                    self.index.train(self.encodings)
+                else:
+                    self.index.add(row, self._matrix[row])
+
+    ############################################################
+    # remove a single student
+    ############################################################
+    def remove(self, face_id: str) -> bool:
+        """
+        Remove the student with the given face id.
+
+        Returns
+        -------
+        removed : bool
+            False if the student is not in the gallery
+        """
+        with self._lock:
+            row = self._positions.pop(face_id, None)
+            if row is None:
+                return False
+
+            self._reserve(len(self.students))
+            last = len(self.students) - 1
+            if row != last:
+                # move the last student into the free row
+                self._matrix[row] = self._matrix[last]
+                self._norms[row] = self._norms[last]
+                self.students[row] = self.students[last]
+                self._positions[self.students[row].face_id] = row
+                if self.index is not None:
+                    self.index.move(last, row)
+            self.students.pop()
+            return True
+
+    ############################################################
+    # distance between the given faces and every student
+    ############################################################
+    def face_distances(self, face_encodings) -> np.ndarray:
+        """
+        Euclidean distance between each face and each gallery entry.
+
+        Returns
+        -------
+        distances : np.ndarray
+            Matrix of shape (number of faces, number of students)
+        """
+        faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        face_norms = np.einsum("ij,ij->i", faces, faces)
+        # |a - b|^2 = |a|^2 + |b|^2 - 2 a.b
+        squared = face_norms[:, None] + self.norms[None, :] - 2.0 * (faces @ self.encodings.T)
+        np.maximum(squared, 0.0, out=squared)
+        return np.sqrt(squared)
+
+    ############################################################
+    # top k students for each face
+    ############################################################
+    def match(self, face_encodings, k: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the k closest students for every face in the frame.
+
+        Parameters
+        ----------
+        face_encodings : array like
+            Encodings of the faces found in the frame
+        k : int, optional
+            Number of candidates returned per face
+
+        Returns
+        -------
+        (indices, distances) : tuple
+            Two arrays of shape (number of faces, k), sorted by distance.
+            Indices refer to the gallery students.
+        """
+        with self._lock:
+            faces = np.asarray(face_encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+            k = min(k, len(self.students))
+            if k <= 0 or len(faces) == 0:
+                return (np.empty((len(faces), 0), dtype=np.intp),
+                        np.empty((len(faces), 0), dtype=np.float32))
+
+            if self.index is not None and self.index.ready:
+                return self._match_index(faces, k)
+
+            distances = self.face_distances(faces)
+            if k < distances.shape[1]:
+                indices = np.argpartition(distances, k - 1, axis=1)[:, :k]
+            else:
+                indices = np.tile(np.arange(distances.shape[1]), (len(faces), 1))
+            top = np.take_along_axis(distances, indices, axis=1)
+            order = np.argsort(top, axis=1)
+            return (np.take_along_axis(indices, order, axis=1),
+                    np.take_along_axis(top, order, axis=1))
+
+    ############################################################
+    # top k students of the IVF candidates
+    ############################################################
+    def _match_index(self, faces: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Same as match, but only the candidates of the IVF index are compared.
+        Faces with less than k candidates are padded with index -1 and an
+        infinite distance.
+        """
+        indices = np.full((len(faces), k), -1, dtype=np.intp)
+        distances = np.full((len(faces), k), np.inf, dtype=np.float32)
+        candidates = self.index.candidates(faces, len(self.students))
+        for face_index, (face, rows) in enumerate(zip(faces, candidates)):
+            if len(rows) == 0:
+                continue
+            squared = np.dot(face, face) + self._norms[rows] - 2.0 * (self._matrix[rows] @ face)
+            face_distances = np.sqrt(np.maximum(squared, 0.0))
+            order = np.argsort(face_distances)[:k]
+            indices[face_index, :len(order)] = rows[order]
+            distances[face_index, :len(order)] = face_distances[order]
+        return indices, distances
+
+    ############################################################
+    # best student (or None) for each face
+    ############################################################
+    def identify(self, face_encodings) -> List[Tuple[Optional[object], float]]:
+        """
+        Return the matched student and distance for every face. The student
+        is None when the closest entry is outside the tolerance.
+        """
+        with self._lock:
+            indices, distances = self.match(face_encodings, k=1)
+            results = []
+            for face_indices, face_distances in zip(indices, distances):
+                if len(face_indices) == 0:
+                    results.append((None, 1.0))
+                    continue
+                distance = float(face_distances[0])
+                student = self.students[face_indices[0]] if distance <= self.tolerance else None
+                results.append((student, distance))
+            return results
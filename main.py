@@ -1,6 +1,10 @@
+import argparse
 import json
 import math
+import queue
 import sys
+import threading
+import time
 from enum import Enum
 
 import cv2
@@ -8,7 +12,19 @@ import face_recognition
 import numpy as np
 from loguru import logger
 
+from attendance import AttendanceWriter
 from database import FacesDatabase
+from detector import DETECTION_SCALE, DETECTORS, MOTION_THRESHOLD, FaceDetector, HogDetector, MotionGate, create_detector
+from events import EventWriter, open_event_writer, timed
+from ann import IVF_NPROBE
+from gallery import FACE_MATCH_TOLERANCE, FaceGallery
+from metrics import counter, gauge, histogram, serve_metrics
+from photos import DisplayImageCache
+from pipeline import FrameGrabber, FrameSlot, RecognitionWorker
+from preview import PreviewPublisher
+from snapshot import load_snapshot
+from tracker import FaceTracker, is_tracked
+from tracing import TRACE_SAMPLE, TRACER
 
 # video start of x & y
 FACES_FOLDER = "assets/faces"
@@ -32,7 +48,20 @@ bg_image = cv2.imread("assets/background.png")
 
 ACCEPT_COUNTER = 2
 RESET_COUNTER = 4
+MODE_STEP_SECONDS = 1.0  # the mode counter advances at most once per step, however fast the results come
 ATTENDANCE_TIME_DELTA = 300  # 300 seconds = 5 minutes (5 * 60)
+GALLERY_REFRESH_INTERVAL = 5  # seconds between checks for new/deleted students
+PIPELINE_QUEUE_SIZE = 1  # recognition results waiting for the render loop
+
+FRAME_STAGE_SECONDS = histogram("attendance_frame_stage_seconds", "Time of the stages of a camera frame",
+                                ("camera", "stage"))
+FRAMES = counter("attendance_frames_total", "Frames recognized", ("camera",))
+FACES = counter("attendance_faces_total", "Faces seen in the recognized frames", ("camera",))
+UNKNOWN_FACES = counter("attendance_unknown_faces_total", "Faces seen matching no student", ("camera",))
+MARKS = counter("attendance_marks_total", "Attendance outcomes (marked, failed, already_marked)",
+                ("camera", "status"))
+GALLERY_STUDENTS = gauge("attendance_gallery_students", "Students in the gallery")
+QUEUE_DEPTH = gauge("attendance_queue_depth", "Items waiting in a queue", ("queue",))
 
 
 class CurrentMode(Enum):
@@ -59,7 +88,7 @@ mode_images["AlreadyMarked"] = cv2.imread(f"assets/fillers/{CurrentMode.AlreadyM
 # logger.add(sys.stdout, format="<yellow>{time}</yellow> <level>{message}</level>")
 
 
-def face_confidence(face_distance, face_match_threshold=0.6):
+def face_confidence(face_distance, face_match_threshold=FACE_MATCH_TOLERANCE):
     face_range = 1.0 - face_match_threshold
     linear_val = (1.0 - face_distance) / (face_range * 2.0)
 
@@ -72,18 +101,156 @@ def face_confidence(face_distance, face_match_threshold=0.6):
         return str(round(value, 2)) + "%"
 
 
+############################################################
+# open camera index, video file or stream url
+############################################################
+def open_video_source(source=0):
+    """
+    Open the video source, a string of digits is taken as camera index.
+    """
+    if isinstance(source, str) and source.isdigit():
+        source = int(source)
+    video_capture = cv2.VideoCapture(source)
+
+    # check is the camera is opened or not
+    if not video_capture.isOpened():
+        sys.exit(f"Video source not opened... ({source})")
+    return video_capture
+
+
+class FrameResult:
+    """
+    Faces found in one frame. Locations are in the frame shrunk by scale,
+    the student is None for a face which is not in the gallery. Matched
+    tells, per face, if the identity comes from an encoding of this frame
+    rather than from its track. The timings are the milliseconds spent in
+    every recognition stage.
+    """
+
+    def __init__(self, face_locations=None, face_names=None, students=None, scale=DETECTION_SCALE,
+                 distances=None, timings=None, matched=None):
+        self.face_locations = face_locations or []
+        self.face_names = face_names or []
+        self.students = students or []
+        self.scale = scale
+        self.distances = distances or []
+        self.timings = timings or {}
+        self.matched = matched or []
+
+    @property
+    def found_student(self):
+        """
+        Student of the first face, the one shown on the screen.
+        """
+        return self.students[0] if self.students else None
+
+    @property
+    def student_matched(self) -> bool:
+        """
+        True if the student of the first face was matched from its own
+        encoding, not inherited from an overlapping track.
+        """
+        return bool(self.matched) and self.matched[0]
+
+
+class CameraState:
+    """
+    Mode state machine and screen of one camera.
+    """
+
+    def __init__(self, name: str = "camera", motion_threshold: float = MOTION_THRESHOLD):
+        self.name = name
+        self.current_mode = CurrentMode.Waiting.value
+        self.counter = 0
+        # monotonic time the counter last advanced
+        self.last_step = 0.0
+        self.attendance_marked = False
+        # future of the attendance being written in the background
+        self.pending_mark = None
+        self.found_student = None
+        self.process_current_frame = True
+        # frames recognized, numbers the events of the camera
+        self.frames = 0
+        self.tracker = FaceTracker()
+        self.motion_gate = MotionGate(motion_threshold)
+        self.last_result = FrameResult()
+        self.canvas = bg_image.copy()
+        # live preview for the web app, None when not published
+        self.preview = None
+
+    ############################################################
+    # recognize the faces again from scratch
+    ############################################################
+    def expire_identities(self):
+        """
+        Make the next frame detect and encode every face again. The motion
+        gate would otherwise keep returning the result of an unchanged
+        scene, with the identities of the expired tracks.
+        """
+        self.tracker.expire()
+        self.motion_gate.reset()
+
+
+############################################################
+# shrink the frame for detection
+############################################################
+def prepare_frame(frame, scale: float = DETECTION_SCALE) -> np.ndarray:
+    """
+    Create the scaled down RGB frame used for the detection.
+    """
+    small_frame = cv2.resize(frame, (0, 0), fx=scale, fy=scale)
+    return np.ascontiguousarray(small_frame[:, :, ::-1])
+
+
+############################################################
+# detect and encode the faces of a prepared frame
+############################################################
+def detect_and_encode(rgb_small_frame: np.ndarray, tracked_locations=(), detector: FaceDetector = None,
+                      timings: dict = None):
+    """
+    Find the faces and their encodings. This is the expensive part of the
+    recognition, it does not need any state so it can run in a worker
+    process.
+
+    Parameters
+    ----------
+    rgb_small_frame : np.ndarray
+        Frame from prepare_frame
+    tracked_locations : list, optional
+        Locations of the tracked faces with a known identity, the faces
+        found at these locations are not encoded again
+    detector : FaceDetector, optional
+        Detector backend, HOG by default
+    timings : dict, optional
+        Receives the milliseconds of the detect and encode stages
+
+    Returns
+    -------
+    (face_locations, face_encodings) : tuple
+        The encoding is None for the faces which continue a track
+    """
+    # find all the faces in the current frame
+    detector = detector or HogDetector()
+    with timed(timings, "detect"):
+        face_locations = detector.detect(rgb_small_frame)
+
+    # find all encoding for the new faces available in the freame
+    new_faces = [not is_tracked(location, tracked_locations) for location in face_locations]
+    new_locations = [location for location, new in zip(face_locations, new_faces) if new]
+    with timed(timings, "encode"):
+        new_encodings = iter(face_recognition.face_encodings(rgb_small_frame, new_locations)
+                             if new_locations else [])
+    face_encodings = [next(new_encodings) if new else None for new in new_faces]
+    return face_locations, face_encodings
+
+
 class FaceRecognition:
     db: FacesDatabase
-    face_locations = []
-    face_encodings = []
-    face_names = []
-    known_face_encodings = []
-    known_face_names = []
-    process_current_frame = True
-    attendance_marked = False
-    current_mode = "Waiting"
-    counter = 0
+    gallery: FaceGallery
+    state: CameraState
     students = []
+    gallery_revision = 0
+    gallery_checked_at = 0.0
 
     selected_name = ""
     selected_course = ""
@@ -92,9 +259,24 @@ class FaceRecognition:
     ############################################################
     # constructor
     ############################################################
-    def __init__(self):
+    def __init__(self, detector: FaceDetector = None, motion_threshold: float = MOTION_THRESHOLD,
+                 gallery: FaceGallery = None, events: EventWriter = None, write_attendance: bool = True):
+        """
+        Without write_attendance there is no attendance writer (and no
+        journal), for the benchmarks which never mark the attendance.
+        """
         self.db = FacesDatabase()
+        self.events = events
+        self.gallery = gallery or FaceGallery()
+        self.detector = detector or HogDetector()
+        self.state = CameraState(motion_threshold=motion_threshold)
+        self.display_images = DisplayImageCache()
         self.load_students()
+        self.db.warm_last_marked()
+        self.attendance = AttendanceWriter(self.db) if write_attendance else None
+        GALLERY_STUDENTS.set_function(lambda: len(self.gallery))
+        if self.attendance is not None:
+            QUEUE_DEPTH.set_function(self.attendance.queue.qsize, queue="attendance_writer")
         # self.encode_faces()
         # sys.exit(12)
 
@@ -103,14 +285,59 @@ class FaceRecognition:
     ############################################################
     def load_students(self):
         """
-        get all the students information
+        get all the students information from the memory mapped snapshot
+        """
+        self.students, encodings, self.gallery_revision = load_snapshot(self.db)
+        self.gallery.load(self.students, encodings)
+        self.students = self.gallery.students
+        self.gallery_checked_at = time.monotonic()
+        self.display_images.clear()
+        self.display_images.prefill(list(self.students))
+
+    ############################################################
+    # apply the student changes since the last load/refresh
+    ############################################################
+    def refresh_gallery(self, force: bool = False) -> bool:
+        """
+        Add newly registered and remove deleted students without reloading
+        the whole gallery. The database is checked at most once every
+        GALLERY_REFRESH_INTERVAL seconds unless forced.
+
+        Returns
+        -------
+        changed : bool
+            True if the gallery was changed
         """
-        self.students = self.db.get_all_faces()
+        now = time.monotonic()
+        if not force and now - self.gallery_checked_at < GALLERY_REFRESH_INTERVAL:
+            return False
+        self.gallery_checked_at = now
+
+        changes = self.db.get_face_changes(self.gallery_revision)
+        for revision, operation, face_id, student in changes:
+            self.display_images.invalidate(face_id)
+            if operation == "delete":
+                self.gallery.remove(face_id)
+            elif student is not None:
+                self.gallery.add(student, student.encodings)
+            self.gallery_revision = revision
+
+        if changes:
+            logger.info(f"Gallery refreshed to revision {self.gallery_revision}, {len(self.gallery)} students")
+        return len(changes) > 0
 
-        for student in self.students:
-            face_encoding = np.array(json.loads(student.encodings))
-            self.known_face_encodings.append(face_encoding)
-            self.known_face_names.append(student.name)
+    ############################################################
+    # write the pending attendance and close the database
+    ############################################################
+    def close(self):
+        if self.state.preview is not None:
+            self.state.preview.close()
+        if self.attendance is not None:
+            self.attendance.close()
+        self.db.close_db()
+        if self.events is not None:
+            self.events.close()
+        TRACER.write()
 
     ############################################################
     # convert numpy array into json string
@@ -124,155 +351,40 @@ class FaceRecognition:
     ############################################################
     # run face recognition
     ############################################################
-    def run_recognition(self):
+    def run_recognition(self, source=0):
         """
         image recognition start from here
         """
 
         # obtain video capture device
-        video_capture = cv2.VideoCapture(0)
-
-        # check is the camera is opened or not
-        if not video_capture.isOpened():
-            sys.exit("Video source not opened...")
+        video_capture = open_video_source(source)
 
+        result = FrameResult()
         while True:
-            ret, frame = video_capture.read()
-
-            # Displaying the camera dimensions
-            width = video_capture.get(3)
-            height = video_capture.get(4)
-            fps = video_capture.get(5)
-            logger.debug(f"Camera width x height x fps: {width} x {height} x {fps}")
-
-            # if no frame captured, continue
-            if not ret:
-                continue
-
-            # if the frame is marked for processing, then start recognition
-            if self.process_current_frame:
-                # create a small frame from the video capture inputer
-                small_frame = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
-                rgb_small_frame = np.ascontiguousarray(small_frame[:, :, ::-1])
-
-                # find all the faces in the current frame
-                self.face_locations = face_recognition.face_locations(rgb_small_frame)
-                # find all encoding for the face available in the freame
-                self.face_encodings = face_recognition.face_encodings(rgb_small_frame, self.face_locations)
-
-                # this
-                self.face_names = []
-
-                name = "Unknown"
-                confidence = "Unknown"
-
-                for face_encoding in self.face_encodings:
-                    matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-                    face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-                    logger.debug(f"Face distances: {face_distances}")
-                    best_match_index = np.argmin(face_distances)
-
-                    if matches[best_match_index]:
-                        name = self.known_face_names[best_match_index]
-                        confidence = face_confidence(face_distances[best_match_index])
-                        found_student = self.students[best_match_index]
-                        logger.debug(f'Face confidence: {confidence}')
-
-                    self.face_names.append(f"{name}")
-
-            # logger.debug(f'name x confidence level: {name} x {confidence}')
-            self.process_current_frame = not self.process_current_frame
-
-            logger.debug(f"Face locations: {self.face_locations}")
-            logger.debug(f"Face names: {self.face_names}")
-
-            # display annotations
-            for (top, right, bottom, left), name in zip(self.face_locations, self.face_names):
-                top *= 4
-                right *= 4
-                bottom *= 4
-                left *= 4
-                self.prepare_bounds_box(frame, name, top, right, bottom, left)
-                # enable this break, if you like to display only one detection
-                break
+            with TRACER.frame(camera=self.state.name):
+                timings = {}
+                with timed(timings, "capture"):
+                    ret, frame = video_capture.read()
 
-            logger.debug(f"No of face locations found : {len(self.face_locations)}")
-
-            # make the video to 640 x 480 and display it with bound box
-            small_frame = cv2.resize(frame, (0, 0), fx=factor, fy=factor)
-            bg_image[
-                start_y: start_y + int(height * factor),
-                start_x: start_x + int(width * factor),
-            ] = small_frame
-
-            # mode the application is waiting to find face in the video
-            if len(self.face_locations) == 0:
-                self.current_mode = CurrentMode.Waiting.value
-                self.counter = 0
-                self.attendance_marked = False
-                bg_image[mp_y: mp_y + mp_h, mp_x: mp_x + mp_w] = mode_images[self.current_mode]
-
-            # face found and no student information in the database
-            if name == "Unknown" and len(self.face_locations) > 0:
-                self.current_mode = CurrentMode.Unknown.value
-                bg_image[mp_y: mp_y + mp_h, mp_x: mp_x + mp_w] = mode_images[self.current_mode]
-
-            # face and student details found in the database
-            if name != "Unknown" and len(self.face_locations) > 0:
-                if self.counter == 0:
-                    self.counter = 1
-                else:
-                    self.counter += 1
-
-                if self.counter <= ACCEPT_COUNTER:
-                    self.current_mode = CurrentMode.Found.value
-
-                elif self.counter > ACCEPT_COUNTER and self.attendance_marked is False:
-                    logger.debug("********* performing attendance insert *********")
-                    timediff = self.db.get_time_diff(found_student.face_id)
-                    logger.debug(f"Time diff: {timediff}")
-                    if timediff == 0 or timediff > ATTENDANCE_TIME_DELTA:
-                        uid = self.db.insert_attenance_details(found_student.face_id,
-                                                               found_student.filename,
-                                                               found_student.name,
-                                                               found_student.course)
-                        if len(uid) > 0:
-                            logger.success("********* attendance insert SUCCESS *********")
-                            self.attendance_marked = True
-                        self.current_mode = CurrentMode.Marked.value
-                    else:
-                        logger.info("********* attendance ALREADY marked *********")
-                        self.current_mode = CurrentMode.AlreadyMarked.value
-
-                bg_image[mp_y: mp_y + mp_h, mp_x: mp_x + mp_w] = mode_images[self.current_mode]
-
-                if self.counter <= ACCEPT_COUNTER and self.current_mode == CurrentMode.Found.value:
-                    student_image = cv2.imread(f"assets/faces/{found_student.filename}")
-                    logger.debug(f"Student image width:  {student_image.shape[0]}")
-                    logger.debug(f"Student image height:, {student_image.shape[1]}")
-                    student_small_frame = cv2.resize(student_image, (st_w, st_h))
-                    bg_image[st_y: st_y + st_h, st_x: st_x + st_w] = student_small_frame
-                    cv2.putText(bg_image, name, (1465, 725), cv2.FONT_HERSHEY_DUPLEX, 1, (121, 9, 238), 2)
-                    cv2.putText(bg_image, found_student.course, (1465, 765),
-                                cv2.FONT_HERSHEY_DUPLEX, 1, (255, 0, 0), 2)
-                    cv2.putText(bg_image, found_student.course, (1465, 765),
-                                cv2.FONT_HERSHEY_DUPLEX, 1, (255, 0, 0), 2)
-
-            logger.debug(f"Counter: {self.counter}")
-
-            logger.debug(f"Current mode: {self.current_mode}")
-            if (self.current_mode == CurrentMode.AlreadyMarked.value or
-                self.current_mode == CurrentMode.Found.value or
-                    self.current_mode == CurrentMode.Marked.value) and self.counter > RESET_COUNTER:
-                logger.debug("**************** RESTING THE COUNTER ************************")
-                self.counter = 0
-                self.current_mode = CurrentMode.Waiting.value
-                self.attendance_marked = False
-                # found_student = None
-                # bg_image[mp_y: mp_y + mp_h, mp_x: mp_x + mp_w] = mode_images[self.current_mode]
+                # if no frame captured, continue
+                if not ret:
+                    continue
+
+                # pick up students registered or deleted since start
+                self.refresh_gallery()
+
+                # if the frame is marked for processing, then start recognition
+                if self.state.process_current_frame:
+                    result = self.recognize_frame(frame)
+                self.state.process_current_frame = not self.state.process_current_frame
+
+                self.update_mode(result)
+                with timed(timings, "render"):
+                    self.render(frame, result)
+                self.observe_stages(timings)
 
             # show final background image
-            cv2.imshow("Attendence System using Face Recognition", bg_image)
+            cv2.imshow("Attendence System using Face Recognition", self.state.canvas)
             # waiting for esc or q key
             key = cv2.waitKey(1000)
             if key == 27 or key == ord("q"):
@@ -282,6 +394,374 @@ class FaceRecognition:
         video_capture.release()
         cv2.destroyAllWindows()
 
+    ############################################################
+    # run face recognition with capture, recognition and
+    # rendering in separate threads
+    ############################################################
+    def run_pipeline(self, source=0):
+        """
+        Pipelined version of run_recognition. A grabber thread keeps the
+        latest camera frame, a worker thread recognizes the newest frame
+        available (stale frames are dropped) and this thread renders at
+        camera rate. The mode counter advances on elapsed time, not per
+        result.
+        """
+        video_capture = open_video_source(source)
+
+        stop = threading.Event()
+        slot = FrameSlot()
+        results = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        QUEUE_DEPTH.set_function(results.qsize, queue="pipeline_results")
+        grabber = FrameGrabber(video_capture, slot, stop)
+        worker = RecognitionWorker(slot, self.recognize_frame, results, stop)
+        grabber.start()
+        worker.start()
+
+        result = FrameResult()
+        sequence = 0
+        try:
+            while True:
+                sequence, frame = slot.wait(sequence, timeout=1.0)
+                if frame is None:
+                    if slot.closed:
+                        break
+                    continue
+
+                # pick up students registered or deleted since start
+                self.refresh_gallery()
+
+                # take the newest recognition result, if there is one
+                try:
+                    _, result = results.get_nowait()
+                    self.update_mode(result)
+                except queue.Empty:
+                    pass
+
+                with TRACER.frame("render", camera=self.state.name):
+                    # the grabber shares the frame with the worker, draw on a copy
+                    timings = {}
+                    with timed(timings, "render"):
+                        self.render(frame.copy(), result)
+                    self.observe_stages(timings)
+
+                cv2.imshow("Attendence System using Face Recognition", self.state.canvas)
+                key = cv2.waitKey(1)
+                if key == 27 or key == ord("q"):
+                    break
+        finally:
+            stop.set()
+            grabber.join(timeout=2)
+            worker.join(timeout=2)
+            video_capture.release()
+            cv2.destroyAllWindows()
+
+    ############################################################
+    # run face recognition without any window, emitting events
+    ############################################################
+    def run_headless(self, source=0):
+        """
+        Recognize every frame of the source without compositing or showing
+        anything, for cameras without a screen, servers and containers.
+        The recognitions and the attendance are reported as events. Stops
+        at the end of the source or on Ctrl+C.
+        """
+        video_capture = open_video_source(source)
+        self.emit("started", source=str(source), detector=self.detector.name, students=len(self.gallery))
+
+        previous = self.state.last_result
+        try:
+            while True:
+                with TRACER.frame(camera=self.state.name):
+                    timings = {}
+                    with timed(timings, "capture"):
+                        ret, frame = video_capture.read()
+                    if not ret:
+                        break
+                    self.observe_stages(timings)
+
+                    # pick up students registered or deleted since start
+                    self.refresh_gallery()
+
+                    result = self.recognize_frame(frame)
+                    self.update_mode(result)
+                    self.publish_preview(frame, result)
+                    # report new results with faces, and the first one without
+                    if result is not previous and (result.face_locations or previous.face_locations):
+                        self.emit_recognition(result)
+                    previous = result
+        except KeyboardInterrupt:
+            logger.info("stopped by the user")
+        finally:
+            video_capture.release()
+            self.emit("stopped", source=str(source), frames=self.state.frames)
+
+    ############################################################
+    # write an event if there is an event writer
+    ############################################################
+    def emit(self, event_type: str, **fields):
+        if self.events is not None:
+            self.events.emit(event_type, **fields)
+
+    ############################################################
+    # event of a recognized frame
+    ############################################################
+    def emit_recognition(self, result: FrameResult, state: CameraState = None):
+        if self.events is None:
+            return
+        state = state or self.state
+        faces = []
+        for index, (top, right, bottom, left) in enumerate(result.face_locations):
+            student = result.students[index] if index < len(result.students) else None
+            distance = float(result.distances[index]) if index < len(result.distances) else math.inf
+            faces.append({
+                "face_id": student.face_id if student is not None else None,
+                "name": result.face_names[index] if index < len(result.face_names) else "Unknown",
+                "course": student.course if student is not None else None,
+                # an empty gallery pads with inf, which is not valid JSON
+                "distance": round(distance, 4) if math.isfinite(distance) else None,
+                # top, right, bottom, left in full frame pixels
+                "box": [round(value / result.scale) for value in (top, right, bottom, left)],
+            })
+        self.events.emit("recognition", camera=state.name, frame=state.frames, mode=state.current_mode,
+                         faces=faces, timings=result.timings)
+
+    ############################################################
+    # event of an attendance write
+    ############################################################
+    def emit_attendance(self, status: str, student, state: CameraState):
+        MARKS.inc(camera=state.name, status=status)
+        self.emit("attendance", camera=state.name, status=status,
+                  face_id=student.face_id, name=student.name, course=student.course)
+
+    ############################################################
+    # stage times of a frame into the metrics
+    ############################################################
+    def observe_stages(self, timings: dict, state: CameraState = None):
+        state = state or self.state
+        for stage, milliseconds in timings.items():
+            FRAME_STAGE_SECONDS.observe(milliseconds / 1000, camera=state.name, stage=stage)
+
+    ############################################################
+    # find and identify the faces in a frame
+    ############################################################
+    def recognize_frame(self, frame, state: CameraState = None) -> FrameResult:
+        """
+        Detect, encode and match the faces of the given camera frame.
+        """
+        state = state or self.state
+        timings = {}
+        # the root span of a frame in the pipeline worker thread
+        with TRACER.frame("recognize", camera=state.name):
+            # nothing has moved, the faces are where they were
+            with timed(timings, "motion"):
+                changed = state.motion_gate.changed(frame)
+            if not changed:
+                self.observe_stages(timings, state)
+                return state.last_result
+
+            with timed(timings, "resize"):
+                rgb_small_frame = prepare_frame(frame, self.detector.scale)
+            face_locations, face_encodings = detect_and_encode(rgb_small_frame,
+                                                               state.tracker.fresh_locations(),
+                                                               self.detector, timings)
+            return self.match_faces(face_locations, face_encodings, state, timings)
+
+    ############################################################
+    # identify the detected faces
+    ############################################################
+    def match_faces(self, face_locations, face_encodings, state: CameraState = None,
+                    timings: dict = None) -> FrameResult:
+        """
+        Match the newly encoded faces against the gallery, the other faces
+        keep the identity of their track.
+        """
+        state = state or self.state
+        timings = {} if timings is None else timings
+        # the render thread of the pipeline expires the tracks meanwhile
+        with timed(timings, "match"), state.tracker.lock:
+            tracks = state.tracker.update(face_locations)
+
+            # match all the new faces against all the students in one go
+            encoded = [index for index, encoding in enumerate(face_encodings) if encoding is not None]
+            if encoded:
+                identities = self.gallery.identify([face_encodings[index] for index in encoded])
+                for index, (student, face_distance) in zip(encoded, identities):
+                    # formatted only when debug messages are logged
+                    logger.debug("Best face distance: {}", face_distance)
+                    if student is not None:
+                        logger.opt(lazy=True).debug("Face confidence: {}", lambda: face_confidence(face_distance))
+                    tracks[index].identify(student, face_distance)
+            students = [track.student for track in tracks]
+            matched = [track.matched for track in tracks]
+            distances = [track.distance for track in tracks]
+
+        face_names = [student.name if student is not None else "Unknown" for student in students]
+
+        logger.debug("Face locations: {}", face_locations)
+        logger.debug("Face names: {}", face_names)
+        state.frames += 1
+        state.last_result = FrameResult(face_locations, face_names, students, self.detector.scale,
+                                        distances, timings, matched)
+        self.observe_stages(timings, state)
+        FRAMES.inc(camera=state.name)
+        FACES.inc(len(face_locations), camera=state.name)
+        UNKNOWN_FACES.inc(students.count(None), camera=state.name)
+        return state.last_result
+
+    ############################################################
+    # mode state machine and attendance marking
+    ############################################################
+    def update_mode(self, result: FrameResult, state: CameraState = None):
+        """
+        Move the application mode of the camera forward with the recognition
+        result and mark the attendance once the student is accepted. The
+        result of an unchanged frame is shown again at camera rate, so the
+        counter advances once per MODE_STEP_SECONDS rather than per call.
+        A student identified from a track is shown, but is only accepted
+        and marked once a fresh encoding of the face matches the gallery.
+        """
+        state = state or self.state
+        # outcome of the attendance written in the background
+        if state.pending_mark is not None and state.pending_mark.done():
+            if state.pending_mark.result():
+                logger.success("********* attendance insert SUCCESS *********")
+                if state.current_mode == CurrentMode.Found.value:
+                    state.current_mode = CurrentMode.Marked.value
+            else:
+                # the writer keeps the row and writes it later, marking
+                # again would write the attendance twice
+                logger.error("********* attendance insert FAILED, retried in the background *********")
+            state.pending_mark = None
+
+        # start over once the student has been shown long enough
+        if (state.current_mode == CurrentMode.AlreadyMarked.value or
+            state.current_mode == CurrentMode.Found.value or
+                state.current_mode == CurrentMode.Marked.value) and state.counter > RESET_COUNTER:
+            logger.debug("**************** RESTING THE COUNTER ************************")
+            state.counter = 0
+            state.current_mode = CurrentMode.Waiting.value
+            state.attendance_marked = False
+
+        found_student = result.found_student
+        state.found_student = found_student
+
+        # mode the application is waiting to find face in the video
+        if len(result.face_locations) == 0:
+            state.current_mode = CurrentMode.Waiting.value
+            state.counter = 0
+            state.attendance_marked = False
+
+        # face found and no student information in the database
+        elif found_student is None:
+            state.current_mode = CurrentMode.Unknown.value
+
+        # face and student details found in the database
+        else:
+            # a tracked identity may belong to another face, it is only
+            # accepted once the encoding of the face matches it again
+            accepted = result.student_matched or state.attendance_marked
+            now = time.monotonic()
+            if now - state.last_step >= MODE_STEP_SECONDS and (state.counter < ACCEPT_COUNTER or accepted):
+                state.counter += 1
+                state.last_step = now
+            if state.counter >= ACCEPT_COUNTER and not accepted:
+                state.expire_identities()
+
+            if state.counter <= ACCEPT_COUNTER:
+                state.current_mode = CurrentMode.Found.value
+
+            elif accepted and state.attendance_marked is False and state.pending_mark is None:
+                logger.debug("********* performing attendance insert *********")
+                timings = {}
+                with timed(timings, "db"):
+                    timediff = self.db.get_time_diff(found_student.face_id, max_age=ATTENDANCE_TIME_DELTA)
+                self.observe_stages(timings, state)
+                logger.debug("Time diff: {}", timediff)
+                if timediff == 0 or timediff > ATTENDANCE_TIME_DELTA:
+                    # written by the attendance thread, the mode turns to
+                    # Marked when the write is confirmed
+                    state.pending_mark = self.attendance.submit(found_student.face_id,
+                                                                found_student.filename,
+                                                                found_student.name,
+                                                                found_student.course)
+                    # reported from the writer thread as soon as it is known
+                    state.pending_mark.add_done_callback(
+                        lambda future, student=found_student: self.emit_attendance(
+                            "marked" if future.result() else "failed", student, state))
+                    state.attendance_marked = True
+                    state.current_mode = CurrentMode.Found.value
+                else:
+                    logger.info("********* attendance ALREADY marked *********")
+                    if state.current_mode != CurrentMode.AlreadyMarked.value:
+                        self.emit_attendance("already_marked", found_student, state)
+                    state.current_mode = CurrentMode.AlreadyMarked.value
+
+        logger.debug("{} counter: {}, current mode: {}", state.name, state.counter, state.current_mode)
+
+    ############################################################
+    # compose the kiosk screen
+    ############################################################
+    def render(self, frame, result: FrameResult, state: CameraState = None):
+        """
+        Draw the camera frame, the mode panel and the found student into
+        the screen of the camera.
+        """
+        state = state or self.state
+        canvas = state.canvas
+        small_frame = self.annotate(frame, result)
+        height, width = small_frame.shape[:2]
+        canvas[start_y: start_y + height, start_x: start_x + width] = small_frame
+        self.publish_preview(frame, result, state, small_frame)
+
+        canvas[mp_y: mp_y + mp_h, mp_x: mp_x + mp_w] = mode_images[state.current_mode]
+
+        found_student = state.found_student
+        if (found_student is not None and state.counter <= ACCEPT_COUNTER and
+                state.current_mode == CurrentMode.Found.value):
+            student_small_frame = self.display_images.get(found_student.face_id, found_student.filename)
+            if student_small_frame is not None:
+                canvas[st_y: st_y + st_h, st_x: st_x + st_w] = student_small_frame
+            cv2.putText(canvas, found_student.name, (1465, 725), cv2.FONT_HERSHEY_DUPLEX, 1, (121, 9, 238), 2)
+            cv2.putText(canvas, found_student.course, (1465, 765),
+                        cv2.FONT_HERSHEY_DUPLEX, 1, (255, 0, 0), 2)
+
+    ############################################################
+    # draw the face boxes and shrink the frame
+    ############################################################
+    def annotate(self, frame, result: FrameResult):
+        """
+        Draw the bounds box into the frame and return it shrunk to the
+        size shown on the screen.
+        """
+        # display annotations
+        for (top, right, bottom, left), name in zip(result.face_locations, result.face_names):
+            top = int(top / result.scale)
+            right = int(right / result.scale)
+            bottom = int(bottom / result.scale)
+            left = int(left / result.scale)
+            self.prepare_bounds_box(frame, name, top, right, bottom, left)
+            # enable this break, if you like to display only one detection
+            break
+
+        # make the video to 640 x 480 and display it with bound box
+        return cv2.resize(frame, (0, 0), fx=factor, fy=factor)
+
+    ############################################################
+    # publish the annotated frame for the web preview
+    ############################################################
+    def publish_preview(self, frame, result: FrameResult, state: CameraState = None, small_frame=None):
+        """
+        Publish the annotated frame and the mode of the camera, at most at
+        the preview frame rate. Without a rendered ``small_frame`` the
+        frame is annotated here, only when a preview frame is due.
+        """
+        state = state or self.state
+        if state.preview is None or not state.preview.due():
+            return
+        if small_frame is None:
+            small_frame = self.annotate(frame.copy(), result)
+        state.preview.publish(small_frame, state.current_mode)
+
     ############################################################
     # Prepare bounds box
     ############################################################
@@ -316,9 +796,92 @@ class FaceRecognition:
             )
 
 
+############################################################
+# detector command line options
+############################################################
+def add_detector_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--detector", choices=list(DETECTORS), default="hog",
+                        help="face detector backend (default: hog)")
+    parser.add_argument("--scale", type=float, default=DETECTION_SCALE,
+                        help=f"frame scale used for detection (default: {DETECTION_SCALE})")
+    parser.add_argument("--upsample", type=int, default=1,
+                        help="times the detector upsamples the frame to find small faces (default: 1)")
+    parser.add_argument("--roi", type=lambda value: tuple(int(v) for v in value.split(",")),
+                        help="only detect inside x,y,w,h of the full frame")
+    parser.add_argument("--motion-threshold", type=float, default=MOTION_THRESHOLD,
+                        help=f"skip detection while the frame changes less (0 disables, default: {MOTION_THRESHOLD})")
+
+
+def detector_from_arguments(args) -> FaceDetector:
+    return create_detector(args.detector, scale=args.scale, upsample=args.upsample, roi=args.roi)
+
+
+############################################################
+# gallery command line options
+############################################################
+def add_gallery_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--matcher", choices=["exact", "ivf"], default="exact",
+                        help="exact scan or approximate IVF index for large galleries (default: exact)")
+    parser.add_argument("--nprobe", type=int, default=IVF_NPROBE,
+                        help=f"IVF lists searched per face, higher gives better recall (default: {IVF_NPROBE})")
+
+
+def gallery_from_arguments(args) -> FaceGallery:
+    return FaceGallery(index=args.matcher, nprobe=args.nprobe)
+
+
+############################################################
+# tracing command line options
+############################################################
+def add_trace_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--trace", metavar="FILE",
+                        help="write a Chrome trace (chrome://tracing, ui.perfetto.dev) of sampled frames on exit")
+    parser.add_argument("--trace-sample", type=float, default=TRACE_SAMPLE,
+                        help=f"fraction of the frames traced (default: {TRACE_SAMPLE})")
+
+
+def configure_tracing(args):
+    if args.trace:
+        TRACER.configure(args.trace, args.trace_sample)
+
+
 ############################################################
 # main
 ############################################################
 if __name__ == "__main__":
-    fr = FaceRecognition()
-    fr.run_recognition()
+    parser = argparse.ArgumentParser(description="Student attendance using face recognition")
+    parser.add_argument("--source", default="0",
+                        help="camera index, video file or stream url (default: 0)")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="run capture, recognition and display in separate threads")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not open a window, report the recognitions as JSON lines events")
+    parser.add_argument("--events", default="-",
+                        help="file the headless events are appended to (default: - for stdout)")
+    parser.add_argument("--preview", nargs="?", const="camera", metavar="NAME",
+                        help="publish the annotated frames to the web app under this camera name (default: camera)")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the Prometheus metrics at http://0.0.0.0:PORT/metrics")
+    add_detector_arguments(parser)
+    add_gallery_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    configure_tracing(args)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    events = open_event_writer(args.events) if args.headless else None
+    fr = FaceRecognition(detector_from_arguments(args), args.motion_threshold, gallery_from_arguments(args),
+                         events)
+    if args.preview:
+        fr.state.name = args.preview
+        fr.state.preview = PreviewPublisher(args.preview)
+    try:
+        if args.headless:
+            fr.run_headless(args.source)
+        elif args.pipeline:
+            fr.run_pipeline(args.source)
+        else:
+            fr.run_recognition(args.source)
+    finally:
+        fr.close()
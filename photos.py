@@ -0,0 +1,237 @@
+import argparse
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+FACES_FOLDER = "assets/faces"
+MAX_PHOTO_SIDE = 1024  # enrolled photos are shrunk to fit in this size
+DISPLAY_SIZE = (300, 400)  # the student panel of the kiosk (st_w, st_h in main.py)
+THUMBNAIL_SIZE = (112, 150)  # the list pages show 75 pixels high, twice for HiDPI screens
+CROP_SIZE = 160  # the square face crop
+CROP_MARGIN = 0.3  # margin around the face location in the crop
+JPEG_QUALITY = 90
+DISPLAY_CACHE_SIZE = 256  # display images kept in memory, 360 KB each
+
+# variant name -> (sub folder, size), a variant is saved as <face id>.jpg
+VARIANTS = {
+    "display": ("display", DISPLAY_SIZE),
+    "thumbnail": ("thumbs", THUMBNAIL_SIZE),
+    "crop": ("crops", (CROP_SIZE, CROP_SIZE)),
+}
+
+
+################################################################################
+# path of a photo variant
+################################################################################
+def variant_path(face_id: str, variant: str, folder: str = FACES_FOLDER) -> str:
+    return os.path.join(folder, VARIANTS[variant][0], f"{face_id}.jpg")
+
+
+################################################################################
+# shrink the image to fit in a box
+################################################################################
+def shrink(image: np.ndarray, max_side: int = MAX_PHOTO_SIDE) -> np.ndarray:
+    height, width = image.shape[:2]
+    ratio = max_side / max(height, width)
+    if ratio >= 1:
+        return image
+    return cv2.resize(image, (round(width * ratio), round(height * ratio)), interpolation=cv2.INTER_AREA)
+
+
+################################################################################
+# crop the image to the aspect ratio of the size and resize
+################################################################################
+def fit(image: np.ndarray, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Cut the image to the aspect ratio of ``size`` (width, height) around
+    its center and resize it to that size.
+    """
+    height, width = image.shape[:2]
+    (target_width, target_height) = size
+    crop_width = min(width, round(height * target_width / target_height))
+    crop_height = min(height, round(width * target_height / target_width))
+    x = (width - crop_width) // 2
+    y = (height - crop_height) // 2
+    image = image[y: y + crop_height, x: x + crop_width]
+    interpolation = cv2.INTER_AREA if crop_width > target_width else cv2.INTER_LINEAR
+    return cv2.resize(image, size, interpolation=interpolation)
+
+
+################################################################################
+# square crop around the face
+################################################################################
+def face_crop(image: np.ndarray, face_location: Tuple[int, int, int, int]) -> np.ndarray:
+    (top, right, bottom, left) = face_location
+    side = round(max(bottom - top, right - left) * (1 + 2 * CROP_MARGIN))
+    center_x = (left + right) // 2
+    center_y = (top + bottom) // 2
+    height, width = image.shape[:2]
+    x = min(max(center_x - side // 2, 0), max(width - side, 0))
+    y = min(max(center_y - side // 2, 0), max(height - side, 0))
+    return fit(image[y: y + side, x: x + side], (CROP_SIZE, CROP_SIZE))
+
+
+################################################################################
+# write an image as jpeg
+################################################################################
+def write_jpeg(path: str, image: np.ndarray):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if not cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY]):
+        raise OSError(f"unable to write {path}")
+
+
+################################################################################
+# write the display and list variants of a photo
+################################################################################
+def save_variants(face_id: str, image: np.ndarray, face_location: Optional[Tuple[int, int, int, int]] = None,
+                  folder: str = FACES_FOLDER):
+    """
+    Write the display (kiosk panel) and thumbnail (list pages) variants of
+    the BGR photo, and the face crop if the face location is known.
+    """
+    write_jpeg(variant_path(face_id, "display", folder), fit(image, DISPLAY_SIZE))
+    write_jpeg(variant_path(face_id, "thumbnail", folder), fit(image, THUMBNAIL_SIZE))
+    if face_location is not None:
+        write_jpeg(variant_path(face_id, "crop", folder), face_crop(image, face_location))
+
+
+################################################################################
+# delete a photo and its variants
+################################################################################
+def remove_photo(face_id: str, filename: str, folder: str = FACES_FOLDER):
+    paths = [os.path.join(folder, filename)] + [variant_path(face_id, variant, folder) for variant in VARIANTS]
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+################################################################################
+# panel image of a student for the kiosk
+################################################################################
+def load_display_image(face_id: str, filename: str, folder: str = FACES_FOLDER) -> Optional[np.ndarray]:
+    """
+    Read the display variant of the student photo, or make it from the
+    original for students enrolled before the variants existed.
+    """
+    image = cv2.imread(variant_path(face_id, "display", folder))
+    if image is not None:
+        return image
+    image = cv2.imread(os.path.join(folder, filename))
+    if image is None:
+        logger.error(f"photo of student {face_id} not found")
+        return None
+    return fit(image, DISPLAY_SIZE)
+
+
+class DisplayImageCache:
+    """
+    Least recently used cache of the student display images of the kiosk,
+    keyed by face id, so showing the panel of a found student is a copy
+    from memory instead of a read and a JPEG decode.
+    """
+
+    def __init__(self, size: int = DISPLAY_CACHE_SIZE, folder: str = FACES_FOLDER):
+        self.size = size
+        self.folder = folder
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        # bumped on every invalidation, images loaded before are not cached
+        self.generation = 0
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    ############################################################
+    # display image of a student
+    ############################################################
+    def get(self, face_id: str, filename: str) -> Optional[np.ndarray]:
+        with self.lock:
+            image = self.images.get(face_id)
+            if image is not None:
+                self.images.move_to_end(face_id)
+                return image
+            generation = self.generation
+
+        # read without the lock, the render loop never waits for a prefill
+        image = load_display_image(face_id, filename, self.folder)
+        if image is not None:
+            self.put(face_id, image, generation)
+        return image
+
+    ############################################################
+    # add an image, dropping the least recently used ones
+    ############################################################
+    def put(self, face_id: str, image: np.ndarray, generation: int):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.images[face_id] = image
+            self.images.move_to_end(face_id)
+            while len(self.images) > self.size:
+                self.images.popitem(last=False)
+
+    ############################################################
+    # forget the image of a changed or deleted student
+    ############################################################
+    def invalidate(self, face_id: str):
+        with self.lock:
+            self.images.pop(face_id, None)
+            self.generation += 1
+
+    ############################################################
+    # forget all the images
+    ############################################################
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.generation += 1
+
+    ############################################################
+    # load the images of the students in the background
+    ############################################################
+    def prefill(self, students: list) -> threading.Thread:
+        """
+        Load the display images of the students in a background thread,
+        until the cache is full.
+        """
+        def load():
+            for student in students:
+                if len(self.images) >= self.size:
+                    break
+                if student.face_id not in self.images:
+                    self.get(student.face_id, student.filename)
+            logger.debug(f"{len(self.images)} student display images cached")
+
+        thread = threading.Thread(target=load, name="display-cache", daemon=True)
+        thread.start()
+        return thread
+
+
+################################################################################
+# main
+################################################################################
+if __name__ == "__main__":
+    from database import FacesDatabase
+
+    parser = argparse.ArgumentParser(description="Create the missing photo variants of the enrolled students")
+    parser.add_argument("--force", action="store_true", help="create the variants again for every student")
+    args = parser.parse_args()
+
+    db = FacesDatabase()
+    created = 0
+    for student in db.get_all_faces():
+        if not args.force and os.path.exists(variant_path(student.face_id, "display")):
+            continue
+        image = cv2.imread(os.path.join(FACES_FOLDER, student.filename))
+        if image is None:
+            logger.warning(f"photo of {student.name} not found: {student.filename}")
+            continue
+        save_variants(student.face_id, shrink(image))
+        created += 1
+    db.close_db()
+    logger.success(f"created the photo variants of {created} students")
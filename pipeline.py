@@ -0,0 +1,130 @@
+import queue
+import threading
+from typing import Callable, Optional, Tuple
+
+from loguru import logger
+
+
+################################################################################
+# put into a bounded queue, dropping the oldest item when it is full
+################################################################################
+def put_latest(q: queue.Queue, item):
+    """
+    Put the item into the queue. If the queue is full the oldest item is
+    dropped, so a slow consumer always gets the most recent data.
+    """
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                pass
+
+
+class FrameSlot:
+    """
+    Holds only the latest camera frame. Readers wait for a frame newer than
+    the one they have seen, older frames are never queued.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._frame = None
+        self._sequence = 0
+        self.closed = False
+
+    ############################################################
+    # publish a new frame
+    ############################################################
+    def publish(self, frame):
+        with self._condition:
+            self._frame = frame
+            self._sequence += 1
+            self._condition.notify_all()
+
+    ############################################################
+    # no more frames will come
+    ############################################################
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    ############################################################
+    # wait for a frame newer than the given sequence number
+    ############################################################
+    def wait(self, after: int, timeout: Optional[float] = None) -> Tuple[int, object]:
+        """
+        Wait for a frame newer than the sequence number ``after``.
+
+        Returns
+        -------
+        (sequence, frame) : tuple
+            The frame is None on timeout or when the slot is closed.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence > after or self.closed, timeout)
+            if self._sequence > after:
+                return self._sequence, self._frame
+            return after, None
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Reads the video capture as fast as the camera delivers and keeps the
+    latest frame in the slot.
+    """
+
+    def __init__(self, video_capture, slot: FrameSlot, stop: threading.Event, name: str = "grabber"):
+        super().__init__(name=name, daemon=True)
+        self.video_capture = video_capture
+        self.slot = slot
+        self.stop = stop
+
+    def run(self):
+        failures = 0
+        while not self.stop.is_set():
+            ret, frame = self.video_capture.read()
+            if not ret:
+                failures += 1
+                # a video file has ended or the camera is gone
+                if failures > 100:
+                    logger.warning(f"{self.name}: no frames from video source, stopping")
+                    break
+                continue
+            failures = 0
+            self.slot.publish(frame)
+        self.slot.close()
+
+
+class RecognitionWorker(threading.Thread):
+    """
+    Runs the recognition on the latest frame. Frames which arrive while
+    the worker is busy are skipped instead of queued.
+    """
+
+    def __init__(self, slot: FrameSlot, recognize: Callable, results: queue.Queue,
+                 stop: threading.Event, name: str = "recognizer"):
+        super().__init__(name=name, daemon=True)
+        self.slot = slot
+        self.recognize = recognize
+        self.results = results
+        self.stop = stop
+
+    def run(self):
+        sequence = 0
+        while not self.stop.is_set():
+            sequence, frame = self.slot.wait(sequence, timeout=0.5)
+            if frame is None:
+                if self.slot.closed:
+                    break
+                continue
+            try:
+                result = self.recognize(frame)
+            except Exception as e:
+                logger.exception(f"{self.name}: recognition failed: {e}")
+                continue
+            put_latest(self.results, (sequence, result))
@@ -0,0 +1,187 @@
+import mmap
+import os
+import re
+import struct
+import time
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+from loguru import logger
+
+PREVIEW_FOLDER = "db/preview"
+PREVIEW_SLOTS = 4  # frames kept in the ring, a reader has this many frames to copy one
+PREVIEW_SLOT_BYTES = 512 * 1024  # largest JPEG of a frame
+PREVIEW_FPS = 10  # frames encoded per second at most
+PREVIEW_QUALITY = 70  # JPEG quality
+PREVIEW_STALE = 5.0  # seconds without a frame before a camera is shown offline
+
+MAGIC = b"APRV"
+# magic, slots, slot bytes, last published sequence
+HEADER = struct.Struct("<4sIIQ")
+# sequence, unix time, jpeg length, mode
+SLOT_HEADER = struct.Struct("<QdI32s")
+HEADER_SIZE = 64
+SLOT_HEADER_SIZE = 64
+
+
+################################################################################
+# ring buffer file of a camera
+################################################################################
+def preview_path(camera: str, folder: str = PREVIEW_FOLDER) -> str:
+    """
+    Path of the preview file of the camera, the name is limited to safe
+    file name characters.
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_.-]+", camera):
+        raise ValueError(f"invalid camera name: {camera}")
+    return os.path.join(folder, f"{camera}.preview")
+
+
+################################################################################
+# cameras publishing a preview
+################################################################################
+def preview_cameras(folder: str = PREVIEW_FOLDER) -> List[str]:
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[:-len(".preview")] for name in os.listdir(folder) if name.endswith(".preview"))
+
+
+class PreviewPublisher:
+    """
+    Ring buffer of the annotated JPEG frames and the mode of one camera.
+
+    The ring lives in a memory mapped file, so the web app in another
+    process reads the frames without any copy through a socket. Each
+    frame is encoded once here, however many viewers there are. A slot is
+    marked as being written (sequence 0) while it changes, readers check
+    its sequence before and after copying it.
+    """
+
+    def __init__(self, camera: str, fps: float = PREVIEW_FPS, slots: int = PREVIEW_SLOTS,
+                 slot_bytes: int = PREVIEW_SLOT_BYTES, folder: str = PREVIEW_FOLDER):
+        self.camera = camera
+        self.interval = 1.0 / fps
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.sequence = 0
+        self.published_at = 0.0
+        self.path = preview_path(camera, folder)
+
+        os.makedirs(folder, exist_ok=True)
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_bytes)
+        # a new file, readers still mapping an old one are not disturbed
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        with open(self.path, "wb") as preview_file:
+            preview_file.truncate(size)
+        self.file = open(self.path, "r+b")
+        self.buffer = mmap.mmap(self.file.fileno(), size)
+        HEADER.pack_into(self.buffer, 0, MAGIC, slots, slot_bytes, 0)
+        logger.info(f"publishing the preview of {camera} in {self.path}")
+
+    ############################################################
+    # a new frame is wanted
+    ############################################################
+    def due(self) -> bool:
+        """
+        True if the last frame is older than the frame interval, checked
+        before annotating and encoding a frame.
+        """
+        return time.monotonic() - self.published_at >= self.interval
+
+    ############################################################
+    # encode and publish a frame
+    ############################################################
+    def publish(self, frame: np.ndarray, mode: str, force: bool = False):
+        if not force and not self.due():
+            return
+        self.published_at = time.monotonic()
+        ok, jpeg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_QUALITY])
+        if not ok or len(jpeg) > self.slot_bytes:
+            logger.warning(f"preview frame of {self.camera} not published ({len(jpeg)} bytes)")
+            return
+
+        self.sequence += 1
+        offset = HEADER_SIZE + (self.sequence % self.slots) * (SLOT_HEADER_SIZE + self.slot_bytes)
+        SLOT_HEADER.pack_into(self.buffer, offset, 0, 0.0, 0, b"")
+        data = offset + SLOT_HEADER_SIZE
+        self.buffer[data: data + len(jpeg)] = jpeg.tobytes()
+        SLOT_HEADER.pack_into(self.buffer, offset, self.sequence, time.time(), len(jpeg),
+                              mode.encode("utf-8")[:32])
+        HEADER.pack_into(self.buffer, 0, MAGIC, self.slots, self.slot_bytes, self.sequence)
+
+    ############################################################
+    # stop publishing and remove the ring
+    ############################################################
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class PreviewReader:
+    """
+    Reads the latest frame of a camera published by PreviewPublisher.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the camera does not publish a preview
+    """
+
+    def __init__(self, camera: str, folder: str = PREVIEW_FOLDER):
+        self.camera = camera
+        self.path = preview_path(camera, folder)
+        with open(self.path, "rb") as preview_file:
+            self.buffer = mmap.mmap(preview_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.slot_bytes, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            self.buffer.close()
+            raise ValueError(f"{self.path} is not a preview file")
+
+    ############################################################
+    # newest frame
+    ############################################################
+    def latest(self, after: int = 0) -> Optional[Tuple[int, bytes, str, float]]:
+        """
+        Copy the newest frame if it is newer than ``after``. A client
+        falling behind skips the frames in between.
+
+        Returns
+        -------
+        frame : tuple
+            (sequence, jpeg, mode, unix time), None if there is no newer frame
+        """
+        for _ in range(3):
+            sequence = HEADER.unpack_from(self.buffer, 0)[3]
+            if sequence <= after:
+                return None
+            offset = HEADER_SIZE + (sequence % self.slots) * (SLOT_HEADER_SIZE + self.slot_bytes)
+            slot_sequence, timestamp, length, mode = SLOT_HEADER.unpack_from(self.buffer, offset)
+            if slot_sequence != sequence:
+                continue
+            data = offset + SLOT_HEADER_SIZE
+            jpeg = self.buffer[data: data + length]
+            # the slot was written again while copying
+            if SLOT_HEADER.unpack_from(self.buffer, offset)[0] != sequence:
+                continue
+            return sequence, jpeg, mode.rstrip(b"\0").decode("utf-8", "replace"), timestamp
+        return None
+
+    ############################################################
+    # state of the camera without copying a frame
+    ############################################################
+    def status(self) -> dict:
+        sequence = HEADER.unpack_from(self.buffer, 0)[3]
+        offset = HEADER_SIZE + (sequence % self.slots) * (SLOT_HEADER_SIZE + self.slot_bytes)
+        _, timestamp, _, mode = SLOT_HEADER.unpack_from(self.buffer, offset)
+        return {"camera": self.camera,
+                "sequence": sequence,
+                "mode": mode.rstrip(b"\0").decode("utf-8", "replace"),
+                "timestamp": timestamp,
+                "online": sequence > 0 and time.time() - timestamp < PREVIEW_STALE}
+
+    def close(self):
+        self.buffer.close()
@@ -0,0 +1,207 @@
+import argparse
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import List
+
+import cv2
+from loguru import logger
+
+from detector import MOTION_THRESHOLD, FaceDetector
+from events import EventWriter, open_event_writer, timed
+from gallery import FaceGallery
+from main import (QUEUE_DEPTH, CameraState, FaceRecognition, add_detector_arguments, add_gallery_arguments,
+                  add_trace_arguments, configure_tracing, detect_and_encode, detector_from_arguments,
+                  gallery_from_arguments, open_video_source, prepare_frame)
+from metrics import serve_metrics
+from pipeline import FrameGrabber, FrameSlot
+from preview import PreviewPublisher
+from tracing import TRACER
+
+
+class Camera:
+    """
+    One video source with its own grabber thread and mode state.
+    """
+
+    def __init__(self, index: int, source, stop: threading.Event, motion_threshold: float, preview: bool = False):
+        self.source = source
+        self.video_capture = open_video_source(source)
+        self.slot = FrameSlot()
+        self.state = CameraState(name=f"camera-{index}", motion_threshold=motion_threshold)
+        if preview:
+            self.state.preview = PreviewPublisher(self.state.name)
+        self.grabber = FrameGrabber(self.video_capture, self.slot, stop, name=f"grabber-{index}")
+        self.sequence = 0
+        # (future, frame, submit time) of the frame being recognized
+        self.pending = None
+        # faces in the last recognized frame
+        self.previous_faces = 0
+
+    @property
+    def finished(self) -> bool:
+        return self.slot.closed and self.pending is None
+
+
+class RecognitionServer:
+    """
+    Recognize the faces of several cameras in one process.
+
+    Detection and encoding run in a shared process pool, so throughput grows
+    with the number of cores. Matching, the mode state machine and the
+    attendance writes stay in this process with a single gallery and a
+    single database connection. Every camera has at most one frame in the
+    pool, newer frames replace older ones while it is busy.
+    """
+
+    def __init__(self, sources: List, workers: int = None, display: bool = True,
+                 detector: FaceDetector = None, motion_threshold: float = MOTION_THRESHOLD,
+                 gallery: FaceGallery = None, events: EventWriter = None, preview: bool = False):
+        self.stop = threading.Event()
+        self.recognition = FaceRecognition(detector, motion_threshold, gallery, events)
+        self.cameras = [Camera(index, source, self.stop, motion_threshold, preview)
+                        for index, source in enumerate(sources)]
+        self.pool = ProcessPoolExecutor(max_workers=workers)
+        self.display = display
+        QUEUE_DEPTH.set_function(lambda: sum(camera.pending is not None for camera in self.cameras),
+                                 queue="recognition_pool")
+
+    ############################################################
+    # send the latest frame of an idle camera to the pool
+    ############################################################
+    def submit(self, camera: Camera):
+        sequence, frame = camera.slot.wait(camera.sequence, timeout=0)
+        if frame is None:
+            return
+        camera.sequence = sequence
+
+        # nothing has moved, show the last result again
+        if not camera.state.motion_gate.changed(frame):
+            self.show(camera, frame, camera.state.last_result)
+            return
+
+        detector = self.recognition.detector
+        future = self.pool.submit(detect_and_encode, prepare_frame(frame, detector.scale),
+                                  camera.state.tracker.fresh_locations(), detector)
+        camera.pending = (future, frame, time.perf_counter())
+
+    ############################################################
+    # match, mark and show a recognized frame
+    ############################################################
+    def complete(self, camera: Camera):
+        future, frame, submitted = camera.pending
+        camera.pending = None
+        try:
+            face_locations, face_encodings = future.result()
+        except Exception as e:
+            logger.exception(f"{camera.state.name}: recognition failed: {e}")
+            return
+
+        # the pool hides the stages, the time in it includes the queueing
+        timings = {"pool": round((time.perf_counter() - submitted) * 1000, 3)}
+        with TRACER.frame(camera=camera.state.name, pool_ms=timings["pool"]):
+            result = self.recognition.match_faces(face_locations, face_encodings, camera.state, timings)
+            self.show(camera, frame, result)
+            if result.face_locations or camera.previous_faces:
+                self.recognition.emit_recognition(result, camera.state)
+        camera.previous_faces = len(result.face_locations)
+
+    ############################################################
+    # step the mode and show the result
+    ############################################################
+    def show(self, camera: Camera, frame, result):
+        self.recognition.update_mode(result, camera.state)
+        if self.display:
+            # the grabber shares the frame with the worker, draw on a copy
+            timings = {}
+            with timed(timings, "render"):
+                self.recognition.render(frame.copy(), result, camera.state)
+            self.recognition.observe_stages(timings, camera.state)
+            cv2.imshow(camera.state.name, camera.state.canvas)
+        else:
+            self.recognition.publish_preview(frame, result, camera.state)
+
+    ############################################################
+    # main loop
+    ############################################################
+    def run(self):
+        for camera in self.cameras:
+            camera.grabber.start()
+
+        try:
+            while not self.stop.is_set():
+                cameras = [camera for camera in self.cameras if not camera.finished]
+                if not cameras:
+                    logger.info("all video sources finished")
+                    break
+
+                # pick up students registered or deleted since start
+                self.recognition.refresh_gallery()
+
+                for camera in cameras:
+                    if camera.pending is None:
+                        self.submit(camera)
+
+                futures = [camera.pending[0] for camera in cameras if camera.pending is not None]
+                if futures:
+                    done, _ = wait(futures, timeout=0.1, return_when=FIRST_COMPLETED)
+                    for camera in cameras:
+                        if camera.pending is not None and camera.pending[0] in done:
+                            self.complete(camera)
+                else:
+                    time.sleep(0.01)
+
+                if self.display:
+                    key = cv2.waitKey(1)
+                    if key == 27 or key == ord("q"):
+                        break
+        finally:
+            self.close()
+
+    ############################################################
+    # release all the resources
+    ############################################################
+    def close(self):
+        self.stop.set()
+        for camera in self.cameras:
+            camera.grabber.join(timeout=2)
+            camera.video_capture.release()
+            if camera.state.preview is not None:
+                camera.state.preview.close()
+        self.pool.shutdown(cancel_futures=True)
+        self.recognition.close()
+        if self.display:
+            cv2.destroyAllWindows()
+
+
+############################################################
+# main
+############################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Face recognition for several cameras")
+    parser.add_argument("--source", action="append", required=True,
+                        help="camera index, video file or stream url, repeat for every camera")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of detection/encoding processes (default: number of cores)")
+    parser.add_argument("--no-display", action="store_true",
+                        help="do not open a window per camera")
+    parser.add_argument("--events",
+                        help="append the recognition and attendance events as JSON lines to this file (- for stdout)")
+    parser.add_argument("--preview", action="store_true",
+                        help="publish the annotated frames of every camera to the web app")
+    parser.add_argument("--metrics-port", type=int,
+                        help="serve the Prometheus metrics at http://0.0.0.0:PORT/metrics")
+    add_detector_arguments(parser)
+    add_gallery_arguments(parser)
+    add_trace_arguments(parser)
+    args = parser.parse_args()
+
+    configure_tracing(args)
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+    server = RecognitionServer(args.source, workers=args.workers, display=not args.no_display,
+                               detector=detector_from_arguments(args), motion_threshold=args.motion_threshold,
+                               gallery=gallery_from_arguments(args),
+                               events=open_event_writer(args.events) if args.events else None,
+                               preview=args.preview)
+    server.run()
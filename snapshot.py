@@ -0,0 +1,156 @@
+import glob
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from database import FacesDatabase, Student
+from gallery import ENCODING_SIZE
+
+SNAPSHOT_FOLDER = "db"
+# the matrix of every export has a file name of its own, named in the index
+SNAPSHOT_MATRIX = "gallery-{revision}-{token}.npy"
+SNAPSHOT_INDEX = "gallery.json"
+SNAPSHOT_RETRIES = 3  # attempts to load a consistent snapshot before reading the database
+
+
+################################################################################
+# write the file next to its final place and swap it in
+################################################################################
+def _atomic_write(path: str, write):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as buffer:
+        write(buffer)
+    os.replace(temp_path, path)
+
+
+################################################################################
+# read the snapshot index
+################################################################################
+def read_index(folder: str = SNAPSHOT_FOLDER) -> dict:
+    """
+    Read the snapshot index, returns an empty dict if there is none.
+    """
+    try:
+        with open(os.path.join(folder, SNAPSHOT_INDEX), "r") as index_file:
+            return json.load(index_file)
+    except (OSError, ValueError):
+        return {}
+
+
+################################################################################
+# export the faces table into a snapshot
+################################################################################
+def export_snapshot(db: FacesDatabase, folder: str = SNAPSHOT_FOLDER) -> int:
+    """
+    Export the encodings of the faces table into an .npy matrix and the
+    student details into a compact JSON index.
+
+    Returns
+    -------
+    revision : int
+        Revision of the faces table the snapshot was taken from
+    """
+    # read the revision first, a change in between makes the snapshot stale
+    revision = db.get_faces_revision()
+    students = db.get_all_faces()
+
+    matrix = np.empty((len(students), ENCODING_SIZE), dtype=np.float32)
+    for row, student in enumerate(students):
+        matrix[row] = student.encodings
+
+    index = {
+        "revision": revision,
+        "count": len(students),
+        "columns": ["id", "name", "course", "face_id", "filename", "join_date"],
+        "rows": [[s.id, s.name, s.course, s.face_id, s.filename, round(s.join_date.timestamp())]
+                 for s in students],
+    }
+
+    # matrix first, the index is the commit point of the snapshot. It names
+    # its own matrix, so a loader never pairs it with another export
+    matrix_file = SNAPSHOT_MATRIX.format(revision=revision, token=uuid.uuid4().hex[:8])
+    index["matrix"] = matrix_file
+    _atomic_write(os.path.join(folder, matrix_file), lambda buffer: np.save(buffer, matrix))
+    _atomic_write(os.path.join(folder, SNAPSHOT_INDEX),
+                  lambda buffer: buffer.write(json.dumps(index, separators=(",", ":")).encode()))
+    remove_old_matrices(folder, matrix_file)
+    logger.success(f"Exported gallery snapshot of {len(students)} faces at revision {revision}.")
+    return revision
+
+
+################################################################################
+# delete the matrices of the previous exports
+################################################################################
+def remove_old_matrices(folder: str, keep: str):
+    """
+    Delete the matrices other than ``keep``. A process which has one mapped
+    keeps reading it, a loader which has not opened it yet loads again.
+    """
+    for path in glob.glob(os.path.join(folder, "gallery*.npy")):
+        if os.path.basename(path) == keep:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            # still open on platforms which do not delete open files
+            pass
+
+
+################################################################################
+# load the snapshot, rebuild it when the faces table has changed
+################################################################################
+def load_snapshot(db: FacesDatabase, folder: str = SNAPSHOT_FOLDER) -> Tuple[List[Student], np.ndarray, int]:
+    """
+    Load the students and a memory mapped encoding matrix. The matrix pages
+    are shared by every process mapping the same snapshot.
+
+    Returns
+    -------
+    (students, encodings, revision) : tuple
+        Student objects, the read-only (N, 128) float32 matrix and the
+        revision of the faces table the snapshot was taken from
+    """
+    for attempt in range(SNAPSHOT_RETRIES):
+        index = read_index(folder)
+        if index.get("revision") != db.get_faces_revision() or "matrix" not in index:
+            logger.info("Gallery snapshot missing or stale, exporting...")
+            export_snapshot(db, folder)
+            index = read_index(folder)
+
+        try:
+            encodings = np.load(os.path.join(folder, index["matrix"]), mmap_mode="r")
+        except (OSError, ValueError, KeyError):
+            # replaced by another export since the index was read
+            logger.warning("Gallery snapshot changed while loading, loading again...")
+            continue
+        if encodings.shape != (index["count"], ENCODING_SIZE):
+            logger.warning("Gallery snapshot is inconsistent, exporting again...")
+            export_snapshot(db, folder)
+            continue
+
+        students = []
+        for row, (id, name, course, face_id, filename, join_date) in enumerate(index["rows"]):
+            students.append(Student(id, name, course, face_id, filename,
+                                    encodings[row], datetime.fromtimestamp(join_date)))
+        return students, encodings, index["revision"]
+
+    # other processes keep exporting, read the faces table directly
+    logger.warning(f"No consistent gallery snapshot after {SNAPSHOT_RETRIES} attempts, reading the database")
+    revision = db.get_faces_revision()
+    students = db.get_all_faces()
+    encodings = np.array([student.encodings for student in students], dtype=np.float32).reshape(-1, ENCODING_SIZE)
+    return students, encodings, revision
+
+
+if __name__ == "__main__":
+    """
+    Export the gallery snapshot
+    """
+    faces_db = FacesDatabase()
+    export_snapshot(faces_db)
+    faces_db.close_db()
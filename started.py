@@ -0,0 +1,6 @@
+import time
+
+# start of the app, the startup times are measured from here. api imports
+# this module first, before fastapi, OpenCV and numpy, whose imports take
+# most of the startup
+STARTED = time.perf_counter()
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import FacesDatabase  # noqa: E402
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Run in an empty folder with a db folder, the database and the journal
+    paths are relative.
+    """
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "db").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def db(workdir):
+    faces_db = FacesDatabase()
+    yield faces_db
+    faces_db.close_db()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from ann import IvfIndex
+from gallery import ENCODING_SIZE, FaceGallery
+from test_gallery import encodings, students
+
+
+def ivf_gallery(matrix: np.ndarray, nprobe: int = 8) -> FaceGallery:
+    gallery = FaceGallery(index="ivf", nprobe=nprobe)
+    gallery.index.min_size = 500
+    gallery.load(students(len(matrix)), matrix)
+    return gallery
+
+
+def test_ivf_top1_agrees_with_the_exact_scan():
+    matrix = encodings(3000)
+    faces = matrix[::30] + np.random.default_rng(1).normal(size=(100, ENCODING_SIZE)).astype(np.float32) * 0.01
+    exact = FaceGallery()
+    exact.load(students(len(matrix)), matrix)
+    ivf = ivf_gallery(matrix)
+    assert ivf.index.ready
+
+    exact_indices, exact_distances = exact.match(faces)
+    ivf_indices, ivf_distances = ivf.match(faces)
+    agreement = np.mean(exact_indices[:, 0] == ivf_indices[:, 0])
+    assert agreement >= 0.95
+    # the candidates are compared exactly, an agreeing match has the same distance
+    same = exact_indices[:, 0] == ivf_indices[:, 0]
+    np.testing.assert_allclose(ivf_distances[same, 0], exact_distances[same, 0], rtol=1e-4, atol=1e-5)
+
+
+def test_ivf_probing_every_list_is_exact():
+    matrix = encodings(1000, seed=4)
+    faces = encodings(20, seed=5)
+    exact = FaceGallery()
+    exact.load(students(len(matrix)), matrix)
+    ivf = ivf_gallery(matrix, nprobe=1000)
+
+    np.testing.assert_array_equal(ivf.match(faces, k=3)[0], exact.match(faces, k=3)[0])
+
+
+def test_small_gallery_stays_on_the_exact_scan():
+    index = IvfIndex()
+    index.train(encodings(100))
+    assert not index.ready
+    assert not index.needs_training(100)
+    assert index.needs_training(index.min_size)
+
+
+def test_ivf_rows_follow_add_and_remove():
+    matrix = encodings(1000, seed=6)
+    ivf = ivf_gallery(matrix, nprobe=1000)
+    extra = encodings(1, seed=7)[0]
+    new_student = students(1001)[-1]
+    ivf.add(new_student, extra)
+    assert ivf.remove("face-3")
+
+    [(student, distance)] = ivf.identify([extra])
+    assert student is new_student and distance < 1e-3
+    [(student, _)] = ivf.identify([matrix[999]])
+    assert student.face_id == "face-999"
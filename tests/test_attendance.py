@@ -0,0 +1,82 @@
+import sqlite3
+import time
+
+import pytest
+
+import attendance
+from attendance import AttendanceWriter, journal_path
+from database import DATABASE_FILE
+
+
+def wait_until(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def attendance_rows(db) -> list:
+    return db.conn.execute("SELECT face_id, datetime FROM attendance_list").fetchall()
+
+
+def test_locked_database_row_is_written_later(db, monkeypatch):
+    monkeypatch.setattr(attendance, "WRITE_RETRIES", 1)
+    monkeypatch.setattr(attendance, "REQUEUE_DELAY", 0.05)
+    db.pool.writer_conn.execute("PRAGMA busy_timeout = 50")
+    writer = AttendanceWriter(db)
+
+    # another process holds the write lock
+    other = sqlite3.connect(DATABASE_FILE, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    try:
+        future = writer.submit("face-1", "face-1.jpg", "Ann", "physics")
+        assert future.result(timeout=5) is False
+        # kept in the journal and still seen as marked
+        assert "face-1" in db.last_marked
+        assert writer.journaled == 1
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+
+    wait_until(lambda: attendance_rows(db))
+    wait_until(lambda: writer.journaled == 0)
+    writer.close()
+    assert len(attendance_rows(db)) == 1
+    with open(writer.journal_file) as journal:
+        assert journal.read() == ""
+
+
+def test_every_writer_has_its_own_journal(db):
+    first = AttendanceWriter(db)
+    second = AttendanceWriter(db)
+    try:
+        assert first.journal_file == journal_path(attendance.JOURNAL_FILE, 0)
+        assert second.journal_file == journal_path(attendance.JOURNAL_FILE, 1)
+        assert first.submit("face-1", "face-1.jpg", "Ann", "physics").result(timeout=5)
+    finally:
+        second.close()
+        first.close()
+
+
+def test_rows_of_a_dead_process_are_adopted(db):
+    with open(journal_path(attendance.JOURNAL_FILE, 1), "w") as journal:
+        journal.write('{"face_id": "face-1", "filename": "face-1.jpg", "name": "Ann", '
+                      '"course": "physics", "datetime": 1700000000}\n{"face_id": ')
+
+    writer = AttendanceWriter(db)
+    wait_until(lambda: attendance_rows(db))
+    writer.close()
+    assert attendance_rows(db) == [("face-1", 1700000000)]
+    with open(journal_path(attendance.JOURNAL_FILE, 1)) as journal:
+        assert journal.read() == ""
+
+
+@pytest.mark.skipif(not hasattr(attendance, "fcntl"), reason="flock only")
+def test_all_journals_in_use(db, monkeypatch):
+    monkeypatch.setattr(attendance, "MAX_JOURNALS", 1)
+    writer = AttendanceWriter(db)
+    try:
+        with pytest.raises(RuntimeError):
+            AttendanceWriter(db)
+    finally:
+        writer.close()
@@ -0,0 +1,229 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from datetime import datetime
+
+import numpy as np
+
+from database import DATABASE_FILE, ENCODING_VERSION, FacesDatabase, blob_to_encodings, encodings_to_blob
+
+LEGACY_FACES = """
+CREATE TABLE faces (
+    id INTEGER PRIMARY KEY,
+    name TEXT not null,
+    course TEXT not null,
+    face_id TEXT not null unique,
+    filename TEXT not null,
+    encodings TEXT not null,
+    datetime INTEGER not null
+);
+"""
+LEGACY_ATTENDANCE = """
+CREATE TABLE attendance_list (
+    id INTEGER PRIMARY KEY,
+    face_id text not null,
+    filename text not null,
+    name TEXT not null,
+    course TEXT not null,
+    datetime INTEGER not null
+);
+"""
+
+
+OPEN_DATABASE = ("from database import FacesDatabase; db = FacesDatabase(); "
+                 "print(db.conn.execute('PRAGMA user_version').fetchone()[0]); db.close_db()")
+
+
+def test_encoding_blob_round_trip():
+    encodings = np.random.default_rng(0).normal(size=128)
+    blob = encodings_to_blob(encodings)
+    assert len(blob) == 128 * 4
+    restored = blob_to_encodings(blob)
+    assert restored.dtype == np.float32
+    np.testing.assert_array_equal(restored, encodings.astype(np.float32))
+
+
+def test_inserted_encodings_read_back(db):
+    encodings = np.random.default_rng(1).normal(size=128)
+    db.insert_face_details("Ann", "physics", "face-1", "face-1.jpg", encodings)
+    student = db.get_student_details("face-1")
+    np.testing.assert_array_equal(student.encodings, encodings.astype(np.float32))
+
+
+def test_legacy_database_migrates_to_latest(workdir):
+    encodings = np.random.default_rng(2).normal(size=128).tolist()
+    conn = sqlite3.connect(DATABASE_FILE)
+    conn.execute(LEGACY_FACES)
+    conn.execute(LEGACY_ATTENDANCE)
+    conn.execute("INSERT INTO faces (name, course, face_id, filename, encodings, datetime) "
+                 "values ('Ann', 'physics', 'face-1', 'face-1.jpg', ?, 1700000000)", (json.dumps(encodings),))
+    conn.executemany("INSERT INTO attendance_list (face_id, filename, name, course, datetime) "
+                     "values ('face-1', 'face-1.jpg', 'Ann', 'physics', ?)", [(1700000000,), (1700000600,)])
+    conn.commit()
+    conn.close()
+
+    db = FacesDatabase()
+    try:
+        assert db.conn.execute("PRAGMA user_version").fetchone()[0] == 7
+        (text, version) = db.conn.execute("SELECT encodings, encoding_version FROM faces").fetchone()
+        assert text == "" and version == ENCODING_VERSION
+        np.testing.assert_array_equal(db.get_encodings("face-1"), np.asarray(encodings, dtype=np.float32))
+        # the attendance marked before the migration is in the rollups
+        assert db.get_daily_report() == [{"day": "2023-11-15", "course": "physics", "students": 1, "marks": 2}]
+    finally:
+        db.close_db()
+
+
+def mark(db, rows):
+    db.insert_attendance_batch([(face_id, f"{face_id}.jpg", face_id, course, time)
+                                for (face_id, course, time) in rows])
+
+
+def all_pages(db, limit, **filters):
+    pages, after = [], ""
+    while True:
+        page, after = db.get_attendance_page(after, limit, **filters)
+        pages.append([row.id for row in page])
+        if not after:
+            return pages
+
+
+def test_attendance_pages_split_equal_times(db):
+    # three rows share every time, so the pages split inside a group
+    mark(db, [(f"face-{n}", "physics", 1700000000 + 60 * (n % 3)) for n in range(9)])
+    expected = [row.id for row in db.get_attendance_page("", 100)[0]]
+
+    pages = all_pages(db, 4)
+    assert [len(page) for page in pages] == [4, 4, 1]
+    # newest first, ties broken by id, no row twice and none missing
+    assert sum(pages, []) == expected
+    assert len(set(expected)) == 9
+
+
+def test_attendance_last_page_has_no_cursor(db):
+    mark(db, [(f"face-{n}", "physics", 1700000000 + n) for n in range(6)])
+
+    # a page of exactly the remaining rows is the last one
+    page, after = db.get_attendance_page("", 6)
+    assert len(page) == 6 and after == ""
+    page, after = db.get_attendance_page("", 3)
+    assert len(page) == 3 and after
+    page, after = db.get_attendance_page(after, 3)
+    assert len(page) == 3 and after == ""
+    assert all_pages(db, 3) == [[6, 5, 4], [3, 2, 1]]
+
+
+def test_attendance_pages_keep_the_filters(db):
+    mark(db, [(f"face-{n}", "physics" if n % 2 else "maths", 1700000000) for n in range(10)])
+
+    pages = all_pages(db, 2, course="physics")
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert sum(pages, []) == [10, 8, 6, 4, 2]
+
+
+def test_deletion_by_another_process_drops_the_cache(db):
+    kiosk = db
+    kiosk.warm_last_marked()
+    mark(kiosk, [("face-1", "physics", round(datetime.now().timestamp()) - 60)])
+    assert 60 <= kiosk.get_time_diff("face-1", max_age=300) < 120
+    assert "face-1" in kiosk.last_marked
+
+    web_app = FacesDatabase()
+    try:
+        [row], _ = web_app.get_attendance_page()
+        assert web_app.delete_attendance_details(row.id)
+    finally:
+        web_app.close_db()
+
+    # no attendance left, the student can be marked again
+    assert kiosk.get_time_diff("face-1", max_age=300) == 0
+    assert "face-1" not in kiosk.last_marked
+
+
+def daily_rollup(db) -> list:
+    return db.conn.execute("SELECT day, course, face_id, marks, first_time, last_time "
+                           "FROM attendance_daily ORDER BY day, course, face_id").fetchall()
+
+
+def test_rollup_counts_inserted_attendance(db):
+    day = 1700000000
+    mark(db, [("face-1", "physics", day), ("face-1", "physics", day + 600), ("face-2", "physics", day + 60),
+              ("face-1", "maths", day + 120), ("face-1", "physics", day + 86400)])
+
+    assert db.get_daily_report() == [
+        {"day": "2023-11-16", "course": "physics", "students": 1, "marks": 1},
+        {"day": "2023-11-15", "course": "maths", "students": 1, "marks": 1},
+        {"day": "2023-11-15", "course": "physics", "students": 2, "marks": 3},
+    ]
+    assert ("2023-11-15", "physics", "face-1", 2, day, day + 600) in daily_rollup(db)
+    report = {row["face_id"]: row for row in db.get_course_report("physics")}
+    assert report["face-1"]["days"] == 2 and report["face-1"]["marks"] == 3
+    assert report["face-2"]["days"] == 1 and report["face-2"]["marks"] == 1
+
+
+def test_rollup_follows_deleted_attendance(db):
+    day = 1700000000
+    mark(db, [("face-1", "physics", day), ("face-1", "physics", day + 600), ("face-1", "physics", day + 1200),
+              ("face-2", "physics", day + 60)])
+    ids = {time: id for (id, time) in db.conn.execute("SELECT id, datetime FROM attendance_list")}
+
+    # the first and last times are found again without the deleted row
+    assert db.delete_attendance_details(ids[day])
+    assert db.delete_attendance_details(ids[day + 1200])
+    assert ("2023-11-15", "physics", "face-1", 1, day + 600, day + 600) in daily_rollup(db)
+    assert db.get_daily_report() == [{"day": "2023-11-15", "course": "physics", "students": 2, "marks": 2}]
+
+    # the last mark of a student removes the student, the last of a day the day
+    assert db.delete_attendance_details(ids[day + 60])
+    assert db.get_daily_report() == [{"day": "2023-11-15", "course": "physics", "students": 1, "marks": 1}]
+    assert [row[2] for row in daily_rollup(db)] == ["face-1"]
+    assert db.delete_attendance_details(ids[day + 600])
+    assert db.get_daily_report() == []
+    assert daily_rollup(db) == []
+
+
+def test_processes_starting_together_migrate_once(workdir):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    processes = [subprocess.Popen([sys.executable, "-c", OPEN_DATABASE], cwd=workdir, env=env,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                 for _ in range(8)]
+    outputs = [process.communicate(timeout=60)[0].strip() for process in processes]
+    assert outputs == ["7"] * 8
+    assert [process.returncode for process in processes] == [0] * 8
+
+
+def test_face_changes_follow_inserts_and_deletes(db):
+    start = db.get_faces_revision()
+    encodings = np.random.default_rng(3).normal(size=128)
+    db.insert_face_details("Ann", "physics", "face-1", "face-1.jpg", encodings)
+    assert db.get_faces_revision() == start + 1
+    assert db.conn.execute("SELECT revision, operation, face_id FROM faces_changes").fetchall() == [
+        (start + 1, "insert", "face-1")]
+    [(revision, operation, face_id, student)] = db.get_face_changes(start)
+    assert (revision, operation, face_id) == (start + 1, "insert", "face-1")
+    np.testing.assert_array_equal(student.encodings, encodings.astype(np.float32))
+
+    assert db.delete_face_details("face-1")
+    assert db.get_faces_revision() == start + 2
+    assert db.get_face_changes(start + 1) == [(start + 2, "delete", "face-1", None)]
+    # the insert of a student deleted since has no student any more
+    assert db.get_face_changes(start) == [(start + 1, "insert", "face-1", None),
+                                          (start + 2, "delete", "face-1", None)]
+
+
+def test_insert_many_faces_in_one_transaction(db):
+    encodings = np.random.default_rng(4).normal(size=(3, 128))
+    faces = [(f"Student {n}", "physics", f"face-{n}", f"face-{n}.jpg", encodings[n]) for n in range(2)]
+    assert db.insert_many_faces(faces) == 2
+    assert db.get_faces_revision() == 2
+    np.testing.assert_array_equal(db.get_encodings("face-1"), encodings[1].astype(np.float32))
+
+    # a duplicate face id fails the batch, the new student before it is not kept
+    batch = [("Student 2", "physics", "face-2", "face-2.jpg", encodings[2]), faces[0]]
+    assert db.insert_many_faces(batch) == 0
+    assert [student.face_id for student in db.get_all_faces()] == ["face-0", "face-1"]
+    assert db.get_faces_revision() == 2
+    assert db.insert_many_faces([]) == 0
@@ -0,0 +1,76 @@
+import io
+import zipfile
+
+import numpy as np
+import pytest
+
+# the enrollment module draws the photo variants with OpenCV, dlib is only
+# imported by prepare_photo, which these tests do not call
+pytest.importorskip("cv2")
+
+from enrollment import MAX_ROSTER_BYTES, read_roster, stage_archive, store_students  # noqa: E402
+
+
+def archive(files: dict) -> io.BytesIO:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zip_file:
+        for name, content in files.items():
+            zip_file.writestr(name, content)
+    buffer.seek(0)
+    return buffer
+
+
+def test_read_roster_normalizes_the_columns():
+    roster = read_roster("Name, Course ,PHOTO,extra\n Ann ,physics, ann.jpg,1\nBob,,bob.png,2\n")
+    assert roster == [{"name": "Ann", "course": "physics", "photo": "ann.jpg"},
+                      {"name": "Bob", "course": "", "photo": "bob.png"}]
+    with pytest.raises(ValueError, match="photo"):
+        read_roster("name,course\nAnn,physics\n")
+
+
+def test_stage_archive_rejects_the_invalid_rows(workdir):
+    (workdir / "faces").mkdir()
+    roster = ("name,course,photo\nAnn,physics,ann.jpg\n,physics,bob.jpg\nCid,physics,cid.gif\n"
+              "Dan,physics,missing.jpg\n")
+    results, photos = stage_archive(archive({"roster.csv": roster, "photos/ann.jpg": b"ann"}), "",
+                                    str(workdir / "faces"))
+
+    assert [result["reason"] for result in results] == [
+        "", "name and course are required", "photo must be one of .jpg, .jpeg, .png, .bmp", "photo not found"]
+    [(result, filename)] = photos
+    assert result["name"] == "Ann" and filename == result["face_id"] + ".jpg"
+    assert (workdir / "faces" / filename).read_bytes() == b"ann"
+
+
+def test_stage_archive_never_mixes_up_photos_with_the_same_name(workdir):
+    (workdir / "faces").mkdir()
+    files = {"a/photo.jpg": b"first", "b/photo.jpg": b"second"}
+    roster = "name,course,photo\nAnn,physics,photo.jpg\nBob,physics,b/photo.jpg\n"
+    results, photos = stage_archive(archive(files), roster, str(workdir / "faces"))
+
+    assert results[0]["face_id"] == "" and "2 photos named photo.jpg" in results[0]["reason"]
+    [(result, filename)] = photos
+    assert result["name"] == "Bob"
+    assert (workdir / "faces" / filename).read_bytes() == b"second"
+
+
+def test_stage_archive_refuses_a_large_roster(workdir):
+    roster = "name,course,photo\n" + "x" * MAX_ROSTER_BYTES
+    with pytest.raises(ValueError, match="roster is larger"):
+        stage_archive(archive({"roster.csv": roster}), "", str(workdir))
+
+
+def test_store_students_rejects_photos_without_one_face(db, workdir):
+    (workdir / "faces").mkdir()
+    roster = "name,course,photo\nAnn,physics,ann.jpg\nBob,physics,bob.jpg\n"
+    results, photos = stage_archive(archive({"ann.jpg": b"ann", "bob.jpg": b"bob"}), roster,
+                                    str(workdir / "faces"))
+    encodings = [(np.zeros(128), ""), (None, "2 faces found")]
+
+    report = store_students(db, results, photos, encodings, str(workdir / "faces"))
+    assert (report["rows"], report["encoded"], report["enrolled"], report["rejected"]) == (2, 2, 1, 1)
+    assert [result["status"] for result in results] == ["enrolled", "rejected"]
+    assert results[1]["reason"] == "2 faces found" and results[1]["face_id"] == ""
+    assert [student.name for student in db.get_all_faces()] == ["Ann"]
+    # the photo of the rejected student is removed
+    assert sorted(path.name for path in (workdir / "faces").iterdir()) == [photos[0][1]]
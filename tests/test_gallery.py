@@ -0,0 +1,78 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from gallery import ENCODING_SIZE, FaceGallery
+
+
+def students(count: int) -> list:
+    return [SimpleNamespace(face_id=f"face-{n}", name=f"Student {n}") for n in range(count)]
+
+
+def encodings(count: int, seed: int = 0) -> np.ndarray:
+    # about the scale of the dlib encodings, students are ~1.6 apart
+    return (np.random.default_rng(seed).normal(size=(count, ENCODING_SIZE)) * 0.1).astype(np.float32)
+
+
+def brute_force(matrix: np.ndarray, faces: np.ndarray) -> tuple:
+    distances = np.linalg.norm(faces[:, None, :] - matrix[None, :, :], axis=2)
+    order = np.argsort(distances, axis=1)
+    return order, np.take_along_axis(distances, order, axis=1)
+
+
+def test_match_agrees_with_brute_force():
+    matrix = encodings(50)
+    gallery = FaceGallery()
+    gallery.load(students(50), matrix)
+    faces = np.vstack([matrix[:5] + 0.01, encodings(3, seed=1)])
+
+    indices, distances = gallery.match(faces, k=3)
+    expected_indices, expected_distances = brute_force(matrix, faces)
+    np.testing.assert_array_equal(indices, expected_indices[:, :3])
+    np.testing.assert_allclose(distances, expected_distances[:, :3], rtol=1e-4, atol=1e-5)
+
+
+def test_identify_applies_the_tolerance():
+    matrix = encodings(20)
+    gallery = FaceGallery()
+    gallery.load(students(20), matrix)
+    near = matrix[7] + 0.01
+    far = matrix[7] + 0.6 / np.sqrt(ENCODING_SIZE) * 1.1
+
+    [(student, distance), (nobody, far_distance)] = gallery.identify([near, far])
+    assert student.face_id == "face-7"
+    assert distance <= 0.6
+    assert nobody is None and far_distance > 0.6
+
+
+def test_empty_gallery_identifies_nobody():
+    gallery = FaceGallery()
+    gallery.load([], [])
+    assert gallery.identify(encodings(2)) == [(None, 1.0), (None, 1.0)]
+
+
+def test_add_and_remove_keep_rows_and_students_together():
+    matrix = encodings(10)
+    original = matrix.copy()
+    gallery = FaceGallery()
+    gallery.load(students(10), matrix)
+
+    assert gallery.remove("face-2")
+    assert not gallery.remove("face-2")
+    extra = encodings(3, seed=2)
+    for student, encoding in zip(students(13)[10:], extra):
+        gallery.add(student, encoding)
+    assert gallery.remove("face-11")
+
+    # the caller's array is never changed by the gallery
+    np.testing.assert_array_equal(matrix, original)
+    expected = {f"face-{n}": original[n] for n in range(10)}
+    expected.update({"face-10": extra[0], "face-12": extra[2]})
+    del expected["face-2"]
+    assert len(gallery) == len(expected)
+    for row, student in enumerate(gallery.students):
+        np.testing.assert_array_equal(gallery.encodings[row], expected[student.face_id])
+        np.testing.assert_allclose(gallery.norms[row], np.dot(expected[student.face_id], expected[student.face_id]),
+                                   rtol=1e-6)
+    [(student, _)] = gallery.identify([extra[2]])
+    assert student.face_id == "face-12"
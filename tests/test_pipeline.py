@@ -0,0 +1,39 @@
+import queue
+
+from pipeline import FrameSlot, put_latest
+
+
+def test_put_latest_drops_the_oldest_item():
+    results = queue.Queue(maxsize=2)
+    for item in range(5):
+        put_latest(results, item)
+    assert [results.get_nowait(), results.get_nowait()] == [3, 4]
+    assert results.empty()
+
+
+def test_put_latest_into_a_queue_with_room():
+    results = queue.Queue(maxsize=1)
+    put_latest(results, "frame")
+    assert results.get_nowait() == "frame"
+
+
+def test_slot_hands_out_only_the_latest_frame():
+    slot = FrameSlot()
+    for frame in ("first", "second", "third"):
+        slot.publish(frame)
+
+    assert slot.wait(0, timeout=0) == (3, "third")
+    # nothing newer than what the reader has seen
+    assert slot.wait(3, timeout=0) == (3, None)
+    slot.publish("fourth")
+    assert slot.wait(3, timeout=0) == (4, "fourth")
+
+
+def test_closed_slot_ends_the_readers():
+    slot = FrameSlot()
+    slot.publish("frame")
+    slot.close()
+    assert slot.closed
+    assert slot.wait(1, timeout=None) == (1, None)
+    # a frame published before the close is still handed out
+    assert slot.wait(0, timeout=None) == (1, "frame")
@@ -0,0 +1,53 @@
+import os
+
+import numpy as np
+
+import snapshot
+from snapshot import SNAPSHOT_INDEX, load_snapshot, read_index
+
+
+def enroll(db, count: int, first: int = 0) -> np.ndarray:
+    encodings = np.random.default_rng(first).normal(size=(count, 128)).astype(np.float32)
+    for n, encoding in enumerate(encodings, start=first):
+        db.insert_face_details(f"Student {n}", "physics", f"face-{n}", f"face-{n}.jpg", encoding)
+    return encodings
+
+
+def matrices(folder) -> list:
+    return sorted(name for name in os.listdir(folder) if name.endswith(".npy"))
+
+
+def test_stale_snapshot_is_exported_again(db, workdir):
+    first = enroll(db, 2)
+    students, encodings, revision = load_snapshot(db)
+    assert [student.face_id for student in students] == ["face-0", "face-1"]
+    np.testing.assert_array_equal(encodings, first)
+    [matrix] = matrices(workdir / "db")
+    assert read_index(str(workdir / "db"))["matrix"] == matrix
+
+    second = enroll(db, 1, first=2)
+    students, encodings, new_revision = load_snapshot(db)
+    assert new_revision == db.get_faces_revision() != revision
+    assert len(students) == 3
+    np.testing.assert_array_equal(encodings, np.vstack([first, second]))
+    # the matrix of the stale export is gone, the index names the new one
+    [new_matrix] = matrices(workdir / "db")
+    assert new_matrix != matrix
+    assert read_index(str(workdir / "db"))["matrix"] == new_matrix
+
+
+def test_unreadable_snapshot_falls_back_to_the_database(db, workdir, monkeypatch):
+    first = enroll(db, 3)
+    attempts = []
+
+    def vanished(path, mmap_mode=None):
+        attempts.append(path)
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr(snapshot.np, "load", vanished)
+    students, encodings, revision = load_snapshot(db)
+    assert len(attempts) == snapshot.SNAPSHOT_RETRIES
+    assert [student.face_id for student in students] == ["face-0", "face-1", "face-2"]
+    np.testing.assert_array_equal(encodings, first)
+    assert revision == db.get_faces_revision()
+    assert os.path.exists(workdir / "db" / SNAPSHOT_INDEX)
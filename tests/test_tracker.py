@@ -0,0 +1,37 @@
+from tracker import FaceTracker
+
+FACE = (10, 60, 60, 10)
+MOVED = (12, 62, 62, 12)
+
+
+def test_track_keeps_identity_without_a_fresh_match():
+    tracker = FaceTracker()
+    [track] = tracker.update([FACE])
+    track.identify("alice", 0.3)
+    assert track.matched
+
+    [same] = tracker.update([MOVED])
+    assert same is track
+    assert same.student == "alice"
+    assert not same.matched
+
+
+def test_empty_frame_drops_every_track():
+    tracker = FaceTracker()
+    [track] = tracker.update([FACE])
+    track.identify("alice", 0.3)
+
+    assert tracker.update([]) == []
+    [face] = tracker.update([FACE])
+    assert face is not track
+    assert face.student is None
+
+
+def test_expire_makes_the_faces_encode_again():
+    tracker = FaceTracker()
+    [track] = tracker.update([FACE])
+    track.identify("alice", 0.3)
+    assert tracker.fresh_locations() == [FACE]
+
+    tracker.expire()
+    assert tracker.fresh_locations() == []
@@ -0,0 +1,141 @@
+import collections
+import json
+import os
+import random
+import threading
+import time
+
+from loguru import logger
+
+TRACE_SAMPLE = 0.1  # fraction of the frames traced
+MAX_TRACE_EVENTS = 200000  # the oldest events are dropped beyond this
+
+
+class NullSpan:
+    """
+    Span of a frame that is not traced, entering and leaving it does
+    nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    A timed block, recorded as a complete event of the Chrome trace format
+    when it ends.
+    """
+
+    def __init__(self, tracer: "Tracer", name: str, category: str, args: dict, root: bool = False):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.root = root
+
+    def __enter__(self):
+        if self.root:
+            self.tracer.local.active = True
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        if self.root:
+            self.tracer.local.active = False
+        self.tracer.record(self.name, self.category, self.start, end, self.args)
+        return False
+
+
+class Tracer:
+    """
+    Span tracer of the recognition loop and the database calls.
+
+    A sampled fraction of the frames is traced: ``frame()`` starts the
+    root span of a frame, and the ``span()`` blocks inside it, on the same
+    thread, are recorded. Outside a traced frame, or when the tracer is
+    disabled, both return a shared no-op span, so the cost is an attribute
+    check. The events are kept in memory and written as Chrome trace event
+    JSON, which chrome://tracing and https://ui.perfetto.dev open.
+    """
+
+    def __init__(self, path: str = None, sample: float = TRACE_SAMPLE, max_events: int = MAX_TRACE_EVENTS):
+        self.local = threading.local()
+        self.events = collections.deque(maxlen=max_events)
+        self.configure(path, sample)
+
+    ############################################################
+    # turn tracing on (with a file) or off (without)
+    ############################################################
+    def configure(self, path: str = None, sample: float = TRACE_SAMPLE):
+        self.path = path
+        self.sample = sample
+        self.enabled = path is not None and sample > 0
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+
+    ############################################################
+    # root span of a frame, traced for a sample of the frames
+    ############################################################
+    def frame(self, name: str = "frame", **args):
+        if not self.enabled:
+            return NULL_SPAN
+        # a frame inside a traced frame is an ordinary span
+        if getattr(self.local, "active", False):
+            return Span(self, name, "frame", args)
+        if random.random() >= self.sample:
+            return NULL_SPAN
+        return Span(self, name, "frame", args, root=True)
+
+    ############################################################
+    # span inside a traced frame
+    ############################################################
+    def span(self, name: str, category: str = "stage", **args):
+        if not self.enabled or not getattr(self.local, "active", False):
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    ############################################################
+    # keep a finished span
+    ############################################################
+    def record(self, name: str, category: str, start: float, end: float, args: dict):
+        self.events.append({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            # microseconds since the tracer started
+            "ts": round((start - self.origin) * 1e6, 3),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": args,
+        })
+
+    ############################################################
+    # write the trace file
+    ############################################################
+    def write(self):
+        """
+        Write the recorded spans and the thread names to the trace file.
+        """
+        if not self.enabled:
+            return
+        events = list(self.events)
+        names = {event["tid"] for event in events}
+        threads = {thread.ident: thread.name for thread in threading.enumerate()}
+        metadata = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid,
+                     "args": {"name": threads.get(tid, str(tid))}} for tid in names]
+        with open(self.path, "w", encoding="utf-8") as trace_file:
+            json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, trace_file)
+        logger.info(f"{len(events)} trace events written to {self.path}")
+
+
+# the tracer of the process, disabled until configured
+TRACER = Tracer()
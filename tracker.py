@@ -0,0 +1,167 @@
+import threading
+from typing import List, Optional
+
+TRACK_IOU_THRESHOLD = 0.4  # minimum overlap to continue a track
+TRACK_CONFIDENCE_DECAY = 0.9  # confidence kept per frame without encoding
+TRACK_MIN_CONFIDENCE = 0.5  # below this the face is encoded again
+TRACK_MAX_MISSES = 2  # frames a track survives without a detection
+
+
+################################################################################
+# intersection over union of two face locations
+################################################################################
+def iou(a, b) -> float:
+    """
+    Overlap of two (top, right, bottom, left) boxes, 0 for disjoint and
+    1 for identical boxes.
+    """
+    (a_top, a_right, a_bottom, a_left) = a
+    (b_top, b_right, b_bottom, b_left) = b
+    width = min(a_right, b_right) - max(a_left, b_left)
+    height = min(a_bottom, b_bottom) - max(a_top, b_top)
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    union = ((a_right - a_left) * (a_bottom - a_top) +
+             (b_right - b_left) * (b_bottom - b_top) - intersection)
+    return intersection / union if union > 0 else 0.0
+
+
+################################################################################
+# check if the location continues one of the given tracks
+################################################################################
+def is_tracked(location, locations) -> bool:
+    """
+    True if the location overlaps one of the given locations enough to be
+    the same face.
+    """
+    return any(iou(location, other) >= TRACK_IOU_THRESHOLD for other in locations)
+
+
+class Track:
+    """
+    A face followed over several frames with its last known identity.
+    """
+
+    def __init__(self, track_id: int, location):
+        self.track_id = track_id
+        self.location = location
+        self.student = None
+        self.distance = 1.0
+        self.confidence = 0.0
+        self.misses = 0
+        # the identity was matched from an encoding of the current frame
+        self.matched = False
+
+    ############################################################
+    # set the identity from a fresh encoding
+    ############################################################
+    def identify(self, student, distance: float):
+        self.student = student
+        self.distance = distance
+        self.confidence = 1.0
+        self.matched = True
+
+    @property
+    def fresh(self) -> bool:
+        """
+        True while the identity can be reused without encoding.
+        """
+        return self.confidence >= TRACK_MIN_CONFIDENCE
+
+
+class FaceTracker:
+    """
+    Follows the detected faces from frame to frame by box overlap, so a
+    face only has to be encoded when it appears or its identity has gone
+    stale. The confidence of an identity decays every frame, faster when
+    the face moves. The recognition thread updates the tracks while the
+    render thread may expire them, both hold the lock.
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.tracks: List[Track] = []
+        self._next_id = 1
+        self.lock = threading.RLock()
+
+    ############################################################
+    # locations of the tracks with a usable identity
+    ############################################################
+    def fresh_locations(self) -> list:
+        """
+        Locations of the tracks which do not need a new encoding.
+        """
+        if not self.enabled:
+            return []
+        with self.lock:
+            return [track.location for track in self.tracks if track.fresh]
+
+    ############################################################
+    # encode every tracked face again on the next frame
+    ############################################################
+    def expire(self):
+        """
+        Make the identities stale, so the next frame matches every face
+        against the gallery instead of reusing its track.
+        """
+        with self.lock:
+            for track in self.tracks:
+                track.confidence = 0.0
+
+    ############################################################
+    # associate the detected faces with the tracks
+    ############################################################
+    def update(self, face_locations) -> List[Track]:
+        """
+        Continue the tracks with the detected face locations.
+
+        Returns
+        -------
+        tracks : list
+            One track per face location, in the same order
+        """
+        with self.lock:
+            # nobody in front of the camera, a face appearing later is a new one
+            if not face_locations:
+                self.tracks = []
+                return []
+
+            for track in self.tracks:
+                track.matched = False
+
+            # greedy association, best overlapping pairs first
+            pairs = []
+            for face_index, location in enumerate(face_locations):
+                for track in self.tracks:
+                    overlap = iou(location, track.location)
+                    if overlap >= TRACK_IOU_THRESHOLD:
+                        pairs.append((overlap, face_index, track))
+            pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+            assigned: List[Optional[Track]] = [None] * len(face_locations)
+            used = set()
+            for overlap, face_index, track in pairs:
+                if assigned[face_index] is not None or track.track_id in used:
+                    continue
+                track.location = face_locations[face_index]
+                track.confidence *= TRACK_CONFIDENCE_DECAY * overlap
+                track.misses = 0
+                assigned[face_index] = track
+                used.add(track.track_id)
+
+            # drop the tracks which have not been seen for a while
+            for track in self.tracks:
+                if track.track_id not in used:
+                    track.misses += 1
+            self.tracks = [track for track in self.tracks if track.misses <= TRACK_MAX_MISSES]
+
+            # new faces
+            for face_index, location in enumerate(face_locations):
+                if assigned[face_index] is None:
+                    track = Track(self._next_id, location)
+                    self._next_id += 1
+                    self.tracks.append(track)
+                    assigned[face_index] = track
+
+            return assigned